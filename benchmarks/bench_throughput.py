@@ -0,0 +1,307 @@
+"""End to end throughput benchmark against a simulated Logs Insights backend.
+
+Runs `CloudwatchAPI.get_records_iterator` and a full `TapCloudWatch` sync for
+each combination of query engine, `batch_increment_s` and query concurrency,
+and reports records per second, API calls, bytes scanned and peak memory. The
+`batch` mode syncs with BATCH messages instead of RECORD messages.
+
+Time is simulated by default. The async engine and the `filter` engine, which
+reads with FilterLogEvents, run their requests in other threads, so they can
+only be compared with `--real-time`, best with shorter latencies, e.g.
+`--real-time --queue-s 0.1 --base-latency-s 0.5`.
+
+Run with `poetry run python -m benchmarks.bench_throughput`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import functools
+import gzip
+import itertools
+import json
+import logging
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from benchmarks.fake_logs import FakeLogsClient, FakeS3Client, SimulatedClock
+from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.tap import TapCloudWatch
+
+LOG_GROUP = "/aws/benchmark"
+QUERY = "fields @timestamp, @message"
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+class _RecordCounter:
+    """Stand-in for stdout counting the Singer RECORD messages written.
+
+    The files announced by BATCH messages are collected to be counted later.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.batch_files = []
+
+    def write(self, data):
+        self.records += data.count('"type":"RECORD"')
+        if '"type":"BATCH"' in data:
+            for line in data.splitlines():
+                if '"type":"BATCH"' in line:
+                    self.batch_files.extend(json.loads(line)["manifest"])
+
+    def flush(self):
+        pass
+
+
+def _api_class(concurrency):
+    class BenchmarkAPI(CloudwatchAPI):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.max_concurrent_queries = concurrency
+
+    return BenchmarkAPI
+
+
+def _engine_name(config):
+    if config.get("filter_log_events"):
+        return "filter"
+    return config.get("query_engine", "sync")
+
+
+def _engine_config(engine):
+    if engine == "filter":
+        return {"filter_log_events": True}
+    return {"query_engine": engine}
+
+
+@contextlib.contextmanager
+def _measure(fake, result, trace_memory):
+    random.seed(0)
+    if trace_memory:
+        tracemalloc.start()
+    started = fake.clock.monotonic()
+    cpu_started = time.process_time()
+    if isinstance(fake.clock, SimulatedClock):
+        clock = fake.clock.patched()
+    else:
+        clock = contextlib.nullcontext()
+    try:
+        with clock:
+            yield
+    finally:
+        result["elapsed_s"] = fake.clock.monotonic() - started
+        result["cpu_s"] = time.process_time() - cpu_started
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        if trace_memory:
+            tracemalloc.stop()
+        result["start_query"] = fake.calls["start_query"]
+        result["get_query_results"] = fake.calls["get_query_results"]
+        result["throttled"] = sum(fake.throttled.values())
+        result["scanned_mb"] = fake.bytes_scanned / 2**20
+
+
+def run_api(fake, days, batch_increment_s, concurrency, config=None, trace_memory=True):
+    """Read every record through `CloudwatchAPI.get_records_iterator`."""
+    config = {"aws_region_name": "us-east-1", **(config or {})}
+    result = {
+        "mode": "api",
+        "engine": _engine_name(config),
+        "batch_s": batch_increment_s,
+        "concurrency": concurrency,
+    }
+    api = _api_class(concurrency)(logging.getLogger("benchmark"), config)
+    with mock.patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+    api._s3_client = fake.s3
+    records = 0
+    with _measure(fake, result, trace_memory):
+        for batch in api.get_records_iterator(
+            START,
+            LOG_GROUP,
+            QUERY,
+            batch_increment_s,
+            START + timedelta(days=days),
+        ):
+            records += len(batch)
+    result["records"] = records
+    return result
+
+
+def _count_batch_records(batch_files):
+    records = 0
+    for url in batch_files:
+        with gzip.open(url[len("file://") :]) as batch_file:
+            records += sum(1 for _ in batch_file)
+    return records
+
+
+def run_tap(
+    fake,
+    days,
+    batch_increment_s,
+    concurrency,
+    config=None,
+    trace_memory=True,
+    batch=False,
+):
+    """Sync every record with `TapCloudWatch`, discarding the messages.
+
+    With `batch` the records are written to gzip JSONL files announced by BATCH
+    messages, which are deleted once their records are counted.
+    """
+    batch_dir = tempfile.TemporaryDirectory() if batch else None
+    config = {
+        "log_group_name": LOG_GROUP,
+        "query": QUERY,
+        "aws_region_name": "us-east-1",
+        "start_date": START.isoformat(),
+        "end_date": (START + timedelta(days=days)).isoformat(),
+        "batch_increment_s": batch_increment_s,
+        **(config or {}),
+    }
+    if batch_dir:
+        config["batch_config"] = {
+            "encoding": {"format": "jsonl", "compression": "gzip"},
+            "storage": {"root": f"file://{batch_dir.name}"},
+        }
+    result = {
+        "mode": "batch" if batch else "tap",
+        "engine": _engine_name(config),
+        "batch_s": batch_increment_s,
+        "concurrency": concurrency,
+    }
+    counter = _RecordCounter()
+    with (
+        mock.patch.object(CloudwatchAPI, "_create_client", return_value=fake),
+        mock.patch.object(CloudwatchAPI, "_create_s3_client", return_value=fake.s3),
+        mock.patch("tap_cloudwatch.client.CloudwatchAPI", _api_class(concurrency)),
+    ):
+        tap = TapCloudWatch(config=config, parse_env_config=False)
+        with _measure(fake, result, trace_memory), contextlib.redirect_stdout(counter):
+            tap.sync_all()
+    result["records"] = counter.records
+    if batch_dir:
+        result["records"] = _count_batch_records(counter.batch_files)
+        result["batches"] = len(counter.batch_files)
+        batch_dir.cleanup()
+    return result
+
+
+def report(result):
+    """Format a benchmark result as a table row."""
+    return (
+        f"{result['mode']:>5} {result['engine']:>6} {result['batch_s']:>8}"
+        f" {result['concurrency']:>4} {result['records']:>9}"
+        f" {result['elapsed_s']:>9.1f}"
+        f" {result['records'] / max(result['elapsed_s'], 1e-9):>10,.0f}"
+        f" {result['cpu_s']:>7.2f} {result['start_query']:>6}"
+        f" {result['get_query_results']:>7} {result['throttled']:>6}"
+        f" {result['scanned_mb']:>9.1f} {result['peak_mb']:>8.1f}"
+    )
+
+
+HEADER = (
+    " mode engine  batch_s conc   records elapsed_s  records/s   cpu_s starts"
+    "   polls thrott scanned_mb  peak_mb"
+)
+
+
+def main():
+    """Print a result row per mode, batch size and concurrency."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=float, default=0.25)
+    parser.add_argument("--records-per-s", type=float, default=1.0)
+    parser.add_argument(
+        "--batch-increment-s", type=int, nargs="+", default=[3600, 21600, 86400]
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument(
+        "--mode", choices=["api", "tap", "batch", "both", "all"], default="both"
+    )
+    parser.add_argument(
+        "--engine", choices=["sync", "async", "filter"], nargs="+", default=["sync"]
+    )
+    parser.add_argument(
+        "--real-time",
+        action="store_true",
+        help="Wait for the simulated latencies instead of simulating time.",
+    )
+    parser.add_argument("--transfer-rate", type=float, default=20000)
+    parser.add_argument("--tps", type=float, default=5)
+    parser.add_argument("--log-streams", type=int, default=1)
+    parser.add_argument("--filter-latency-s", type=float, default=0.2)
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Read the range from an export task instead of querying it.",
+    )
+    parser.add_argument("--export-latency-s", type=float, default=30.0)
+    parser.add_argument("--queue-s", type=float, default=1.0)
+    parser.add_argument("--base-latency-s", type=float, default=2.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--stuck-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip tracing peak memory, which slows the runs down several times.",
+    )
+    args = parser.parse_args()
+    if set(args.engine) - {"sync"} and not args.real_time:
+        parser.error("only the sync engine can be benchmarked in simulated time")
+
+    run_batch = functools.partial(run_tap, batch=True)
+    runners = {
+        "api": [run_api],
+        "tap": [run_tap],
+        "batch": [run_batch],
+        "both": [run_api, run_tap],
+        "all": [run_api, run_tap, run_batch],
+    }
+    logging.disable(logging.INFO)
+    print(HEADER)
+    for runner, batch_increment_s, concurrency, engine in itertools.product(
+        runners[args.mode], args.batch_increment_s, args.concurrency, args.engine
+    ):
+        fake = FakeLogsClient(
+            time if args.real_time else SimulatedClock(),
+            records_per_s=args.records_per_s,
+            queue_s=args.queue_s,
+            base_latency_s=args.base_latency_s,
+            transfer_rate=args.transfer_rate,
+            tps=args.tps,
+            log_streams=args.log_streams,
+            filter_latency_s=args.filter_latency_s,
+            s3=FakeS3Client() if args.export else None,
+            export_latency_s=args.export_latency_s,
+            throttle_rate=args.throttle_rate,
+            failure_rate=args.failure_rate,
+            timeout_rate=args.timeout_rate,
+            stuck_rate=args.stuck_rate,
+        )
+        result = runner(
+            fake,
+            args.days,
+            batch_increment_s,
+            concurrency,
+            config={
+                **_engine_config(engine),
+                "start_query_rate_limit": args.tps,
+                "get_query_results_rate_limit": args.tps,
+                "filter_log_events_rate_limit": args.tps,
+                **({"export_bucket": "benchmark"} if args.export else {}),
+            },
+            trace_memory=not args.no_memory,
+        )
+        print(report(result))
+
+
+if __name__ == "__main__":
+    main()
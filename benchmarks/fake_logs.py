@@ -0,0 +1,475 @@
+"""Simulated Logs Insights backend for running benchmarks offline.
+
+`FakeLogsClient` stands in for a boto3 `logs` client. Queries are scheduled on
+a `SimulatedClock` so a benchmark covering days of logs and minutes of query
+latency finishes in seconds of real time.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import gzip
+import io
+import random
+import re
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from math import floor
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+LIMIT = 10000
+QUERY_TIMEOUT_S = 3600
+
+
+class SimulatedClock:
+    """Clock that only advances when something sleeps."""
+
+    def __init__(self, start=None):
+        """Initialize SimulatedClock.
+
+        It starts from the real monotonic time by default so objects created
+        before the clock is patched in, e.g. rate limiters, stay consistent.
+        """
+        self.now = time.monotonic() if start is None else start
+
+    def monotonic(self):
+        """Return the simulated time."""
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the simulated time instead of sleeping."""
+        self.now += max(seconds, 0)
+
+    @contextlib.contextmanager
+    def patched(self):
+        """Route `time.monotonic` and `time.sleep` through this clock."""
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch("time.monotonic", self.monotonic))
+            stack.enter_context(mock.patch("time.sleep", self.sleep))
+            yield self
+
+
+class FakeS3Client:
+    """Fake `s3` client holding objects in memory."""
+
+    def __init__(self, page_size=1000):
+        """Initialize FakeS3Client."""
+        self.objects: dict[tuple[str, str], bytes] = {}
+        self.page_size = page_size
+        self.calls: Counter = Counter()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        """Store an object."""
+        self.calls["put_object"] += 1
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key, **kwargs):
+        """Return an object's body as a stream."""
+        self.calls["get_object"] += 1
+        try:
+            body = self.objects[(Bucket, Key)]
+        except KeyError:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject"
+            ) from None
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, **kwargs):
+        """Return a page of the keys under a prefix, in order."""
+        self.calls["list_objects_v2"] += 1
+        keys = sorted(
+            key for bucket, key in self.objects if bucket == Bucket and key >= Prefix
+        )
+        keys = [key for key in keys if key.startswith(Prefix)]
+        first = int(ContinuationToken or 0)
+        page = keys[first : first + self.page_size]
+        response: dict = {
+            "Contents": [
+                {"Key": key, "Size": len(self.objects[(Bucket, key)])} for key in page
+            ],
+            "IsTruncated": first + self.page_size < len(keys),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(first + self.page_size)
+        return response
+
+
+class _FakeQuery:
+    def __init__(self, submitted_at, queue_s, run_s, outcome, request):
+        self.running_at = submitted_at + queue_s
+        self.done_at = self.running_at + run_s
+        self.outcome = outcome
+        # Results are only built when fetched so the fake doesn't hold them.
+        self.request = request
+
+    def status(self, now):
+        if now < self.running_at:
+            return "Scheduled"
+        if now < self.done_at:
+            return "Running"
+        return self.outcome
+
+
+class FakeLogsClient:
+    """Fake `logs` client serving a steady stream of synthetic log records.
+
+    Every log group holds `records_per_s` records per second. Queries wait
+    `queue_s` before they start running and then take `base_latency_s` plus
+    the time to scan their window at `scan_rate` records per second. Only the
+    first 10k records of a window are returned, as Logs Insights does, and
+    fetching them takes a second per `transfer_rate` rows.
+
+    The records are spread across `log_streams` log streams, which
+    `filter_log_events` reads in pages of up to 1 MB, taking
+    `filter_latency_s` per call plus the transfer time. Every event is
+    ingested `ingestion_lag_s` after its timestamp.
+
+    `create_export_task` writes a range's events to the `s3` fake after
+    `export_latency_s` plus the time to scan the range, in gzip objects of up
+    to `export_object_events` events per log stream. Only one export task
+    runs at a time.
+
+    The `clock` is a `SimulatedClock`, or the `time` module to run in real
+    time.
+
+    Calls over `tps` per second for an operation, or over `max_concurrent`
+    running queries for `start_query`, are rejected with the same errors the
+    API raises. `throttle_rate`, `failure_rate` and `timeout_rate` randomly
+    throttle calls and end queries as `Failed` or `Timeout`, and
+    `stuck_rate` leaves queries `Running` until they're stopped with
+    `stop_query` or time out after 60 minutes, as Logs Insights queries do.
+    """
+
+    def __init__(
+        self,
+        clock,
+        records_per_s=1.0,
+        queue_s=1.0,
+        base_latency_s=2.0,
+        scan_rate=500000,
+        transfer_rate=20000,
+        record_bytes=200,
+        log_streams=1,
+        filter_latency_s=0.2,
+        ingestion_lag_s=1.0,
+        s3=None,
+        export_latency_s=30.0,
+        export_object_events=100000,
+        tps=5,
+        max_concurrent=30,
+        throttle_rate=0.0,
+        failure_rate=0.0,
+        timeout_rate=0.0,
+        stuck_rate=0.0,
+        seed=0,
+    ):
+        """Initialize FakeLogsClient."""
+        self.clock = clock
+        self.records_per_s = records_per_s
+        self.queue_s = queue_s
+        self.base_latency_s = base_latency_s
+        self.scan_rate = scan_rate
+        self.transfer_rate = transfer_rate
+        self.record_bytes = record_bytes
+        self.log_streams = log_streams
+        self.filter_latency_s = filter_latency_s
+        self.ingestion_lag_s = ingestion_lag_s
+        self.s3 = s3
+        self.export_latency_s = export_latency_s
+        self.export_object_events = export_object_events
+        self.tps = tps
+        self.max_concurrent = max_concurrent
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.stuck_rate = stuck_rate
+        self._random = random.Random(seed)
+        self._queries: dict[str, _FakeQuery] = {}
+        self._export_tasks: dict[str, dict] = {}
+        self._calls: dict[str, deque] = {}
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self.bytes_scanned = 0
+
+    def _throttle(self, operation):
+        now = self.clock.monotonic()
+        self.calls[operation] += 1
+        calls = self._calls.setdefault(operation, deque())
+        while calls and calls[0] <= now - 1:
+            calls.popleft()
+        if len(calls) >= self.tps or self._random.random() < self.throttle_rate:
+            self.throttled[operation] += 1
+            raise self._error("ThrottlingException", operation)
+        calls.append(now)
+
+    @staticmethod
+    def _error(code, operation):
+        return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def _count(self, start_ts, end_ts):
+        # Records with a timestamp in the inclusive seconds [start_ts, end_ts].
+        d = self.records_per_s
+        return floor((end_ts + 1) * d) - floor(start_ts * d)
+
+    @staticmethod
+    def _format_ts(second, ms=0):
+        ts = datetime.fromtimestamp(second, tz=timezone.utc)
+        return f"{ts:%Y-%m-%d %H:%M:%S}.{ms:03d}"
+
+    def _rows(self, log_group, start_ts, end_ts, limit):
+        rows = []
+        for second in range(start_ts, end_ts + 1):
+            count = self._count(second, second)
+            prefix = self._format_ts(second)[:-3] if count else ""
+            for i in range(count):
+                if len(rows) >= limit:
+                    return rows
+                rows.append(
+                    [
+                        {
+                            "field": "@timestamp",
+                            "value": f"{prefix}{i * 1000 // count:03d}",
+                        },
+                        {"field": "@message", "value": f"{log_group} {second} {i}"},
+                        {"field": "@ptr", "value": f"{log_group}/{second}/{i}"},
+                    ]
+                )
+        return rows
+
+    def _histogram(self, start_ts, end_ts, bin_s):
+        rows = []
+        first = start_ts - start_ts % bin_s
+        for bin_start in range(first, end_ts + 1, bin_s):
+            count = self._count(
+                max(bin_start, start_ts), min(bin_start + bin_s - 1, end_ts)
+            )
+            if count:
+                rows.append(
+                    [
+                        {
+                            "field": f"bin({bin_s}s)",
+                            "value": self._format_ts(bin_start),
+                        },
+                        {"field": "records", "value": str(count)},
+                    ]
+                )
+        return rows
+
+    def _lag(self, start_ts, end_ts):
+        return [
+            [
+                {"field": "lag_ms", "value": str(self.ingestion_lag_s * 1000)},
+                {"field": "events", "value": str(self._count(start_ts, end_ts))},
+            ]
+        ]
+
+    def describe_log_streams(self, logGroupName, nextToken=None, limit=50, **kwargs):
+        """Return a page of the log streams the records are spread across."""
+        self._throttle("describe_log_streams")
+        first = int(nextToken or 0)
+        last = min(first + limit, self.log_streams)
+        response: dict = {
+            "logStreams": [
+                {
+                    "logStreamName": f"stream-{i}",
+                    "firstEventTimestamp": 0,
+                    "lastIngestionTime": int(time.time() * 1000),
+                }
+                for i in range(first, last)
+            ]
+        }
+        if last < self.log_streams:
+            response["nextToken"] = str(last)
+        return response
+
+    def _events(self, log_group, stream_name, start_ms, end_ms, second=None, first=0):
+        # Yield the position of each event of a log stream in a millisecond
+        # range, as `(second, index)`, along with the event.
+        stream = int(stream_name.split("-")[1])
+        if second is None:
+            second = start_ms // 1000
+        while second <= end_ms // 1000:
+            count = self._count(second, second)
+            for i in range(first, count):
+                if i % self.log_streams != stream:
+                    continue
+                ms = second * 1000 + i * 1000 // count
+                if start_ms <= ms <= end_ms:
+                    yield (
+                        second,
+                        i,
+                        {
+                            "logStreamName": stream_name,
+                            "timestamp": ms,
+                            "message": f"{log_group} {second} {i}",
+                            "ingestionTime": ms + int(self.ingestion_lag_s * 1000),
+                            "eventId": f"{log_group}/{second}/{i}",
+                        },
+                    )
+            second, first = second + 1, 0
+
+    def filter_log_events(
+        self,
+        logGroupName,
+        logStreamNames,
+        startTime,
+        endTime,
+        nextToken=None,
+        limit=10000,
+        **kwargs,
+    ):
+        """Return a page of a log stream's events in a millisecond range."""
+        self._throttle("filter_log_events")
+        (stream_name,) = logStreamNames
+        max_events = min(limit, 10000, 2**20 // self.record_bytes)
+        position = map(int, (nextToken or f"{startTime // 1000}:0").split(":"))
+        events: list = []
+        token = None
+        for second, i, event in self._events(
+            logGroupName, stream_name, startTime, endTime, *position
+        ):
+            if len(events) >= max_events:
+                token = f"{second}:{i}"
+                break
+            events.append(event)
+        response: dict = {"events": events}
+        if token:
+            response["nextToken"] = token
+        self.clock.sleep(self.filter_latency_s + len(events) / self.transfer_rate)
+        return response
+
+    def create_export_task(
+        self, logGroupName, fromTime, to, destination, destinationPrefix, **kwargs
+    ):
+        """Schedule an export of a log group's events in a millisecond range."""
+        self._throttle("create_export_task")
+        now = self.clock.monotonic()
+        if any(task["done_at"] > now for task in self._export_tasks.values()):
+            raise self._error("LimitExceededException", "CreateExportTask")
+        task_id = f"export-{len(self._export_tasks)}"
+        records = self._count(fromTime // 1000, to // 1000)
+        self._export_tasks[task_id] = {
+            "done_at": now + self.export_latency_s + records / self.scan_rate,
+            "request": (logGroupName, fromTime, to, destination, destinationPrefix),
+            "written": False,
+        }
+        return {"taskId": task_id}
+
+    def _write_export(self, task_id, log_group, start_ms, end_ms, bucket, prefix):
+        prefix = f"{prefix}/" if prefix else ""
+        self.s3.put_object(Bucket=bucket, Key=f"{prefix}aws-logs-write-test", Body=b"")
+        for stream in range(self.log_streams):
+            stream_name = f"stream-{stream}"
+            lines: list = []
+            for *_, event in self._events(log_group, stream_name, start_ms, end_ms):
+                ts = datetime.fromtimestamp(event["timestamp"] / 1000, tz=timezone.utc)
+                lines.append(
+                    f"{ts:%Y-%m-%dT%H:%M:%S.%f}"[:-3] + f"Z {event['message']}"
+                )
+            for n, first in enumerate(range(0, len(lines), self.export_object_events)):
+                body = "\n".join(lines[first : first + self.export_object_events])
+                self.s3.put_object(
+                    Bucket=bucket,
+                    Key=f"{prefix}{task_id}/{stream_name}/{n:06d}.gz",
+                    Body=gzip.compress(f"{body}\n".encode()),
+                )
+
+    def describe_export_tasks(self, taskId, **kwargs):
+        """Return an export task, writing its objects once it's done."""
+        self._throttle("describe_export_tasks")
+        task = self._export_tasks[taskId]
+        if task["done_at"] > self.clock.monotonic():
+            status = "RUNNING"
+        else:
+            status = "COMPLETED"
+            if not task["written"]:
+                log_group, start_ms, end_ms, bucket, prefix = task["request"]
+                self._write_export(taskId, log_group, start_ms, end_ms, bucket, prefix)
+                task["written"] = True
+        return {"exportTasks": [{"taskId": taskId, "status": {"code": status}}]}
+
+    def start_query(
+        self, logGroupName, startTime, endTime, queryString, limit=1000, **kwargs
+    ):
+        """Schedule a query, rejecting it when throttled or over concurrency."""
+        self._throttle("start_query")
+        now = self.clock.monotonic()
+        running = sum(
+            1
+            for q in self._queries.values()
+            if q.status(now) in ("Scheduled", "Running")
+        )
+        if running >= self.max_concurrent:
+            raise self._error("LimitExceededException", "start_query")
+
+        matched = self._count(startTime, endTime)
+        roll = self._random.random()
+        if roll < self.failure_rate:
+            outcome = "Failed"
+        elif roll < self.failure_rate + self.timeout_rate:
+            outcome = "Timeout"
+        else:
+            outcome = "Complete"
+        run_s = self.base_latency_s + matched / self.scan_rate
+        if roll >= 1 - self.stuck_rate:
+            run_s = QUERY_TIMEOUT_S
+            outcome = "Timeout"
+        bytes_scanned = matched * self.record_bytes
+        self.bytes_scanned += bytes_scanned
+        query_id = f"query-{len(self._queries)}"
+        self._queries[query_id] = _FakeQuery(
+            now,
+            self.queue_s,
+            run_s,
+            outcome,
+            (logGroupName, startTime, endTime, queryString, min(limit, LIMIT)),
+        )
+        return {"queryId": query_id}
+
+    def stop_query(self, queryId, **kwargs):
+        """Cancel a query that is still scheduled or running."""
+        self._throttle("stop_query")
+        query = self._queries[queryId]
+        now = self.clock.monotonic()
+        if query.status(now) not in ("Scheduled", "Running"):
+            raise self._error("InvalidParameterException", "stop_query")
+        query.outcome = "Cancelled"
+        query.running_at = min(query.running_at, now)
+        query.done_at = now
+        return {"success": True}
+
+    def get_query_results(self, queryId, **kwargs):
+        """Return the query status, with its results once it's complete."""
+        self._throttle("get_query_results")
+        query = self._queries[queryId]
+        status = query.status(self.clock.monotonic())
+        if status != "Complete":
+            return {
+                "status": status,
+                "results": [],
+                "ResponseMetadata": {"HTTPStatusCode": 200},
+            }
+        log_group, start_ts, end_ts, query_string, limit = query.request
+        histogram = re.search(r"bin\((\d+)s\)", query_string)
+        if histogram:
+            results = self._histogram(start_ts, end_ts, int(histogram.group(1)))
+        elif " as lag " in query_string:
+            results = self._lag(start_ts, end_ts)
+        else:
+            results = self._rows(log_group, start_ts, end_ts, limit)
+        # Downloading the results, which releases the GIL like real I/O.
+        self.clock.sleep(len(results) / self.transfer_rate)
+        matched = float(self._count(start_ts, end_ts))
+        return {
+            "status": status,
+            "results": results,
+            "statistics": {
+                "recordsMatched": matched,
+                "recordsScanned": matched,
+                "bytesScanned": matched * self.record_bytes,
+            },
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+        }
@@ -0,0 +1,378 @@
+"""Asyncio engine running the queries of CloudwatchAPI jobs concurrently."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tap_cloudwatch.subquery import Subquery
+
+
+class _JobChannel:
+    """Items of one job handed from the engine thread to its reader."""
+
+    def __init__(self, queue_size):
+        self.items: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.started = False
+        self.windows_queued: asyncio.Event | None = None
+
+
+class AsyncQueryEngine:
+    """Run the windows of queued CloudwatchAPI jobs as asyncio tasks.
+
+    The event loop runs in a background thread, so submitting, polling and
+    fetching results carry on while the reader transforms records. The
+    blocking client calls are run in a thread pool. Each job's pages reach
+    its reader in window order through a bounded queue, together with the
+    job's checkpoints.
+
+    Jobs share the API's concurrent query slots and buffered row cap. The
+    windows of a job are only queued once every window of the job before it
+    has been, so the job being read comes first.
+    """
+
+    def __init__(self, api, queue_size=4):
+        """Initialize AsyncQueryEngine."""
+        self.api = api
+        self.queue_size = queue_size
+        self._channels: dict = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        # Set when a thread is started and cleared, together with `_loop`,
+        # once it has decided to stop, so a job added while the thread winds
+        # down starts a new one.
+        self._running = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._main_task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: set = set()
+        self._error: BaseException | None = None
+        self._closed = False
+
+    def add_job(self, job_key):
+        """Register a job added to the API so its windows are run."""
+        with self._lock:
+            self._channels[job_key] = _JobChannel(self.queue_size)
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def run_query_job(self, job_key):
+        """Yield the pages of a job, running its checkpoints as they're reached."""
+        if self._closed:
+            raise Exception("The query engine was closed before the job was read.")
+        channel = self._channels[job_key]
+        job = self.api._jobs[job_key]
+        self._start()
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, value = channel.items.get(timeout=0.1)
+                except queue.Empty:
+                    if self._error is not None:
+                        raise self._error from None
+                    continue
+                if kind == "page":
+                    yield value
+                elif kind == "checkpoint":
+                    if job.on_checkpoint:
+                        job.on_checkpoint(**value)
+                else:
+                    finished = True
+                    return
+        finally:
+            with self._lock:
+                del self._channels[job_key]
+            if not finished:
+                self.close()
+            # Pages queued for the reader are released once the engine stopped.
+            self.api._drop_job(job_key)
+
+    def close(self):
+        """Cancel every query task and wait for the engine thread to stop."""
+        with self._lock:
+            self._closed = True
+            if self._loop is not None and self._main_task is not None:
+                self._loop.call_soon_threadsafe(self._main_task.cancel)
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._error = None
+            self._thread = threading.Thread(
+                target=asyncio.run, args=(self._main(),), daemon=True
+            )
+            self._thread.start()
+
+    async def _main(self):
+        self._slots = asyncio.Semaphore(self.api.max_concurrent_queries)
+        self._buffer = asyncio.Condition()
+        self._buffered_rows = 0
+        # A thread started after this one stops replaces the executor.
+        executor = self._executor = ThreadPoolExecutor(
+            max_workers=self.api.max_concurrent_queries
+        )
+        jobs: set = set()
+        previous = None
+        with self._lock:
+            self._wakeup = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+            self._main_task = asyncio.current_task()
+        try:
+            while True:
+                with self._lock:
+                    new = [
+                        (key, channel)
+                        for key, channel in self._channels.items()
+                        if not channel.started
+                    ]
+                    if not new and not jobs:
+                        self._loop = None
+                        self._running = False
+                        return
+                for job_key, channel in new:
+                    channel.started = True
+                    channel.windows_queued = asyncio.Event()
+                    jobs.add(
+                        self._spawn(
+                            self._run_job(self.api._jobs[job_key], channel, previous)
+                        )
+                    )
+                    previous = channel.windows_queued
+                # Wait for a job to finish or for a new one to be added.
+                self._wakeup.clear()
+                wakeup = asyncio.ensure_future(self._wakeup.wait())
+                done, _ = await asyncio.wait(
+                    jobs | {wakeup}, return_when=asyncio.FIRST_COMPLETED
+                )
+                wakeup.cancel()
+                for task in done - {wakeup}:
+                    jobs.discard(task)
+                    task.result()
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self._error = e
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            with self._lock:
+                self._loop = None
+                self._running = False
+        finally:
+            executor.shutdown(wait=False)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        # Window tasks aren't awaited, so their errors stop the engine here.
+        self._tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        if self._error is None:
+            self._error = task.exception()
+            self._main_task.cancel()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _run_job(self, job, channel, previous):
+        windows: asyncio.Queue = asyncio.Queue()
+        producer = self._spawn(self._queue_windows(job, channel, windows, previous))
+        await self._emit(job, channel, windows)
+        # A job is only done if every window was queued without an error.
+        await producer
+        await self._put(channel, ("done", None))
+
+    async def _queue_windows(self, job, channel, windows, previous):
+        if previous is not None:
+            await previous.wait()
+        try:
+            while True:
+                async with self._buffer:
+                    await self._buffer.wait_for(
+                        lambda: self._buffered_rows < self.api.max_buffered_rows
+                    )
+                # The slot is taken before the next window is planned, so an
+                # adaptive planner sizes it from every window finished so far.
+                await self._slots.acquire()
+                try:
+                    window = await self._run(next, job.batch_windows, None)
+                except BaseException:
+                    self._slots.release()
+                    raise
+                if window is None:
+                    self._slots.release()
+                    return
+                window_channel: asyncio.Queue = asyncio.Queue(maxsize=1)
+                pages = await self._run(self.api._cached_pages, job, *window)
+                if pages is not None:
+                    self._slots.release()
+                    windows.put_nowait((window_channel, None))
+                    self._spawn(self._replay(job, pages, window[1], window_channel))
+                    continue
+                # Windows read from the API are cached as they're emitted.
+                windows.put_nowait((window_channel, window))
+                self._spawn(self._run_window(job, *window, window_channel, True))
+        finally:
+            windows.put_nowait(None)
+            channel.windows_queued.set()
+
+    async def _emit(self, job, channel, windows):
+        while True:
+            item = await windows.get()
+            if item is None:
+                break
+            window_channel, window = item
+            writer = None
+            if window is not None:
+                writer = await self._run(self.api._cache_writer, job, *window)
+            try:
+                while True:
+                    item = await window_channel.get()
+                    if item is None:
+                        break
+                    held, checkpoint = item
+                    results = held.rows()
+                    if writer:
+                        await self._run(writer.add_page, results)
+                    await self._put(channel, ("page", results))
+                    if checkpoint:
+                        await self._put(channel, ("checkpoint", checkpoint))
+                    async with self._buffer:
+                        self._buffered_rows -= len(results)
+                        self._buffer.notify_all()
+                if writer:
+                    await self._run(writer.commit)
+                    writer = None
+            finally:
+                if writer:
+                    writer.abort()
+
+    async def _put(self, channel, item):
+        # The reader is in another thread, so the bounded queue is polled.
+        while True:
+            try:
+                channel.items.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.005)
+
+    async def _execute(self, func, slot_held=False):
+        if not slot_held:
+            await self._slots.acquire()
+        try:
+            await self._run(func)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _wait(self, query_obj):
+        try:
+            while True:
+                delay = query_obj.next_poll_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if await self._run(query_obj.poll):
+                    return
+        finally:
+            self._slots.release()
+
+    async def _run_window(self, job, start_ts, end_ts, window_channel, top_level):
+        # Pages are handed over with the checkpoint reached once they're read.
+        # Nothing waits on a full channel while holding a query slot, so
+        # windows waiting their turn can't starve the one being read.
+        query_obj = Subquery(
+            job.client,
+            start_ts,
+            end_ts,
+            job.log_group,
+            job.query,
+            poll_timer=self.api.poll_timer,
+        )
+        await self._execute(query_obj.execute, slot_held=top_level)
+        await self._wait(query_obj)
+        if query_obj.can_split() or (
+            self.api.split_oversized_windows and query_obj.is_oversized()
+        ):
+            await self._split_window(job, query_obj, window_channel, top_level)
+            return
+        observe = top_level and job.window_planner
+        while True:
+            response, exceeded = await self._run(query_obj.take_page)
+            if observe:
+                job.window_planner.observe(*query_obj.window, query_obj.records_matched)
+                observe = False
+            results = response["results"]
+            self._buffered_rows += len(results)
+            if not exceeded:
+                break
+            checkpoint = {"continuation_ts": query_obj._record_ts(results[-1])}
+            await window_channel.put(
+                (self.api.row_buffer.hold(results, job), checkpoint)
+            )
+            # Runs while the page is read, as in Subquery.iter_results.
+            await self._execute(
+                functools.partial(query_obj._handle_limit_exceeded, response)
+            )
+            await self._wait(query_obj)
+        self.api._log_query_stats(query_obj, job.metric_tags)
+        await window_channel.put(
+            (self.api.row_buffer.hold(results, job), {"window_end": end_ts})
+        )
+        await window_channel.put(None)
+
+    async def _replay(self, job, pages, end_ts, window_channel):
+        # The last page is held back to carry the window's checkpoint.
+        previous = None
+        while True:
+            page = await self._run(next, pages, None)
+            if page is None:
+                break
+            if previous is not None:
+                await window_channel.put((previous, None))
+            self._buffered_rows += len(page)
+            previous = self.api.row_buffer.hold(page, job)
+        if previous is None:
+            previous = self.api.row_buffer.hold([], job)
+        await window_channel.put((previous, {"window_end": end_ts}))
+        await window_channel.put(None)
+
+    async def _split_window(self, job, query_obj, window_channel, top_level):
+        results, windows = await self._run(query_obj.split, self.api.target_fill)
+        if top_level and job.window_planner:
+            job.window_planner.observe(*query_obj.window, query_obj.records_matched)
+        self.api._log_query_stats(query_obj, job.metric_tags)
+        self._buffered_rows += len(results)
+        children = []
+        for start_ts, end_ts in windows:
+            child: asyncio.Queue = asyncio.Queue(maxsize=1)
+            children.append(child)
+            self._spawn(self._run_window(job, start_ts, end_ts, child, False))
+        await window_channel.put(
+            (
+                self.api.row_buffer.hold(results, job),
+                {"window_end": windows[0][0] - 1},
+            )
+        )
+        # Sub-windows run concurrently and are handed over in order.
+        for child in children:
+            while True:
+                item = await child.get()
+                if item is None:
+                    break
+                await window_channel.put(item)
+        await window_channel.put(None)
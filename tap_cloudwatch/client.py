@@ -2,15 +2,42 @@
 
 from __future__ import annotations
 
+import signal
+import threading
+import time
 import typing as t
+from datetime import datetime, timezone
 
+from singer_sdk.batch import Batcher
 from singer_sdk.streams import Stream
 
 from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.dedup import PtrDedupCache
+from tap_cloudwatch.exception import InvalidConfigException
+from tap_cloudwatch.metrics import Metric, log_counter
+from tap_cloudwatch.query_parser import project_query
+from tap_cloudwatch.records import iter_records
+from tap_cloudwatch.window_planner import AdaptiveWindowPlanner
 
 if t.TYPE_CHECKING:
+    from singer_sdk.helpers._batch import BaseBatchFileEncoding, BatchConfig
     from singer_sdk.helpers.types import Context
 
+    from tap_cloudwatch.tap import TapCloudWatch
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _exit_on_sigterm():
+    # SIGTERM ends the process right away by default. Raising SystemExit
+    # instead unwinds the sync, which stops the queries still running.
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+
 
 class CloudWatchStream(Stream):
     """Stream class for CloudWatch streams."""
@@ -44,7 +71,8 @@ class CloudWatchStream(Stream):
         # The stream is sorted but when the limit is exceeded we recursively
         # request sub-batches to get ever smaller batches until all data has been
         # replicated. As part of that we use >= logic so some duplicates are
-        # created on the edges of the date range window. The requests are at seconds
+        # created on the edges of the date range window. They are dropped by
+        # `get_records` using the record `ptr`. The requests are at seconds
         # grain but the log timestamps are at the millisecond grain, which causes this
         # to throw an exception if the max is like `2023-02-20 06:01:57.792` because the
         # sub-batch filter is `2023-02-20 06:01:57` and we get some records that are
@@ -52,6 +80,241 @@ class CloudWatchStream(Stream):
         # `2023-02-20 06:01:57.009`. For that reason it is disabled.
         return False
 
+    def __init__(self, *args, query_config: dict | None = None, **kwargs):
+        """Initialize CloudWatchStream.
+
+        The `query_config` overrides the tap config for a stream of the
+        `queries` setting.
+        """
+        # Set first, the SDK reads the config while initializing the stream.
+        self._query_config = query_config or {}
+        super().__init__(*args, **kwargs)
+        self._query: str | None = None
+        self._batching = False
+        self._window_completed = False
+        self._cloudwatch_api: CloudwatchAPI | None = None
+        self._pending_jobs: dict = {}
+
+    @property
+    def stream_config(self) -> dict:
+        """The tap config with this stream's query settings applied."""
+        config = {**self.config, **self._query_config}
+        if "log_group_name" in self._query_config:
+            config.pop("log_group_names", None)
+        return config
+
+    @property
+    def query(self) -> str:
+        """The stream's query, requesting only the properties selected."""
+        if self._query is None:
+            query = self.stream_config["query"]
+            self._query = project_query(
+                query, lambda name: self.mask.get(("properties", name), True)
+            )
+            if self._query != query:
+                self.logger.info(f"Querying the selected fields only: `{self._query}`.")
+        return self._query
+
+    @property
+    def partitions(self) -> list[Context] | None:
+        """Return a partition per log group and region when several are set."""
+        log_groups = self.stream_config.get("log_group_names")
+        regions = self.config.get("aws_region_names")
+        if not log_groups and not regions:
+            return None
+        # A single `log_group_name` is only partitioned by region.
+        groups = [{"log_group_name": name} for name in log_groups or []] or [{}]
+        return [
+            {**group, "aws_region_name": region} if region else group
+            for region in regions or [None]
+            for group in groups
+        ]
+
+    def _job_key(self, context: Context | None) -> tuple:
+        return (self.name, *sorted((context or {}).items()))
+
+    @staticmethod
+    def _parse_utc(value: str) -> datetime:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            return parsed.replace(tzinfo=timezone.utc)
+        return parsed
+
+    def compare_start_date(self, value: str, start_date_value: str) -> str:
+        """Return the later of the bookmark and start date.
+
+        Bookmarks are UTC timestamps while `start_date` may be naive, which
+        the default comparison can't handle.
+        """
+        return max(value, start_date_value, key=self._parse_utc)
+
+    def _get_end_time(self) -> datetime | None:
+        end_date = self.config.get("end_date")
+        if not end_date:
+            return None
+        return self._parse_utc(end_date)
+
+    def _get_bookmark(self, context: Context | None, state: dict) -> datetime | None:
+        bookmark = self.get_starting_timestamp(context)
+        checkpoint = state.get("window_checkpoint")
+        if not checkpoint:
+            return bookmark
+        # Windows read in full are skipped even when they held no records, and
+        # a window interrupted during a continuation restarts from it.
+        resume_ts = max(
+            checkpoint.get("window_end", -1) + 1,
+            checkpoint.get("continuation_ts", -1),
+        )
+        if bookmark and resume_ts <= bookmark.timestamp():
+            return bookmark
+        self.logger.info(
+            f"Resuming from the window checkpoint at "
+            f"`{datetime.utcfromtimestamp(resume_ts).isoformat()} UTC`."
+        )
+        return datetime.fromtimestamp(resume_ts, tz=timezone.utc)
+
+    def _overlap_bookmark(
+        self, state: dict, bookmark: datetime | None
+    ) -> datetime | None:
+        # Events can be ingested after the window they belong to was read, so
+        # the end of the last window is read again. Records already emitted
+        # are dropped by their `ptr`.
+        window_end = state.get("window_checkpoint", {}).get("window_end")
+        if bookmark is None or window_end is None:
+            return bookmark
+        overlap_start = window_end + 1 - self.config.get("follow_overlap_s", 60)
+        return min(bookmark, datetime.fromtimestamp(overlap_start, tz=timezone.utc))
+
+    def _checkpoint_writer(self, state: dict) -> t.Callable:
+        def on_checkpoint(window_end=None, continuation_ts=None):
+            checkpoint = state.setdefault("window_checkpoint", {})
+            if window_end is not None:
+                checkpoint["window_end"] = window_end
+                checkpoint.pop("continuation_ts", None)
+            if continuation_ts is not None:
+                checkpoint["continuation_ts"] = continuation_ts
+            if self._batching:
+                # The SDK writes the state once the window's batch is announced.
+                self._window_completed = window_end is not None
+                return
+            # Written right away so a preempted run resumes from here.
+            self._write_state_message()
+
+        return on_checkpoint
+
+    def _shard_bounds(
+        self,
+        api: CloudwatchAPI,
+        state: dict,
+        bookmark: datetime | None,
+        end_time: datetime | None,
+    ) -> tuple:
+        index = self.config.get("shard_index", 0)
+        count = self.config["shard_count"]
+        if end_time is None:
+            raise InvalidConfigException(
+                "`end_date` must be set when sharding so every shard plans the "
+                "same windows"
+            )
+        if not 0 <= index < count:
+            raise InvalidConfigException("`shard_index` must be below `shard_count`")
+        start_time = self._parse_utc(self.config["start_date"])
+        shard = api.shard_range(
+            start_time,
+            end_time,
+            self.stream_config.get("batch_increment_s"),
+            index,
+            count,
+        )
+        # Recorded so the shard states can be merged once the backfill is done.
+        state["shard"] = {"index": index, "count": count}
+        state["shard"]["start_ts"], state["shard"]["end_ts"] = shard or (None, None)
+        if shard is None:
+            self.logger.info(f"Shard {index} of {count} has no windows to sync.")
+            return start_time, start_time
+        start_ts, end_ts = shard
+        shard_start = datetime.fromtimestamp(start_ts, tz=timezone.utc)
+        shard_end = datetime.fromtimestamp(end_ts, tz=timezone.utc)
+        self.logger.info(
+            f"Syncing shard {index} of {count} from "
+            f"`{shard_start.isoformat()}` to `{shard_end.isoformat()}`."
+        )
+        return max(bookmark or shard_start, shard_start), shard_end
+
+    def _queue_partition(self, api: CloudwatchAPI, context: Context | None) -> tuple:
+        context = context or {}
+        if self.config.get("follow") and (
+            self.partitions or len(self.config.get("queries") or []) > 1
+        ):
+            # Following never returns, so no other stream would be synced.
+            raise InvalidConfigException(
+                "`follow` reads a single log group in one region with one query, "
+                "it can't be used with `log_group_names`, `aws_region_names` or "
+                "more than one of `queries`"
+            )
+        log_group = context.get("log_group_name") or self.stream_config.get(
+            "log_group_name"
+        )
+        if not log_group:
+            raise InvalidConfigException(
+                "Either `log_group_name` or `log_group_names` must be set"
+            )
+        state = self.get_context_state(context or None)
+        window_planner = None
+        if self.config.get("adaptive_batch_window"):
+            window_planner = AdaptiveWindowPlanner(
+                self.stream_config.get("batch_increment_s"),
+                target_fill=self.config.get("adaptive_target_fill"),
+                density=state.get("log_group_density", {}).get(log_group),
+            )
+        # The SDK writes this right before syncing a partition, it's needed
+        # earlier to read the bookmark of partitions queued ahead of time.
+        self._write_starting_replication_value(context or None)
+        job_key = self._job_key(context)
+        bookmark = self._get_bookmark(context or None, state)
+        if self.config.get("follow"):
+            bookmark = self._overlap_bookmark(state, bookmark)
+        end_time = self._get_end_time()
+        if self.config.get("shard_count", 1) > 1:
+            bookmark, end_time = self._shard_bounds(api, state, bookmark, end_time)
+        api.add_query_job(
+            job_key,
+            bookmark,
+            log_group,
+            self.query,
+            self.stream_config.get("batch_increment_s"),
+            end_time,
+            window_planner,
+            context.get("aws_region_name"),
+            {"stream": self.name, "context": context},
+            self._checkpoint_writer(state),
+        )
+        self._pending_jobs[job_key] = (log_group, window_planner)
+        return job_key
+
+    def _get_cloudwatch_api(self) -> CloudwatchAPI:
+        if self._cloudwatch_api is None:
+            tap = t.cast("TapCloudWatch", self._tap)
+            if tap.cloudwatch_api is None:
+                api = CloudwatchAPI(self.logger, self.config, self.metrics_logger)
+                api.authenticate(self.config, tap.client_factory)
+                tap.cloudwatch_api = api
+                _exit_on_sigterm()
+                # Every partition of every stream is queued up front so the
+                # query slots the current one can't fill are used by the
+                # partitions and streams synced after it.
+                for stream in tap.streams.values():
+                    if isinstance(stream, CloudWatchStream) and stream.selected:
+                        stream._queue_partitions(api)
+            if self._cloudwatch_api is None:
+                self._queue_partitions(tap.cloudwatch_api)
+        return t.cast(CloudwatchAPI, self._cloudwatch_api)
+
+    def _queue_partitions(self, api: CloudwatchAPI) -> None:
+        for partition in self.partitions or [{}]:
+            self._queue_partition(api, partition)
+        self._cloudwatch_api = api
+
     def get_records(self, context: Context | None) -> t.Iterable[dict]:
         """Return a generator of record-type dictionary objects.
 
@@ -59,18 +322,96 @@ class CloudWatchStream(Stream):
         stream if partitioning is required for the stream. Most implementations do not
         require partitioning and should ignore the `context` argument.
         """
-        # TODO: move to iterate batches
-        # TODO: log stats metrics returned by cloudwatch
-        # self.metrics_logger.info('test')
-        client = CloudwatchAPI(self.logger)
-        client.authenticate(self.config)
-        cloudwatch_iter = client.get_records_iterator(
-            self.get_starting_timestamp(context),
-            self.config.get("log_group_name"),
-            self.config.get("query"),
-            self.config.get("batch_increment_s"),
-            self.config.get("end_date"),
+        api = self._get_cloudwatch_api()
+        job_key = self._job_key(context)
+        if job_key not in self._pending_jobs:
+            self._queue_partition(api, context)
+        state = self.get_context_state(context)
+        # Drops the duplicates created on the edges of windows and sub-batches.
+        # Following re-queries the overlap, so its records are kept as well.
+        follow = self.config.get("follow", False)
+        dedup = PtrDedupCache(self.config.get("follow_overlap_s", 60) if follow else 0)
+        yield from self._read_job(api, job_key, state, dedup)
+        if follow:
+            yield from self._follow(api, context, state, dedup)
+        log_counter(
+            self.metrics_logger,
+            Metric.DEDUP_HIT_COUNT,
+            dedup.hits,
+            {"stream": self.name, "context": context},
+        )
+
+    def get_batches(
+        self, batch_config: BatchConfig, context: Context | None = None
+    ) -> t.Iterable[tuple[BaseBatchFileEncoding, list[str]]]:
+        """Write the records of each query window to their own batch files.
+
+        Windows holding more than `batch_size` records are split into several
+        files.
+        """
+        batcher = Batcher(
+            tap_name=self.tap_name, stream_name=self.name, batch_config=batch_config
         )
-        for batch in cloudwatch_iter:
-            for record in batch:
-                yield {i["field"][1:]: i["value"] for i in record}
+        records = self._sync_records(context, write_messages=False)
+        self._batching = True
+        try:
+            next_record = next(records, None)
+            while next_record is not None:
+                following: list[dict] = []
+                window = self._window_records(next_record, records, following)
+                for manifest in batcher.get_batches(records=window):
+                    yield batch_config.encoding, manifest
+                next_record = following[0] if following else None
+        finally:
+            self._batching = False
+
+    def _window_records(
+        self, first: dict, records: t.Iterator[dict], following: list
+    ) -> t.Iterator[dict]:
+        # The checkpoint of a window is written while reading the first
+        # record after it, which is held back for the next window.
+        self._window_completed = False
+        yield first
+        for record in records:
+            if self._window_completed:
+                following.append(record)
+                return
+            yield record
+
+    def _read_job(
+        self, api: CloudwatchAPI, job_key: tuple, state: dict, dedup: PtrDedupCache
+    ) -> t.Iterable[dict]:
+        log_group, window_planner = self._pending_jobs.pop(job_key)
+        for batch in api.run_query_job(job_key):
+            if window_planner and window_planner.density is not None:
+                # Persist records per second so the next run starts well sized.
+                state.setdefault("log_group_density", {})[log_group] = (
+                    window_planner.density
+                )
+            for record in iter_records(batch):
+                if dedup.is_duplicate(record.get("timestamp"), record.get("ptr")):
+                    continue
+                yield record
+
+    def _follow(
+        self,
+        api: CloudwatchAPI,
+        context: Context | None,
+        state: dict,
+        dedup: PtrDedupCache,
+    ) -> t.Iterable[dict]:
+        poll_s = self.config.get("follow_poll_s", 5)
+        duration_s = self.config.get("follow_duration_s")
+        deadline = None if duration_s is None else time.monotonic() + duration_s
+        self.logger.info(f"Following `{self.name}` every {poll_s}s...")
+        while deadline is None or time.monotonic() < deadline:
+            started = time.monotonic()
+            job_key = self._queue_partition(api, context)
+            yield from self._read_job(api, job_key, state, dedup)
+            time.sleep(max(0, poll_s - (time.monotonic() - started)))
+
+    def log_sync_costs(self) -> None:
+        """Log the totals of the queries run once the sync has finished."""
+        super().log_sync_costs()
+        if self._cloudwatch_api is not None:
+            self._cloudwatch_api.log_summary({"stream": self.name}, stream=self.name)
@@ -0,0 +1,181 @@
+"""Create the AWS clients shared by every stream and partition of a sync."""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+from botocore.retries import quota, standard
+from botocore.retries.base import BaseRetryableChecker
+from botocore.session import get_session
+
+
+class _TransientRetryConditions(BaseRetryableChecker):
+    """Botocore's standard retry conditions without the throttling errors.
+
+    Throttled calls are retried by `RateLimitedClient` within the shared rate
+    limits, so botocore only retries connection errors and 5xx responses.
+    """
+
+    def __init__(self, max_attempts):
+        self._max_attempts_checker = standard.MaxAttemptsChecker(max_attempts)
+        self._transient_checker = standard.TransientRetryableChecker()
+
+    def is_retryable(self, context):
+        return self._max_attempts_checker.is_retryable(
+            context
+        ) and self._transient_checker.is_retryable(context)
+
+
+def _retry_transient_errors(client, max_attempts):
+    # Replaces the handler botocore registers for the standard retry mode.
+    service_event_name = client.meta.service_model.service_id.hyphenize()
+    retry_quota = standard.RetryQuotaChecker(quota.RetryQuota())
+    client.meta.events.register(
+        f"after-call.{service_event_name}", retry_quota.release_retry_quota
+    )
+    handler = standard.RetryHandler(
+        retry_policy=standard.RetryPolicy(
+            retry_checker=_TransientRetryConditions(max_attempts),
+            retry_backoff=standard.ExponentialBackoff(),
+        ),
+        retry_event_adapter=standard.RetryEventAdapter(),
+        retry_quota=retry_quota,
+    )
+    unique_id = f"retry-config-{service_event_name}"
+    client.meta.events.unregister(
+        f"needs-retry.{service_event_name}", unique_id=unique_id
+    )
+    client.meta.events.register(
+        f"needs-retry.{service_event_name}", handler.needs_retry, unique_id=unique_id
+    )
+
+
+class ClientFactory:
+    """Create AWS clients from the tap config, reusing them for the whole sync.
+
+    Clients are cached by service, region and endpoint, so every stream and
+    partition shares their connection pools. With `aws_role_arn` set the role
+    is assumed with the configured credentials, and the role credentials are
+    refreshed before they expire so long syncs don't fail halfway.
+    """
+
+    def __init__(self, config):
+        """Initialize ClientFactory."""
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self._session: boto3.session.Session | None = None
+        self._clients: dict[tuple, object] = {}
+        # Sessions aren't thread safe, the clients they create are.
+        self._lock = threading.Lock()
+
+    def _base_session(self):
+        config = self.config
+        aws_access_key_id = config.get("aws_access_key_id") or os.environ.get(
+            "AWS_ACCESS_KEY_ID"
+        )
+        aws_secret_access_key = config.get("aws_secret_access_key") or os.environ.get(
+            "AWS_SECRET_ACCESS_KEY"
+        )
+        aws_session_token = config.get("aws_session_token") or os.environ.get(
+            "AWS_SESSION_TOKEN"
+        )
+        aws_profile = config.get("aws_profile") or os.environ.get("AWS_PROFILE")
+        aws_region_name = config.get("aws_region_name")
+
+        # AWS credentials based authentication
+        if aws_access_key_id and aws_secret_access_key:
+            return boto3.session.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                aws_session_token=aws_session_token,
+                region_name=aws_region_name,
+            )
+        # AWS Profile based authentication
+        return boto3.session.Session(
+            profile_name=aws_profile, region_name=aws_region_name
+        )
+
+    def _assume_role(self, sts):
+        role_arn = self.config["aws_role_arn"]
+        kwargs = {}
+        if self.config.get("aws_role_external_id"):
+            kwargs["ExternalId"] = self.config["aws_role_external_id"]
+        self.logger.info(f"Assuming role {role_arn}.")
+        credentials = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=self.config.get("aws_role_session_name", "tap-cloudwatch"),
+            DurationSeconds=self.config.get("aws_role_duration_s", 3600),
+            **kwargs,
+        )["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    def _role_session(self, base_session):
+        sts = base_session.client("sts", config=self.client_config())
+
+        def refresh():
+            return self._assume_role(sts)
+
+        # botocore refreshes the credentials before they expire, including
+        # while other threads are using clients created from them.
+        credentials = RefreshableCredentials.create_from_metadata(
+            metadata=refresh(), refresh_using=refresh, method="sts-assume-role"
+        )
+        botocore_session = get_session()
+        botocore_session._credentials = credentials
+        return boto3.session.Session(
+            botocore_session=botocore_session,
+            region_name=base_session.region_name,
+        )
+
+    @property
+    def session(self):
+        """The session every client is created from."""
+        if self._session is None:
+            session = self._base_session()
+            if self.config.get("aws_role_arn"):
+                session = self._role_session(session)
+            self._session = session
+        return self._session
+
+    def client_config(self, max_pool_connections=10):
+        """Return the connection pool, retry and timeout settings for a client."""
+        return Config(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=self.config.get("aws_connect_timeout_s", 10),
+            read_timeout=self.config.get("aws_read_timeout_s", 60),
+            tcp_keepalive=True,
+            retries={
+                "mode": "standard",
+                "total_max_attempts": self.config.get("aws_max_attempts", 5),
+            },
+        )
+
+    def client(self, service, region=None, endpoint_url=None, max_pool_connections=10):
+        """Return the client for a service and region, creating it once.
+
+        The connection pool is sized by the first caller, which should pass
+        the most requests it can make at once.
+        """
+        key = (service, region, endpoint_url)
+        with self._lock:
+            if key not in self._clients:
+                config = self.client_config(max_pool_connections)
+                client = self.session.client(
+                    service,
+                    region_name=region,
+                    endpoint_url=endpoint_url,
+                    config=config,
+                )
+                _retry_transient_errors(client, config.retries["total_max_attempts"])
+                self._clients[key] = client
+            return self._clients[key]
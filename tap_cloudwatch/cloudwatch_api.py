@@ -2,25 +2,173 @@
 
 from __future__ import annotations
 
-import os
-from collections import deque
+import time
+from collections import Counter, deque
 from datetime import datetime, timedelta, timezone
 from math import ceil
 
-import boto3
+from singer_sdk import metrics
 
+from tap_cloudwatch.async_engine import AsyncQueryEngine
+from tap_cloudwatch.client_factory import ClientFactory
 from tap_cloudwatch.exception import InvalidQueryException
-from tap_cloudwatch.subquery import Subquery
+from tap_cloudwatch.export import EXPORT_FIELDS, ExportReader
+from tap_cloudwatch.filter_events import FilterEventsReader, parse_simple_query
+from tap_cloudwatch.metrics import Metric, QueryStats, log_counter, log_timer
+from tap_cloudwatch.query_parser import command_name, parse_fields, split_commands
+from tap_cloudwatch.result_cache import ResultCache
+from tap_cloudwatch.row_buffer import RowBuffer
+from tap_cloudwatch.subquery import HistogramSubquery, LagSubquery, Subquery
+from tap_cloudwatch.throttling import PollTimer, RateLimitedClient, TokenBucket
+from tap_cloudwatch.window_planner import HistogramWindowPlanner
+
+
+class _QueryJob:
+    """The windows of one log group query, emitted in order."""
+
+    def __init__(
+        self,
+        index,
+        client,
+        batch_windows,
+        log_group,
+        query,
+        window_planner,
+        metric_tags=None,
+        on_checkpoint=None,
+        region=None,
+        reader=None,
+        export=None,
+    ):
+        self.index = index
+        self.client = client
+        self.batch_windows = iter(batch_windows)
+        self.log_group = log_group
+        self.query = query
+        self.window_planner = window_planner
+        self.metric_tags = {"log_group": log_group, **(metric_tags or {})}
+        self.on_checkpoint = on_checkpoint
+        self.region = region
+        # Reads the windows with FilterLogEvents instead of Logs Insights.
+        self.reader = reader
+        # The ExportReader, first and last second of a range exported before
+        # the windows are queried.
+        self.export = export
+        # Windows are keyed by tuples so the sub-windows of a split window sort
+        # between it and the next window. They are only emitted in this order,
+        # once every earlier window has been, so records stay in timestamp order.
+        self.order: deque[tuple] = deque()
+        # Finished windows map to their buffered rows, pages and end second.
+        self.completed: dict[tuple, tuple] = {}
+        self.sub_windows: deque[tuple] = deque()
+        # The batch windows by index, with the ones read from the result cache.
+        self.windows: dict[int, tuple] = {}
+        self.cached: set[int] = set()
+        self.submitted = 0
+        self.exhausted = False
+
+    @property
+    def done(self):
+        return self.exhausted and not self.order
+
+    def next_window(self, allow_new):
+        # Sub-windows go first since later windows can't be emitted until they
+        # are done.
+        if self.sub_windows:
+            return self.sub_windows.popleft()
+        if self.exhausted or not allow_new:
+            return None
+        # Windows are pulled lazily so an adaptive planner can size each one
+        # from the results observed so far.
+        window = next(self.batch_windows, None)
+        if window is None:
+            self.exhausted = True
+            return None
+        key = (self.submitted,)
+        self.windows[self.submitted] = window
+        self.order.append(key)
+        self.submitted += 1
+        return (key, *window)
 
 
 class CloudwatchAPI:
     """Cloudwatch class for interacting with the API."""
 
-    def __init__(self, logger):
+    def __init__(self, logger, config=None, metrics_logger=None):
         """Initialize CloudwatchAPI."""
+        config = config or {}
+        self.metrics_logger = metrics_logger or metrics.get_metrics_logger()
+        # Totals of every query run, and of each stream's queries, logged as
+        # the run summary.
+        self.stats = QueryStats()
+        self.stream_stats: dict[str, QueryStats] = {}
         self._client = None
+        self._config = None
+        self.client_factory: ClientFactory | None = None
+        self._region_clients: dict = {}
         self.logger = logger
         self.max_concurrent_queries = 20
+        # Queries running past their deadline are stopped and run again.
+        self.poll_timer = PollTimer(
+            deadline_factor=config.get("query_deadline_factor", 3),
+            deadline_percentile=config.get("query_deadline_percentile", 95),
+            min_deadline_s=config.get("query_deadline_min_s", 120),
+            max_deadline_s=config.get("query_timeout_s", 1800),
+        )
+        # Shared by every query so the account level API quotas aren't exceeded.
+        self.limiters = {
+            "start_query": TokenBucket(config.get("start_query_rate_limit", 5)),
+            "get_query_results": TokenBucket(
+                config.get("get_query_results_rate_limit", 5)
+            ),
+            "filter_log_events": TokenBucket(
+                config.get("filter_log_events_rate_limit", 5)
+            ),
+            "describe_log_streams": TokenBucket(5),
+            "stop_query": TokenBucket(5),
+        }
+        self.max_buffered_rows = config.get("max_buffered_rows", 200000)
+        max_buffered_mb = config.get("max_buffered_mb", 256)
+        self.row_buffer = RowBuffer(
+            None if max_buffered_mb is None else max_buffered_mb * 2**20,
+            config.get("buffer_spill_dir"),
+        )
+        self.split_oversized_windows = config.get("split_oversized_windows", False)
+        self.target_fill = config.get("adaptive_target_fill", 0.7)
+        self.histogram_planning = config.get("histogram_planning", False)
+        self.filter_log_events = config.get("filter_log_events", False)
+        # How far behind realtime windows end. Following streams trail closely
+        # and re-query the end of the previous window for late events.
+        self.end_lag_s = 300
+        if config.get("follow"):
+            self.end_lag_s = config.get("follow_lag_s", 5)
+        self.adaptive_end_lag = config.get("adaptive_end_lag", False)
+        self.end_lag_percentile = config.get("end_lag_percentile", 100)
+        self.end_lag_margin_s = config.get("end_lag_margin_s", 30)
+        self.end_lag_probe_s = config.get("end_lag_probe_s", 3600)
+        # The measured lag of each client and log group, with when it was taken.
+        self._end_lags: dict[tuple, tuple[float, int]] = {}
+        self.export_bucket = config.get("export_bucket")
+        self.export_prefix = config.get("export_prefix", "tap-cloudwatch")
+        self.export_tail_s = config.get("export_tail_s", 86400)
+        self._s3_client = None
+        self.result_cache = None
+        if config.get("result_cache_dir"):
+            self.result_cache = ResultCache(
+                config["result_cache_dir"],
+                config.get("result_cache_max_mb", 1024) * 2**20,
+                config.get("result_cache_ttl_s", 604800),
+            )
+        self.cache_hits = 0
+        self.stream_cache_hits: Counter = Counter()
+        self._async_engine = None
+        if config.get("query_engine", "sync") == "async":
+            self._async_engine = AsyncQueryEngine(self)
+        # Queries for every job share the same slots, keyed by job index and
+        # window key.
+        self._jobs: dict = {}
+        self._job_count = 0
+        self._in_flight: dict[tuple, tuple[_QueryJob, Subquery]] = {}
 
     @property
     def client(self):
@@ -29,40 +177,55 @@ class CloudwatchAPI:
             raise Exception("Client not yet initialized")
         return self._client
 
-    def authenticate(self, config):
-        """Authenticate the AWS client."""
-        self._client = self._create_client(config)
+    def authenticate(self, config, client_factory=None):
+        """Authenticate the AWS client.
 
-    def _create_client(self, config):
-        aws_access_key_id = config.get("aws_access_key_id") or os.environ.get(
-            "AWS_ACCESS_KEY_ID"
-        )
-        aws_secret_access_key = config.get("aws_secret_access_key") or os.environ.get(
-            "AWS_SECRET_ACCESS_KEY"
-        )
-        aws_session_token = config.get("aws_session_token") or os.environ.get(
-            "AWS_SESSION_TOKEN"
-        )
-        aws_profile = config.get("aws_profile") or os.environ.get("AWS_PROFILE")
-        aws_endpoint_url = config.get("aws_endpoint_url")
-        aws_region_name = config.get("aws_region_name")
-
-        # AWS credentials based authentication
-        if aws_access_key_id and aws_secret_access_key:
-            aws_session = boto3.session.Session(
-                aws_access_key_id=aws_access_key_id,
-                aws_secret_access_key=aws_secret_access_key,
-                aws_session_token=aws_session_token,
-                region_name=aws_region_name,
+        Clients are created by the `client_factory`, which can be shared with
+        other streams so they reuse the same connections and credentials.
+        """
+        self._config = config
+        self.client_factory = client_factory or ClientFactory(config)
+        self._client = RateLimitedClient(self._create_client(config), self.limiters)
+
+    def client_for_region(self, region):
+        """Return a client for another region, sharing the same rate limits."""
+        if not region or region == self._config.get("aws_region_name"):
+            return self.client
+        if region not in self._region_clients:
+            self._region_clients[region] = RateLimitedClient(
+                self._create_client({**self._config, "aws_region_name": region}),
+                self.limiters,
             )
-        # AWS Profile based authentication
-        else:
-            aws_session = boto3.session.Session(profile_name=aws_profile)
-        if aws_endpoint_url:
-            logs = aws_session.client("logs", endpoint_url=aws_endpoint_url)
-        else:
-            logs = aws_session.client("logs")
-        return logs
+        return self._region_clients[region]
+
+    @property
+    def s3_client(self):
+        """Property to access the S3 client reading exported objects."""
+        if not self._s3_client:
+            self._s3_client = self._create_s3_client(self._config)
+        return self._s3_client
+
+    def _create_client(self, config):
+        return self.client_factory.client(
+            "logs",
+            config.get("aws_region_name"),
+            endpoint_url=config.get("aws_endpoint_url"),
+            max_pool_connections=self._pool_connections,
+        )
+
+    def _create_s3_client(self, config):
+        return self.client_factory.client(
+            "s3",
+            config.get("aws_region_name"),
+            endpoint_url=config.get("export_s3_endpoint_url"),
+            max_pool_connections=self._pool_connections,
+        )
+
+    @property
+    def _pool_connections(self):
+        # A request for every query slot, plus the pages the FilterLogEvents
+        # and export readers fetch ahead.
+        return 2 * self.max_concurrent_queries
 
     def _split_batch_into_windows(self, start_time, end_time, batch_increment_s):
         start_time_epoch = start_time.timestamp()
@@ -87,14 +250,29 @@ class CloudwatchAPI:
             batch_windows.append((query_start, query_end))
         return batch_windows
 
+    def shard_range(self, start_time, end_time, batch_increment_s, index, count):
+        """Return the first and last second of a shard of the batch windows.
+
+        The windows from `start_time` to `end_time` are cut into `count`
+        contiguous slices of nearly equal length, so every shard covers a
+        separate range. Returns None when the shard has no windows.
+        """
+        windows = self._split_batch_into_windows(
+            start_time, end_time, batch_increment_s
+        )
+        first = len(windows) * index // count
+        last = len(windows) * (index + 1) // count
+        if first == last:
+            return None
+        return windows[first][0], windows[last - 1][1]
+
     def _validate_query(self, query):
-        if "|sort" in query.replace(" ", ""):
-            raise InvalidQueryException("sort not allowed")
-        if "|limit" in query.replace(" ", ""):
-            raise InvalidQueryException("limit not allowed")
-        if "stats" in query:
-            raise InvalidQueryException("stats not allowed")
-        if "@timestamp" not in query.split("|")[0]:
+        commands = {command_name(command) for command in split_commands(query)}
+        for command in ("sort", "limit", "stats"):
+            if command in commands:
+                raise InvalidQueryException(f"{command} not allowed")
+        fields = parse_fields(query) or []
+        if "@timestamp" not in [field.expression for field in fields]:
             raise InvalidQueryException(
                 "@timestamp field is used as the replication key so it must be selected"
             )
@@ -102,44 +280,594 @@ class CloudwatchAPI:
     def _queue_is_full(self, queue):
         return len(queue) >= self.max_concurrent_queries
 
-    @staticmethod
-    def _get_completed_query(queue):
-        return queue.popleft()
-
-    def _iterate_batches(self, batch_windows, log_group, query):
-        queue: deque[Subquery] = deque()
+    def _buffer_is_full(self):
+        # Finished windows wait here until every earlier window is emitted.
+        buffered_rows = sum(
+            rows for job in self._jobs.values() for rows, *_ in job.completed.values()
+        )
+        return buffered_rows >= self.max_buffered_rows
 
-        for start_ts, end_ts in batch_windows:
-            if self._queue_is_full(queue):
-                query_obj = self._get_completed_query(queue)
-                queue.append(
-                    Subquery(self.client, start_ts, end_ts, log_group, query).execute()
+    def _fill_slots(self, current):
+        # Slots the current job can't use go to the jobs queued after it.
+        jobs = [current] + [job for job in self._jobs.values() if job is not current]
+        for job in jobs:
+            # The current job always gets a window to read, even when the
+            # buffer is full of the results of later jobs.
+            allow_current = job is current and not job.order
+            while not self._queue_is_full(self._in_flight):
+                window = job.next_window(
+                    allow_new=allow_current or not self._buffer_is_full()
+                )
+                allow_current = False
+                if window is None:
+                    break
+                key, start_ts, end_ts = window
+                if len(key) == 1:
+                    pages = self._cached_pages(job, start_ts, end_ts)
+                    if pages is not None:
+                        # Read from disk as they're emitted, so no rows are held.
+                        job.cached.add(key[0])
+                        job.completed[key] = (0, pages, end_ts)
+                        continue
+                self._in_flight[(job.index, key)] = (
+                    job,
+                    Subquery(
+                        job.client,
+                        start_ts,
+                        end_ts,
+                        job.log_group,
+                        job.query,
+                        poll_timer=self.poll_timer,
+                    ).execute(),
                 )
-                yield query_obj.get_results()
+
+    def _split_oversized_query(self, job, key, query_obj):
+        results, windows = query_obj.split(self.target_fill)
+        # The results received so far and each sub-window take the place of the
+        # split window in the emit order.
+        children = [(*key, i) for i in range(len(windows) + 1)]
+        position = job.order.index(key)
+        del job.order[position]
+        for child in reversed(children):
+            job.order.insert(position, child)
+        job.completed[children[0]] = (
+            len(results),
+            self.row_buffer.hold_pages([results], job),
+            windows[0][0] - 1,
+        )
+        self._log_query_stats(query_obj, job.metric_tags)
+        job.sub_windows.extend(
+            (child, start_ts, end_ts)
+            for child, (start_ts, end_ts) in zip(children[1:], windows)
+        )
+
+    def _harvest_completed_queries(self, current):
+        # Polling a finished query fetches its results, so once the buffer is
+        # full only the query holding up the emit order is polled. If that one
+        # is still waiting for a slot everything is polled to free one up.
+        head = (current.index, current.order[0]) if current.order else None
+        pollable = self._in_flight
+        if head in self._in_flight and self._buffer_is_full():
+            pollable = {head: self._in_flight[head]}
+        # Sleep until the earliest query is due, then poll every query that is
+        # due by then, starting with the current job.
+        poll_at = min(query_obj.next_poll_at for _, query_obj in pollable.values())
+        wait = poll_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        for key, (job, query_obj) in sorted(
+            pollable.items(), key=lambda item: (item[0][0] != current.index, item[0])
+        ):
+            if key != head and head in self._in_flight and self._buffer_is_full():
+                continue
+            if query_obj.next_poll_at > poll_at or not query_obj.poll():
+                continue
+            del self._in_flight[key]
+            window_key = key[1]
+            if query_obj.can_split() or (
+                self.split_oversized_windows and query_obj.is_oversized()
+            ):
+                self._split_oversized_query(job, window_key, query_obj)
             else:
-                queue.append(
-                    Subquery(self.client, start_ts, end_ts, log_group, query).execute()
+                query_obj.hold_results(self.row_buffer, job)
+                # Continuations are only fetched as the pages are consumed.
+                job.completed[window_key] = (
+                    query_obj.buffered_rows(),
+                    self._iter_results(job, query_obj),
+                    query_obj.window[1],
                 )
+            if job.window_planner and len(window_key) == 1:
+                job.window_planner.observe(*query_obj.window, query_obj.records_matched)
+
+    def _log_query_stats(self, query_obj, tags):
+        window_start, window_end = query_obj.window
+        self.stats.add(query_obj.stats)
+        if "stream" in tags:
+            self.stream_stats.setdefault(tags["stream"], QueryStats()).add(
+                query_obj.stats
+            )
+        query_obj.stats.log(
+            self.metrics_logger,
+            {
+                **tags,
+                "window_start": datetime.utcfromtimestamp(window_start).isoformat(),
+                "window_end": datetime.utcfromtimestamp(window_end).isoformat(),
+            },
+        )
+
+    def _iter_results(self, job, query_obj):
+        start_ts = query_obj.window[0]
+        for page in query_obj.iter_results():
+            yield page
+            if job.on_checkpoint and query_obj.start_ts != start_ts:
+                # Every record before the continuation's start has been read.
+                start_ts = query_obj.start_ts
+                job.on_checkpoint(continuation_ts=start_ts)
+        # Continuations are only run as the pages are read, so the statistics
+        # are complete once the last one has been.
+        self._log_query_stats(query_obj, job.metric_tags)
+
+    def log_summary(self, tags, stream=None):
+        """Log the totals of every query run so far, or only of a stream's."""
+        if stream is None:
+            stats, cache_hits = self.stats, self.cache_hits
+        else:
+            stats = self.stream_stats.get(stream, QueryStats())
+            cache_hits = self.stream_cache_hits[stream]
+        stats.log(self.metrics_logger, tags)
+        if self.result_cache:
+            log_counter(
+                self.metrics_logger,
+                Metric.RESULT_CACHE_HIT_COUNT,
+                cache_hits,
+                tags,
+            )
+
+    def _cached_pages(self, job, start_ts, end_ts):
+        if not self.result_cache:
+            return None
+        pages = self.result_cache.get(
+            job.region, job.log_group, job.query, start_ts, end_ts
+        )
+        if pages is not None:
+            self.cache_hits += 1
+            if "stream" in job.metric_tags:
+                self.stream_cache_hits[job.metric_tags["stream"]] += 1
+            self.logger.info(
+                "Reading cached results for batch from:"
+                f" `{datetime.utcfromtimestamp(start_ts).isoformat()} UTC` -"
+                f" `{datetime.utcfromtimestamp(end_ts).isoformat()} UTC`"
+            )
+        return pages
+
+    def _cache_writer(self, job, start_ts, end_ts):
+        # Windows ending inside the safety buffer can still receive records.
+        if not self.result_cache:
+            return None
+        if end_ts >= self._safe_end_time().timestamp():
+            return None
+        return self.result_cache.writer(
+            job.region, job.log_group, job.query, start_ts, end_ts
+        )
+
+    def _add_job(
+        self,
+        job_key,
+        client,
+        batch_windows,
+        log_group,
+        query,
+        planner,
+        metric_tags=None,
+        on_checkpoint=None,
+        region=None,
+        reader=None,
+        export=None,
+    ):
+        self._jobs[job_key] = _QueryJob(
+            self._job_count,
+            client,
+            batch_windows,
+            log_group,
+            query,
+            planner,
+            metric_tags,
+            on_checkpoint,
+            region,
+            reader,
+            export,
+        )
+        self._job_count += 1
+        if self._async_engine and not reader:
+            self._async_engine.add_job(job_key)
 
-        # Clear queue to complete
-        while len(queue) > 0:
-            query_obj = self._get_completed_query(queue)
-            yield query_obj.get_results()
+    def _run_job(self, job_key):
+        job = self._jobs[job_key]
+        # Caches the pages of a batch window, including those of its
+        # sub-windows, once every one has been emitted.
+        writer = None
+        try:
+            while True:
+                self._fill_slots(job)
+                if job.order and job.order[0] in job.completed:
+                    key = job.order.popleft()
+                    _, pages, window_end = job.completed.pop(key)
+                    if writer is None and key[0] not in job.cached:
+                        writer = self._cache_writer(job, *job.windows[key[0]])
+                    for page in pages:
+                        if writer:
+                            writer.add_page(page)
+                        yield page
+                    if job.on_checkpoint:
+                        job.on_checkpoint(window_end=window_end)
+                    if writer and (not job.order or job.order[0][0] != key[0]):
+                        writer.commit()
+                        writer = None
+                    continue
+                if job.done:
+                    return
+                self._harvest_completed_queries(job)
+        finally:
+            if writer:
+                writer.abort()
+            self._drop_job(job_key)
 
-    def _alter_end_ts(self, end_time):
-        default_end_time = datetime.now(timezone.utc) - timedelta(minutes=5)
+    def _drop_job(self, job_key):
+        # A job closed early leaves queries running and results unread, which
+        # would otherwise keep holding query slots and buffer space.
+        job = self._jobs.pop(job_key)
+        for key in [key for key, (owner, _) in self._in_flight.items() if owner is job]:
+            del self._in_flight[key]
+        self.row_buffer.discard(job)
+
+    def _run_filter_job(self, job_key):
+        job = self._jobs[job_key]
+        try:
+            for start_ts, end_ts in job.batch_windows:
+                records = 0
+                for page in job.reader.iter_window(start_ts, end_ts):
+                    records += len(page)
+                    yield page
+                if job.window_planner:
+                    job.window_planner.observe(start_ts, end_ts, records)
+                if job.on_checkpoint:
+                    job.on_checkpoint(window_end=end_ts)
+        finally:
+            job.reader.close()
+            self._drop_job(job_key)
+
+    def _run_export(self, job):
+        reader, start_ts, end_ts = job.export
+        try:
+            # Checkpointed as the range is read, so an interrupted backfill
+            # only exports the rest of it again.
+            for page, window_end in reader.iter_range(start_ts, end_ts):
+                if page:
+                    yield page
+                if job.on_checkpoint:
+                    job.on_checkpoint(window_end=window_end)
+        finally:
+            reader.close()
+        job.export = None
+
+    def _iterate_batches(
+        self,
+        batch_windows,
+        log_group,
+        query,
+        window_planner=None,
+        reader=None,
+        export=None,
+    ):
+        job_key = object()
+        self._add_job(
+            job_key,
+            self.client,
+            batch_windows,
+            log_group,
+            query,
+            window_planner,
+            reader=reader,
+            export=export,
+        )
+        yield from self.run_query_job(job_key)
+
+    def _safe_end_time(self):
+        return datetime.now(timezone.utc) - timedelta(minutes=5)
+
+    def _alter_end_ts(self, end_time, end_lag_s=None):
+        if end_lag_s is None:
+            end_lag_s = self.end_lag_s
+        default_end_time = datetime.now(timezone.utc) - timedelta(seconds=end_lag_s)
         if end_time:
             return min([end_time, default_end_time])
         else:
             return default_end_time
 
+    def _plan_windows_from_histogram(
+        self, client, log_group, query, start_time, end_time
+    ):
+        start_ts = int(start_time.timestamp())
+        end_ts = int(end_time.timestamp())
+        if end_ts <= start_ts:
+            return
+        # Keep the number of bins under the 10k result limit.
+        bin_s = max(60, ceil((end_ts - start_ts + 1) / 10000))
+        histogram = HistogramSubquery(
+            client,
+            start_ts,
+            end_ts,
+            log_group,
+            query,
+            bin_s,
+            poll_timer=self.poll_timer,
+        ).execute()
+        windows = HistogramWindowPlanner(target_fill=self.target_fill).plan(
+            histogram.get_bins(), start_ts, end_ts, bin_s
+        )
+        self._log_query_stats(
+            histogram, {"log_group": log_group, "query_type": "histogram"}
+        )
+        self.logger.info(
+            f"Planned {len(windows)} batch windows for `{log_group}` from a "
+            f"histogram of {bin_s}s bins."
+        )
+        for window_start, window_end, records in windows:
+            self.logger.info(
+                "Planned batch window from:"
+                f" `{datetime.utcfromtimestamp(window_start).isoformat()} UTC` -"
+                f" `{datetime.utcfromtimestamp(window_end).isoformat()} UTC`"
+                f" with ~{records} records."
+            )
+            yield (window_start, window_end)
+
+    def _get_batch_windows(
+        self,
+        client,
+        log_group,
+        bookmark,
+        query,
+        batch_increment_s,
+        end_time,
+        planner,
+        histogram=True,
+        end_lag_s=None,
+    ):
+        self._validate_query(query)
+        if self.adaptive_end_lag and end_lag_s is None:
+            return self._windows_before_watermark(
+                client,
+                log_group,
+                bookmark,
+                query,
+                batch_increment_s,
+                end_time,
+                planner,
+                histogram,
+            )
+        end_time = self._alter_end_ts(end_time, end_lag_s)
+        # FilterLogEvents has no result limit, so it doesn't need a histogram.
+        if self.histogram_planning and histogram:
+            # Runs lazily, when the job first gets a free query slot.
+            return self._plan_windows_from_histogram(
+                client, log_group, query, bookmark, end_time
+            )
+        if planner:
+            return planner.windows(bookmark, end_time)
+        return self._split_batch_into_windows(bookmark, end_time, batch_increment_s)
+
+    def _windows_before_watermark(self, client, log_group, *args):
+        # Measured lazily, when the job first gets a free query slot.
+        end_lag_s = self._measure_end_lag(client, log_group)
+        yield from self._get_batch_windows(
+            client, log_group, *args, end_lag_s=end_lag_s
+        )
+
+    def _measure_end_lag(self, client, log_group):
+        key = (client, log_group)
+        previous = self._end_lags.get(key)
+        if previous and time.monotonic() - previous[0] < self.end_lag_probe_s:
+            return previous[1]
+        now_ts = int(datetime.now(timezone.utc).timestamp())
+        probe = LagSubquery(
+            client,
+            now_ts - self.end_lag_probe_s,
+            now_ts,
+            log_group,
+            self.end_lag_percentile,
+            poll_timer=self.poll_timer,
+        ).execute()
+        lag_s = probe.get_lag_s()
+        self._log_query_stats(
+            probe, {"log_group": log_group, "query_type": "ingestion_lag"}
+        )
+        if lag_s is None:
+            # The group may be idle, or delayed by more than the probe range,
+            # so the buffer is never shortened to the fixed one.
+            if previous:
+                end_lag_s = previous[1]
+            else:
+                end_lag_s = max(
+                    self.end_lag_s, self.end_lag_probe_s + self.end_lag_margin_s
+                )
+            self.logger.info(
+                f"No events were ingested into `{log_group}` in the last "
+                f"{self.end_lag_probe_s}s, windows end {end_lag_s}s before now."
+            )
+        else:
+            end_lag_s = ceil(lag_s + self.end_lag_margin_s)
+            self.logger.info(
+                f"`{log_group}` ingestion lag is {lag_s:.1f}s, windows end "
+                f"{end_lag_s}s before now."
+            )
+            log_timer(
+                self.metrics_logger,
+                Metric.INGESTION_LAG,
+                lag_s,
+                {"log_group": log_group},
+            )
+        self._end_lags[key] = (time.monotonic(), end_lag_s)
+        return end_lag_s
+
+    def add_query_job(
+        self,
+        job_key,
+        bookmark,
+        log_group,
+        query,
+        batch_increment_s,
+        end_time,
+        window_planner=None,
+        region=None,
+        metric_tags=None,
+        on_checkpoint=None,
+    ):
+        """Queue a log group query so its windows can use spare query slots.
+
+        Jobs share the concurrent query budget. While one job is being read,
+        any slots it can't fill are used to run the windows of jobs queued
+        after it, whose results are held until `run_query_job` reads them.
+        The `metric_tags` are added to the statistics logged for each query.
+
+        Once the records of a window have all been read `on_checkpoint` is
+        called with its `window_end`, and within a window that is continued
+        past the 10k limit with the `continuation_ts` it restarted from.
+        """
+        client = self.client_for_region(region)
+        reader = self._filter_events_reader(client, log_group, query)
+        export = self._export(client, log_group, query, bookmark, end_time)
+        if export:
+            # The windows after the exported range are queried as usual.
+            bookmark = datetime.fromtimestamp(export[2] + 1, tz=timezone.utc)
+        batch_windows = self._get_batch_windows(
+            client,
+            log_group,
+            bookmark,
+            query,
+            batch_increment_s,
+            end_time,
+            window_planner,
+            histogram=reader is None,
+        )
+        self._add_job(
+            job_key,
+            client,
+            batch_windows,
+            log_group,
+            query,
+            window_planner,
+            metric_tags,
+            on_checkpoint,
+            region or (self._config or {}).get("aws_region_name"),
+            reader,
+            export,
+        )
+
+    def _export(self, client, log_group, query, bookmark, end_time):
+        if not self.export_bucket or bookmark is None:
+            return None
+        cutoff = min(
+            self._alter_end_ts(end_time),
+            datetime.now(timezone.utc) - timedelta(seconds=self.export_tail_s),
+        )
+        if cutoff <= bookmark:
+            return None
+        simple_query = parse_simple_query(query)
+        if simple_query is None or any(
+            field not in EXPORT_FIELDS for field in simple_query.fields
+        ):
+            self.logger.info(
+                "The query can't be read from exported objects, only "
+                f"{', '.join(EXPORT_FIELDS)} can be selected. Querying instead."
+            )
+            return None
+        reader = ExportReader(
+            client,
+            self.s3_client,
+            self.export_bucket,
+            self.export_prefix,
+            log_group,
+            simple_query,
+            self.max_concurrent_queries,
+        )
+        return reader, int(bookmark.timestamp()), int(cutoff.timestamp())
+
+    def _filter_events_reader(self, client, log_group, query):
+        if not self.filter_log_events:
+            return None
+        simple_query = parse_simple_query(query)
+        if simple_query is None:
+            return None
+        self.logger.info(f"Reading `{log_group}` with FilterLogEvents.")
+        return FilterEventsReader(
+            client, log_group, simple_query, self.max_concurrent_queries
+        )
+
+    def stop_queries(self):
+        """Stop every query still running, e.g. when the sync is interrupted."""
+        if self._async_engine:
+            self._async_engine.close()
+        for client in [self._client, *self._region_clients.values()]:
+            if isinstance(client, RateLimitedClient):
+                client.stop_queries()
+
+    def run_query_job(self, job_key):
+        """Retrieve records for a queued job.
+
+        If reading is interrupted by an error, or the generator is closed
+        before the job is done, every query still running is stopped so it
+        doesn't keep holding one of the account's concurrent query slots.
+        """
+        try:
+            yield from self._run_query_job(job_key)
+        except BaseException:
+            self.stop_queries()
+            raise
+
+    def _run_query_job(self, job_key):
+        job = self._jobs[job_key]
+        if job.export:
+            exported = False
+            try:
+                yield from self._run_export(job)
+                exported = True
+            finally:
+                if not exported:
+                    self._drop_job(job_key)
+                    if self._async_engine:
+                        self._async_engine.close()
+        if job.reader:
+            yield from self._run_filter_job(job_key)
+        elif self._async_engine:
+            yield from self._async_engine.run_query_job(job_key)
+        else:
+            yield from self._run_job(job_key)
+
     def get_records_iterator(
-        self, bookmark, log_group, query, batch_increment_s, end_time
+        self,
+        bookmark,
+        log_group,
+        query,
+        batch_increment_s,
+        end_time,
+        window_planner=None,
     ):
         """Retrieve records from Cloudwatch."""
-        self._validate_query(query)
-        batch_windows = self._split_batch_into_windows(
-            bookmark, self._alter_end_ts(end_time), batch_increment_s
+        reader = self._filter_events_reader(self.client, log_group, query)
+        export = self._export(self.client, log_group, query, bookmark, end_time)
+        if export:
+            bookmark = datetime.fromtimestamp(export[2] + 1, tz=timezone.utc)
+        batch_windows = self._get_batch_windows(
+            self.client,
+            log_group,
+            bookmark,
+            query,
+            batch_increment_s,
+            end_time,
+            window_planner,
+            histogram=reader is None,
         )
 
-        yield from self._iterate_batches(batch_windows, log_group, query)
+        yield from self._iterate_batches(
+            batch_windows, log_group, query, window_planner, reader, export
+        )
@@ -0,0 +1,50 @@
+"""Class for dropping duplicate records at window and sub-batch edges."""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+
+class PtrDedupCache:
+    """Remember the ptr of recent records so repeats can be dropped.
+
+    Duplicates only come from re-querying the second a window or sub-batch
+    ended on, so only the latest two seconds of records are kept. Older
+    entries are evicted as the timestamp watermark moves past them. When
+    windows overlap by more, e.g. while following a log group, `retain_s`
+    keeps that many seconds before the watermark.
+    """
+
+    def __init__(self, retain_s=0):
+        """Initialize PtrDedupCache."""
+        self.retain_s = retain_s
+        self.hits = 0
+        self._ptrs: dict[str, set] = {}
+        self._watermark = None
+
+    def is_duplicate(self, timestamp, ptr):
+        """Return True if the record was already seen, caching it otherwise."""
+        if timestamp is None or ptr is None:
+            return False
+        # Timestamps are formatted like `2023-02-20T06:01:57.792Z`, so the
+        # prefix is the second and compares in time order.
+        second = timestamp[:19]
+        ptrs = self._ptrs.get(second)
+        if ptrs is not None and ptr in ptrs:
+            self.hits += 1
+            return True
+        if self._watermark is None or second > self._watermark:
+            previous = self._watermark or second
+            if self.retain_s:
+                oldest = datetime.fromisoformat(second) - timedelta(
+                    seconds=self.retain_s
+                )
+                previous = min(previous, oldest.isoformat())
+            self._ptrs = {k: v for k, v in self._ptrs.items() if k >= previous}
+            self._watermark = second
+        self._ptrs.setdefault(second, set()).add(ptr)
+        return False
+
+    def __len__(self):
+        """Return the number of cached ptr values."""
+        return sum(len(ptrs) for ptrs in self._ptrs.values())
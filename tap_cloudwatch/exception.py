@@ -5,3 +5,9 @@ class InvalidQueryException(Exception):
     """Raised when the input query is invalid."""
 
     pass
+
+
+class InvalidConfigException(Exception):
+    """Raised when the tap config is invalid."""
+
+    pass
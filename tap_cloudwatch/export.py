@@ -0,0 +1,231 @@
+"""Classes for reading historical ranges through CloudWatch Logs export tasks."""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import heapq
+import logging
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+# Fields that exported objects hold, the rest of the query has to be simple.
+EXPORT_FIELDS = ("@timestamp", "@message", "@logStream", "@ptr")
+
+
+def _parse_lines(data):
+    # Each event is written as `2023-01-01T00:00:00.000Z message`. Lines that
+    # don't start with a timestamp continue the previous event's message.
+    events: list[list[str]] = []
+    text = data.decode("utf-8", errors="replace")
+    if text.endswith("\n"):
+        text = text[:-1]
+    for line in text.split("\n"):
+        if line[23:25] in ("Z ", "Z") and line[10:11] == "T":
+            events.append([line[:24], line[25:]])
+        elif events:
+            events[-1][1] += "\n" + line
+    return events
+
+
+class _StreamObjects:
+    """Events of one log stream's exported objects, fetching one ahead."""
+
+    def __init__(self, reader, stream_name, keys):
+        self.reader = reader
+        self.stream_name = stream_name
+        self.keys = keys
+        # The first object is requested right away, so every stream is
+        # downloaded and decompressed in parallel before they're merged.
+        self._future: Future | None = reader.executor.submit(self._fetch, 0)
+
+    def _fetch(self, index):
+        response = self.reader.s3_client.get_object(
+            Bucket=self.reader.bucket, Key=self.keys[index]
+        )
+        return _parse_lines(gzip.decompress(response["Body"].read()))
+
+    def __iter__(self):
+        index = 0
+        # Counts identical events at the same timestamp, so each gets its own
+        # `@ptr`. They're adjacent since the objects are in timestamp order.
+        occurrences: dict[str, int] = {}
+        previous = None
+        while self._future is not None:
+            events = self._future.result()
+            self._future = None
+            if index + 1 < len(self.keys):
+                self._future = self.reader.executor.submit(self._fetch, index + 1)
+            for timestamp, message in events:
+                if timestamp != previous:
+                    occurrences.clear()
+                    previous = timestamp
+                occurrence = occurrences.get(message, 0)
+                occurrences[message] = occurrence + 1
+                yield timestamp, message, self.stream_name, occurrence
+            index += 1
+
+    def close(self):
+        if self._future is not None:
+            self._future.cancel()
+
+
+class ExportReader:
+    """Read a log group's events in a range with `CreateExportTask`.
+
+    The range is exported to `s3://{bucket}/{prefix}/` and the gzip objects
+    of each log stream are downloaded and decompressed in parallel, one ahead,
+    and merged in timestamp order. The rows have the same fields as Logs
+    Insights results. Exports don't include event IDs, so `@ptr` is the
+    timestamp and a hash of the log stream and message, which stays the same
+    when the range is exported again.
+    """
+
+    def __init__(
+        self,
+        client,
+        s3_client,
+        bucket,
+        prefix,
+        log_group,
+        simple_query,
+        max_workers,
+        poll_s=10,
+        page_size=10000,
+    ):
+        """Initialize ExportReader."""
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.log_group = log_group
+        self.query = simple_query
+        self.poll_s = poll_s
+        self.page_size = page_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _create_task(self, start_ts, end_ts):
+        while True:
+            try:
+                return self.client.create_export_task(
+                    taskName=f"tap-cloudwatch-{uuid.uuid4()}",
+                    logGroupName=self.log_group,
+                    fromTime=start_ts * 1000,
+                    to=end_ts * 1000 + 999,
+                    destination=self.bucket,
+                    destinationPrefix=self.prefix,
+                )["taskId"]
+            except ClientError as e:
+                # Only one export task can run at a time in an account.
+                if e.response.get("Error", {}).get("Code") != "LimitExceededException":
+                    raise
+                self.logger.info("Another export task is running, waiting...")
+                time.sleep(self.poll_s)
+
+    def _wait_for_task(self, task_id):
+        while True:
+            task = self.client.describe_export_tasks(taskId=task_id)["exportTasks"][0]
+            status = task["status"]["code"]
+            if status == "COMPLETED":
+                return
+            if status in ("CANCELLED", "FAILED"):
+                raise Exception(f"Export task {task_id} failed: {task['status']}")
+            self.logger.info(f"Export task {task_id} status: {status}, waiting...")
+            time.sleep(self.poll_s)
+
+    def _list_streams(self, task_id):
+        # Objects are written as `{prefix}/{task_id}/{log stream}/000000.gz`,
+        # and log stream names can contain slashes.
+        task_prefix = f"{self.prefix}/{task_id}/" if self.prefix else f"{task_id}/"
+        streams: dict[str, list[str]] = {}
+        kwargs: dict = {}
+        while True:
+            response = self.s3_client.list_objects_v2(
+                Bucket=self.bucket, Prefix=task_prefix, **kwargs
+            )
+            for obj in response.get("Contents", []):
+                key = obj["Key"]
+                stream_name, _, name = key[len(task_prefix) :].rpartition("/")
+                if stream_name and name.endswith(".gz"):
+                    streams.setdefault(stream_name, []).append(key)
+            if not response.get("IsTruncated"):
+                break
+            kwargs = {"ContinuationToken": response["NextContinuationToken"]}
+        return {name: sorted(keys) for name, keys in streams.items()}
+
+    @staticmethod
+    def _ptr(timestamp, message, stream_name, occurrence):
+        digest = hashlib.blake2b(digest_size=12)
+        for part in (stream_name, str(occurrence), message):
+            digest.update(part.encode("utf-8", errors="replace"))
+            digest.update(b"\0")
+        return f"{timestamp}/{digest.hexdigest()}"
+
+    def _row(self, timestamp, message, stream_name, occurrence):
+        values = {
+            # Formatted like Logs Insights, e.g. `2023-02-20 06:01:57.792`.
+            "@timestamp": f"{timestamp[:10]} {timestamp[11:23]}",
+            "@message": message,
+            "@logStream": stream_name,
+            "@ptr": self._ptr(timestamp, message, stream_name, occurrence),
+        }
+        row = [{"field": field, "value": values[field]} for field in self.query.fields]
+        if "@ptr" not in self.query.fields:
+            # Records are deduplicated by `ptr`, so it's always included.
+            row.append({"field": "@ptr", "value": values["@ptr"]})
+        return row
+
+    def iter_range(self, start_ts, end_ts):
+        """Export the range and yield pages of its rows in time order.
+
+        Each page is yielded with the last second whose events have all been
+        read once it is, so progress can be checkpointed as the range is read.
+        """
+        self.logger.info(
+            f"Exporting `{self.log_group}` from:"
+            f" `{datetime.utcfromtimestamp(start_ts).isoformat()} UTC` -"
+            f" `{datetime.utcfromtimestamp(end_ts).isoformat()} UTC`"
+            f" to `s3://{self.bucket}/{self.prefix}`"
+        )
+        task_id = self._create_task(start_ts, end_ts)
+        self._wait_for_task(task_id)
+        stream_predicates = self.query.predicates("@logStream")
+        streams = [
+            _StreamObjects(self, name, keys)
+            for name, keys in self._list_streams(task_id).items()
+            if all(match(name) for match in stream_predicates)
+        ]
+        self.logger.info(
+            f"Reading export task {task_id} objects of {len(streams)} log streams."
+        )
+        predicates = self.query.predicates("@message")
+        page = []
+        second = None
+        try:
+            for event in heapq.merge(*streams, key=lambda e: e[0]):
+                if not all(match(event[1]) for match in predicates):
+                    continue
+                if len(page) >= self.page_size and event[0][:19] != second:
+                    # Every event before this one's second has been read.
+                    yield page, self._parse_second(event[0]) - 1
+                    page = []
+                second = event[0][:19]
+                page.append(self._row(*event))
+            yield page, end_ts
+        finally:
+            for stream in streams:
+                stream.close()
+
+    @staticmethod
+    def _parse_second(timestamp):
+        parsed = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+        return int(parsed.replace(tzinfo=timezone.utc).timestamp())
+
+    def close(self):
+        """Stop the threads downloading objects."""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,215 @@
+"""Classes for reading simple queries with FilterLogEvents."""
+
+from __future__ import annotations
+
+import heapq
+import logging
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from tap_cloudwatch.query_parser import parse_fields, split_commands
+
+# FilterLogEvents event keys for the Logs Insights fields they hold.
+EVENT_FIELDS = {
+    "@timestamp": "timestamp",
+    "@message": "message",
+    "@logStream": "logStreamName",
+    "@ingestionTime": "ingestionTime",
+    "@ptr": "eventId",
+}
+_TIME_FIELDS = ("@timestamp", "@ingestionTime")
+# Events can be timestamped up to 2 hours after they're ingested.
+_MAX_FUTURE_MS = 2 * 3600 * 1000
+
+# Only these fields can be filtered on, the others aren't strings.
+_FILTER_FIELDS = ("@message", "@logStream")
+_FILTER = re.compile(
+    r"filter\s+(@\w+)\s+(?:(like)\s+(\"(?:[^\"\\]|\\.)*\"|/(?:[^/\\]|\\.)*/)"
+    r"|(=)\s+(\"(?:[^\"\\]|\\.)*\"))$"
+)
+
+
+def _unquote(literal):
+    return re.sub(r"\\(.)", r"\1", literal[1:-1])
+
+
+class SimpleQuery:
+    """A query that only selects event fields and filters on them."""
+
+    def __init__(self, fields, filters):
+        """Initialize SimpleQuery.
+
+        The filters are `(field, predicate)` pairs that events have to match.
+        """
+        self.fields = fields
+        self.filters = filters
+
+    def predicates(self, field):
+        """Return the predicates the values of a field have to match."""
+        return [predicate for name, predicate in self.filters if name == field]
+
+
+def parse_simple_query(query):
+    """Return a SimpleQuery if the query can be read with FilterLogEvents.
+
+    That is a `fields` command selecting event fields, optionally followed by
+    `filter` commands matching a field `like` a string or regular expression,
+    or `=` a string. Returns None for any other query.
+    """
+    parsed_fields = parse_fields(query)
+    if not parsed_fields or any(
+        field.name != field.expression or field.name not in EVENT_FIELDS
+        for field in parsed_fields
+    ):
+        return None
+    fields = [field.name for field in parsed_fields]
+    rest = split_commands(query)[1:]
+    filters = []
+    for command in rest:
+        match = _FILTER.fullmatch(command)
+        if not match or match.group(1) not in _FILTER_FIELDS:
+            return None
+        field, _, pattern, equals, literal = match.groups()
+        if equals:
+            value = _unquote(literal)
+            filters.append((field, value.__eq__))
+        elif pattern.startswith("/"):
+            filters.append((field, re.compile(pattern[1:-1]).search))
+        else:
+            substring = _unquote(pattern)
+            filters.append((field, lambda v, s=substring: s in v))
+    return SimpleQuery(fields, filters)
+
+
+def _format_ms(ms):
+    ts = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    return f"{ts:%Y-%m-%d %H:%M:%S}.{ms % 1000:03d}"
+
+
+class _StreamEvents:
+    """Events of one log stream in a time range, fetching a page ahead."""
+
+    def __init__(self, reader, stream_name, start_ms, end_ms):
+        self.reader = reader
+        self.request = {
+            "logGroupName": reader.log_group,
+            "logStreamNames": [stream_name],
+            "startTime": start_ms,
+            "endTime": end_ms,
+        }
+        # The first page is requested right away, so every stream of a window
+        # is fetched in parallel before they're merged.
+        self._future: Future | None = reader.executor.submit(self._fetch, None)
+
+    def _fetch(self, token):
+        kwargs = {"nextToken": token} if token else {}
+        return self.reader.client.filter_log_events(**self.request, **kwargs)
+
+    def __iter__(self):
+        while self._future is not None:
+            response = self._future.result()
+            token = response.get("nextToken")
+            self._future = None
+            if token:
+                self._future = self.reader.executor.submit(self._fetch, token)
+            yield from response["events"]
+
+    def close(self):
+        if self._future is not None:
+            self._future.cancel()
+
+
+class FilterEventsReader:
+    """Read the events of a log group with FilterLogEvents.
+
+    Each log stream that can hold events in a window is read in parallel,
+    one page ahead, and the streams are merged in timestamp order. The rows
+    have the same fields as Logs Insights results, with the event ID as
+    `@ptr`, and are returned in pages of up to `page_size` rows.
+    """
+
+    def __init__(self, client, log_group, simple_query, max_workers, page_size=10000):
+        """Initialize FilterEventsReader."""
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.log_group = log_group
+        self.query = simple_query
+        self.page_size = page_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._streams: list[dict] | None = None
+
+    def _list_streams(self):
+        # Filters on the log stream are applied to the list of streams.
+        predicates = self.query.predicates("@logStream")
+        streams = []
+        token = None
+        while True:
+            kwargs = {"nextToken": token} if token else {}
+            response = self.client.describe_log_streams(
+                logGroupName=self.log_group, **kwargs
+            )
+            streams.extend(
+                stream
+                for stream in response["logStreams"]
+                if all(match(stream["logStreamName"]) for match in predicates)
+            )
+            token = response.get("nextToken")
+            if not token:
+                return streams
+
+    def _active_streams(self, start_ms, end_ms):
+        if self._streams is None:
+            self._streams = self._list_streams()
+            self.logger.info(
+                f"Reading {len(self._streams)} log streams of `{self.log_group}` "
+                "with FilterLogEvents."
+            )
+        return [
+            stream["logStreamName"]
+            for stream in self._streams
+            if stream.get("firstEventTimestamp", start_ms) <= end_ms
+            and stream.get("lastIngestionTime", end_ms) >= start_ms - _MAX_FUTURE_MS
+        ]
+
+    def _row(self, event):
+        row = []
+        for field in self.query.fields:
+            value = event.get(EVENT_FIELDS[field])
+            if value is None:
+                continue
+            if field in _TIME_FIELDS:
+                value = _format_ms(value)
+            row.append({"field": field, "value": value})
+        if "@ptr" not in self.query.fields:
+            # Records are deduplicated by `ptr`, so it's always included.
+            row.append({"field": "@ptr", "value": event["eventId"]})
+        return row
+
+    def iter_window(self, start_ts, end_ts):
+        """Yield pages of rows for the events in the window, in time order."""
+        # The end second is included, as with Logs Insights.
+        start_ms, end_ms = start_ts * 1000, end_ts * 1000 + 999
+        streams = [
+            _StreamEvents(self, name, start_ms, end_ms)
+            for name in self._active_streams(start_ms, end_ms)
+        ]
+        predicates = self.query.predicates("@message")
+        page = []
+        try:
+            for event in heapq.merge(*streams, key=lambda e: e["timestamp"]):
+                if not all(match(event["message"]) for match in predicates):
+                    continue
+                page.append(self._row(event))
+                if len(page) >= self.page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def close(self):
+        """Stop the threads fetching events."""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,76 @@
+"""Metrics reported through the singer-sdk metrics logger."""
+
+from __future__ import annotations
+
+import dataclasses
+import enum
+
+from singer_sdk import metrics
+
+
+class Metric(str, enum.Enum):
+    """Metric types specific to CloudWatch."""
+
+    DEDUP_HIT_COUNT = "dedup_hit_count"
+    QUERY_COUNT = "query_count"
+    QUERY_QUEUED_DURATION = "query_queued_duration"
+    QUERY_RUNNING_DURATION = "query_running_duration"
+    QUERY_POLL_COUNT = "query_poll_count"
+    QUERY_RETRY_COUNT = "query_retry_count"
+    QUERY_CONTINUATION_COUNT = "query_continuation_count"
+    QUERY_DEADLINE_STOP_COUNT = "query_deadline_stop_count"
+    QUERY_RECORDS_MATCHED = "query_records_matched"
+    QUERY_RECORDS_SCANNED = "query_records_scanned"
+    QUERY_BYTES_SCANNED = "query_bytes_scanned"
+    RESULT_CACHE_HIT_COUNT = "result_cache_hit_count"
+    INGESTION_LAG = "ingestion_lag"
+
+
+def log_counter(logger, metric, value, tags):
+    """Log a single counter measurement."""
+    metrics.log(logger, metrics.Point("counter", metric, value, tags))
+
+
+def log_timer(logger, metric, value, tags):
+    """Log a single timer measurement in seconds."""
+    metrics.log(logger, metrics.Point("timer", metric, value, tags))
+
+
+@dataclasses.dataclass
+class QueryStats:
+    """Statistics of the Logs Insights queries run for one or more windows.
+
+    The queued time runs until the last poll that still saw the query
+    `Scheduled`, so it is a lower bound and the rest counts as running.
+    """
+
+    queries: int = 0
+    queued_s: float = 0.0
+    running_s: float = 0.0
+    polls: int = 0
+    retries: int = 0
+    continuations: int = 0
+    deadline_stops: int = 0
+    records_matched: float = 0.0
+    records_scanned: float = 0.0
+    bytes_scanned: float = 0.0
+
+    def add(self, other):
+        """Add the statistics of another query to these."""
+        for field in dataclasses.fields(self):
+            setattr(
+                self, field.name, getattr(self, field.name) + getattr(other, field.name)
+            )
+
+    def log(self, logger, tags):
+        """Log each statistic as a measurement."""
+        log_counter(logger, Metric.QUERY_COUNT, self.queries, tags)
+        log_timer(logger, Metric.QUERY_QUEUED_DURATION, round(self.queued_s, 3), tags)
+        log_timer(logger, Metric.QUERY_RUNNING_DURATION, round(self.running_s, 3), tags)
+        log_counter(logger, Metric.QUERY_POLL_COUNT, self.polls, tags)
+        log_counter(logger, Metric.QUERY_RETRY_COUNT, self.retries, tags)
+        log_counter(logger, Metric.QUERY_CONTINUATION_COUNT, self.continuations, tags)
+        log_counter(logger, Metric.QUERY_DEADLINE_STOP_COUNT, self.deadline_stops, tags)
+        log_counter(logger, Metric.QUERY_RECORDS_MATCHED, self.records_matched, tags)
+        log_counter(logger, Metric.QUERY_RECORDS_SCANNED, self.records_scanned, tags)
+        log_counter(logger, Metric.QUERY_BYTES_SCANNED, self.bytes_scanned, tags)
@@ -0,0 +1,129 @@
+"""Functions for tokenizing Logs Insights queries."""
+
+from __future__ import annotations
+
+import re
+import typing as t
+
+# A regular expression follows these operators, e.g. `like /a|b/`.
+_REGEX_OPERATOR = re.compile(r"(?:\blike|=~)\s*$", flags=re.I)
+_ALIAS = re.compile(r"(.+?)\s+as\s+(`[^`]+`|[\w@.$]+)", flags=re.I | re.S)
+_IDENTIFIER = re.compile(r"`[^`]+`|[\w@.$]+")
+# Always requested, they're the replication and primary keys.
+_KEY_FIELDS = ("@timestamp", "@ptr")
+
+
+class Field(t.NamedTuple):
+    """A field of a `fields` command and the name it's returned under."""
+
+    expression: str
+    name: str
+
+    def __str__(self):
+        """Return the field as written in a query."""
+        if self.name == self.expression:
+            return self.expression
+        return f"{self.expression} as {self.name}"
+
+
+def _split(text, separator):
+    # Separators inside quoted strings, regular expressions and parentheses
+    # don't split, e.g. `filter @message like "a | b"` or `concat(a, b)`.
+    parts = []
+    start = 0
+    quote = None
+    escaped = False
+    depth = 0
+    for i, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif quote:
+            if char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'`" or (char == "/" and _REGEX_OPERATOR.search(text, start, i)):
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(depth - 1, 0)
+        elif char == separator and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def split_commands(query):
+    """Return the commands of a query, split on the pipes between them."""
+    return _split(query, "|")
+
+
+def command_name(command):
+    """Return the lowercased keyword a command starts with."""
+    return command.split(None, 1)[0].lower() if command else ""
+
+
+def _unquote_name(name):
+    return name[1:-1] if name.startswith("`") else name
+
+
+def _parse_field(text):
+    match = _ALIAS.fullmatch(text)
+    if match:
+        return Field(match.group(1).strip(), _unquote_name(match.group(2)))
+    return Field(text, text)
+
+
+def parse_fields(query):
+    """Return the fields selected by the query's first command.
+
+    Returns None if the query doesn't start with a `fields` command.
+    """
+    first = split_commands(query)[0]
+    if command_name(first) != "fields":
+        return None
+    clause = first[len("fields") :]
+    return [_parse_field(text) for text in _split(clause, ",") if text]
+
+
+def property_name(field_name):
+    """Return the stream property a returned field is written to."""
+    return field_name[1:] if field_name.startswith("@") else field_name
+
+
+def _referenced_names(commands):
+    names = set()
+    for command in commands:
+        # Literals are blanked out so words inside them don't count.
+        unquoted = re.sub(
+            r"\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*'|/(?:[^/\\]|\\.)*/", " ", command
+        )
+        names.update(_unquote_name(name) for name in _IDENTIFIER.findall(unquoted))
+    return names
+
+
+def project_query(query, is_selected):
+    """Return the query with its `fields` command reduced to selected fields.
+
+    `is_selected` is called with the property name of each field. `@timestamp`
+    and `@ptr` are always kept, and so are aliased fields that later commands
+    refer to. Other fields are read from the log events by later commands
+    whether they're selected or not, so they don't need to be kept.
+    """
+    fields = parse_fields(query)
+    if fields is None:
+        return query
+    first, *rest = split_commands(query)
+    referenced = _referenced_names(rest)
+    kept = [
+        field
+        for field in fields
+        if field.expression in _KEY_FIELDS
+        or is_selected(property_name(field.name))
+        or (field.name != field.expression and field.name in referenced)
+    ]
+    if len(kept) == len(fields):
+        return query
+    return " | ".join([f"fields {', '.join(map(str, kept))}", *rest])
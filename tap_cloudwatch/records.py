@@ -0,0 +1,20 @@
+"""Functions for converting Logs Insights result rows into stream records."""
+
+from __future__ import annotations
+
+from tap_cloudwatch.query_parser import property_name
+
+
+def iter_records(rows):
+    """Yield a record matching the stream schema for each result row.
+
+    `@timestamp` is rewritten from the Logs Insights format, e.g.
+    `2023-02-20 06:01:57.792`, to RFC 3339 as the schema's `date-time` format
+    expects.
+    """
+    for row in rows:
+        record = {property_name(i["field"]): i["value"] for i in row}
+        timestamp = record.get("timestamp")
+        if timestamp is not None and len(timestamp) == 23 and timestamp[10] == " ":
+            record["timestamp"] = f"{timestamp[:10]}T{timestamp[11:]}Z"
+        yield record
@@ -0,0 +1,159 @@
+"""Class for caching the results of historical query windows on disk."""
+
+from __future__ import annotations
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+# Quoted strings are kept as is when normalizing a query.
+_QUOTED = re.compile(r"(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*'|`[^`]*`)")
+
+
+def normalize_query(query):
+    """Collapse the whitespace of a query outside of its quoted strings."""
+    parts = _QUOTED.split(query)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r"\s+", " ", parts[i])
+        parts[i] = re.sub(r" ?\| ?", " | ", part)
+    return "".join(parts).strip()
+
+
+def _encode_page(results):
+    # Rows repeat the same field names, so they're stored once per page and
+    # each row only holds its values. Logs Insights leaves out empty fields,
+    # which are stored as null.
+    fields: dict[str, int] = {}
+    for row in results:
+        for item in row:
+            fields.setdefault(item["field"], len(fields))
+    rows = []
+    for row in results:
+        values = [None] * len(fields)
+        for item in row:
+            values[fields[item["field"]]] = item["value"]
+        rows.append(values)
+    return json.dumps([list(fields), rows], separators=(",", ":"))
+
+
+def _decode_page(line):
+    fields, rows = json.loads(line)
+    return [
+        [
+            {"field": field, "value": value}
+            for field, value in zip(fields, values)
+            if value is not None
+        ]
+        for values in rows
+    ]
+
+
+class _EntryWriter:
+    """Write the pages of one window to a temporary file until committed."""
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self._file = tempfile.NamedTemporaryFile(
+            dir=cache.directory, suffix=".tmp", delete=False
+        )
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def add_page(self, results):
+        self._gzip.write(_encode_page(results).encode() + b"\n")
+
+    def commit(self):
+        self._gzip.close()
+        self._file.close()
+        os.replace(self._file.name, self.path)
+        self.cache.evict()
+
+    def abort(self):
+        self._gzip.close()
+        self._file.close()
+        os.unlink(self._file.name)
+
+
+class ResultCache:
+    """Cache the result pages of query windows as compressed files.
+
+    Entries are keyed by region, log group, normalized query and window.
+    Only windows that can't receive more records should be stored, so an
+    entry never goes stale and is only dropped once it's older than `ttl_s`,
+    or when the cache outgrows `max_bytes` and it's the least recently used.
+    """
+
+    def __init__(self, directory, max_bytes, ttl_s):
+        """Initialize ResultCache."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, region, log_group, query, start_ts, end_ts):
+        key = json.dumps(
+            [region, log_group, normalize_query(query), start_ts, end_ts]
+        ).encode()
+        return os.path.join(
+            self.directory, f"{hashlib.sha256(key).hexdigest()}.json.gz"
+        )
+
+    def get(self, region, log_group, query, start_ts, end_ts):
+        """Return an iterator over the cached pages of a window, or None."""
+        path = self._path(region, log_group, query, start_ts, end_ts)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        mtime = os.fstat(file.fileno()).st_mtime
+        if time.time() - mtime > self.ttl_s:
+            file.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            return None
+        # The access time orders the entries for eviction, the modification
+        # time stays the time the entry was written.
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path, (time.time(), mtime))
+        return self._read_pages(file)
+
+    @staticmethod
+    def _read_pages(file):
+        # The open file is kept, so the entry can be evicted while it's read.
+        with file, gzip.GzipFile(fileobj=file, mode="rb") as pages:
+            for line in pages:
+                yield _decode_page(line)
+
+    def writer(self, region, log_group, query, start_ts, end_ts):
+        """Return a writer storing a window's pages once it's committed."""
+        return _EntryWriter(
+            self, self._path(region, log_group, query, start_ts, end_ts)
+        )
+
+    def evict(self):
+        """Remove expired entries and the least recently used over the size cap."""
+        entries = []
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".json.gz"):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.ttl_s:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # Another run sharing the cache may have removed it already.
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
@@ -0,0 +1,155 @@
+"""Classes for holding result pages compactly until they're emitted."""
+
+from __future__ import annotations
+
+import json
+import tempfile
+import threading
+
+# Estimated bytes held per value: the list slot and the str object header.
+_VALUE_OVERHEAD = 57
+
+
+class HeldPage:
+    """A page of result rows stored as columns, in memory or in a spill file.
+
+    Rows are lists of `{"field": ..., "value": ...}` dicts as returned by
+    GetQueryResults. Each of those dicts is dropped and only the values are
+    kept, one list per field, with None where a row doesn't have the field.
+    """
+
+    __slots__ = ("_buffer", "_length", "columns", "fields", "owner", "size", "spilled")
+
+    def __init__(self, buffer, rows, owner=None):
+        """Initialize HeldPage."""
+        self._buffer = buffer
+        self._length = len(rows)
+        self.owner = owner
+        fields: dict[str, int] = {}
+        columns: list[list] = []
+        for index, row in enumerate(rows):
+            for i in row:
+                position = fields.get(i["field"])
+                if position is None:
+                    position = fields[i["field"]] = len(columns)
+                    columns.append([None] * self._length)
+                columns[position][index] = i["value"]
+        self.fields = buffer.intern_fields(tuple(fields))
+        self.columns: list[list] | None = columns
+        self.size = sum(
+            len(value) + _VALUE_OVERHEAD
+            for column in columns
+            for value in column
+            if value is not None
+        )
+        # The offset and length of the columns in the spill file.
+        self.spilled: tuple[int, int] | None = None
+
+    def __len__(self):
+        """Return the number of rows held."""
+        return self._length
+
+    def rows(self):
+        """Return the rows and release them from the buffer."""
+        columns = self._buffer.release(self)
+        fields = self.fields
+        return [
+            [
+                {"field": field, "value": value}
+                for field, value in zip(fields, values)
+                if value is not None
+            ]
+            for values in zip(*columns)
+        ]
+
+
+class RowBuffer:
+    """Hold the pages of finished queries until they're emitted.
+
+    Pages are kept as columns with one interned tuple of field names per field
+    set, so they take a fraction of the memory of the rows they came from.
+    Once the pages held in memory reach `max_bytes`, further pages are written
+    to a temporary file in `spill_dir` instead, and read back when emitted.
+    Pages are held for an owner, whose pages that are never read, e.g. when
+    a job is closed early, are released with `discard`.
+    """
+
+    def __init__(self, max_bytes=None, spill_dir=None):
+        """Initialize RowBuffer."""
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.bytes = 0
+        self.spill_count = 0
+        self._field_sets: dict[tuple, tuple] = {}
+        self._file = None
+        self._held_spilled = 0
+        self._owned: dict[object, set[HeldPage]] = {}
+        # Pages are held and released from the engine threads.
+        self._lock = threading.Lock()
+
+    def intern_fields(self, fields):
+        """Return the shared tuple equal to a page's field names."""
+        return self._field_sets.setdefault(fields, fields)
+
+    def hold(self, rows, owner=None):
+        """Return the rows as a HeldPage, spilling them if the buffer is full."""
+        page = HeldPage(self, rows, owner)
+        with self._lock:
+            if owner is not None:
+                self._owned.setdefault(owner, set()).add(page)
+            if self.max_bytes is None or self.bytes + page.size <= self.max_bytes:
+                self.bytes += page.size
+                return page
+            self._spill(page)
+        return page
+
+    def hold_pages(self, pages, owner=None):
+        """Hold every page now and return a generator of their rows."""
+        held = [self.hold(page, owner) for page in pages]
+        return (page.rows() for page in held)
+
+    def _spill(self, page):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.spill_dir)
+        data = json.dumps(page.columns, separators=(",", ":")).encode()
+        self._file.seek(0, 2)
+        page.spilled = (self._file.tell(), len(data))
+        self._file.write(data)
+        page.columns = None
+        self._held_spilled += 1
+        self.spill_count += 1
+
+    def release(self, page):
+        """Return the columns of a page and stop accounting for them."""
+        with self._lock:
+            columns = page.columns
+            if page.spilled is not None:
+                offset, length = page.spilled
+                self._file.seek(offset)
+                columns = json.loads(self._file.read(length))
+            self._drop(page)
+            return columns
+
+    def discard(self, owner):
+        """Release every page still held for an owner without reading them."""
+        with self._lock:
+            for page in list(self._owned.get(owner, ())):
+                self._drop(page)
+
+    def _drop(self, page):
+        owned = self._owned.get(page.owner)
+        if owned is not None:
+            owned.discard(page)
+            if not owned:
+                del self._owned[page.owner]
+        if page.spilled is None:
+            self.bytes -= page.size
+        else:
+            self._held_spilled -= 1
+            if not self._held_spilled:
+                # Every spilled page has been read, so the file can be reused.
+                self._file.seek(0)
+                self._file.truncate()
+        page.columns = None
+        page.spilled = None
+        page.size = 0
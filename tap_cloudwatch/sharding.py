@@ -0,0 +1,94 @@
+"""Merge the states written by the shards of a sharded backfill.
+
+Run as `python -m tap_cloudwatch.sharding STATE [STATE ...]` to print the
+merged state, which a normal incremental sync can start from.
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+
+
+def _is_complete(state):
+    shard = state["shard"]
+    if shard["end_ts"] is None:
+        return True
+    window_end = state.get("window_checkpoint", {}).get("window_end")
+    return window_end is not None and window_end >= shard["end_ts"]
+
+
+def _merge_context_states(states):
+    # Shards cover contiguous ranges in index order, so the merged bookmark
+    # only moves past a shard once it and every shard before it are done.
+    by_index = {state["shard"]["index"]: state for state in states if "shard" in state}
+    if not by_index:
+        return {}
+    count = next(iter(by_index.values()))["shard"]["count"]
+    merged: dict = {}
+    for index in range(count):
+        state = by_index.get(index)
+        if state is None:
+            break
+        if "replication_key_value" in state or "window_checkpoint" in state:
+            merged = state
+        if not _is_complete(state):
+            break
+    merged = copy.deepcopy(merged)
+    merged.pop("shard", None)
+    first = by_index.get(0, {})
+    if "starting_replication_value" in first:
+        merged["starting_replication_value"] = first["starting_replication_value"]
+    return merged
+
+
+def merge_shard_states(states):
+    """Merge the final state of every shard into a single state.
+
+    Each stream or partition is bookmarked as far as the shards have synced
+    without a gap. Shards that finished after one that didn't have to be
+    synced again by the incremental runs.
+    """
+    bookmarks: dict = {}
+    stream_ids = {
+        stream_id for state in states for stream_id in state.get("bookmarks", {})
+    }
+    for stream_id in sorted(stream_ids):
+        stream_states = [
+            state["bookmarks"][stream_id]
+            for state in states
+            if stream_id in state.get("bookmarks", {})
+        ]
+        merged = _merge_context_states(stream_states)
+        partitions: dict = {}
+        for stream_state in stream_states:
+            for partition in stream_state.get("partitions", []):
+                key = json.dumps(partition["context"], sort_keys=True)
+                partitions.setdefault(key, []).append(partition)
+        if partitions:
+            merged["partitions"] = [
+                {
+                    "context": partition_states[0]["context"],
+                    **_merge_context_states(partition_states),
+                }
+                for partition_states in partitions.values()
+            ]
+        bookmarks[stream_id] = merged
+    return {"bookmarks": bookmarks}
+
+
+def main():
+    """Print the merged state of the shard state files."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("states", nargs="+", help="The state file of each shard.")
+    args = parser.parse_args()
+    states = []
+    for path in args.states:
+        with open(path) as f:
+            states.append(json.load(f))
+    print(json.dumps(merge_shard_states(states)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from __future__ import annotations
 from singer_sdk import typing as th
 
 from tap_cloudwatch.client import CloudWatchStream
+from tap_cloudwatch.query_parser import parse_fields, property_name
 
 
 class LogStream(CloudWatchStream):
@@ -31,14 +32,27 @@ class LogStream(CloudWatchStream):
                 "timestamp", th.DateTimeType(), description="The timestamp of the log."
             )
         )
-        for prop in self.config.get("query").split("|")[0].split(","):
-            prop = prop.strip()
-            if prop.startswith("fields "):
-                prop = prop[7:].strip()
-            if prop.startswith("@"):
-                prop = prop[1:]
+        for field in parse_fields(self.stream_config["query"]) or []:
+            prop = property_name(field.name)
             if prop in ("timestamp", "ptr"):
                 continue
             # Assume string type for all fields
             properties.append(th.Property(prop, th.StringType()))
+        # Partition keys are added to each record by the SDK.
+        if self.stream_config.get("log_group_names"):
+            properties.append(
+                th.Property(
+                    "log_group_name",
+                    th.StringType(),
+                    description="The log group the record was queried from.",
+                )
+            )
+        if self.config.get("aws_region_names"):
+            properties.append(
+                th.Property(
+                    "aws_region_name",
+                    th.StringType(),
+                    description="The AWS region the record was queried from.",
+                )
+            )
         return th.PropertiesList(*properties).to_dict()
@@ -5,14 +5,20 @@ from __future__ import annotations
 import logging
 import time
 from datetime import datetime
+from math import ceil
 
 import pytz
+from botocore.exceptions import ClientError
+
+from tap_cloudwatch.metrics import QueryStats
+from tap_cloudwatch.row_buffer import HeldPage
+from tap_cloudwatch.throttling import PollTimer
 
 
 class Subquery:
     """Subquery managing a Subquery."""
 
-    def __init__(self, client, start_ts, end_ts, log_group, query):
+    def __init__(self, client, start_ts, end_ts, log_group, query, poll_timer=None):
         """Initialize Subquery."""
         self.logger = logging.getLogger(__name__)
         self.client = client
@@ -22,6 +28,24 @@ class Subquery:
         self.query = self._alter_query(query)
         self.query_id = None
         self.limit = 10000
+        self.window = (start_ts, end_ts)
+        self.records_matched = None
+        self._response = None
+        self._retry = True
+        self.poll_timer = poll_timer or PollTimer()
+        self.started_at = None
+        self.poll_delay = self.poll_timer.min_delay_s
+        self.next_poll_at = 0.0
+        self.stats = QueryStats(queries=1)
+        self._queued_until = None
+        self._prev_start = None
+        self.deadline_at = None
+        # Set once the query was stopped at its deadline twice, so the
+        # window can be split instead.
+        self.timed_out = False
+        self._resubmitted = False
+        # Set once a timed out query is run to the end without a deadline.
+        self._run_to_end = False
 
     def execute(self):
         """Run the query."""
@@ -38,71 +62,298 @@ class Subquery:
             limit=self.limit,
         )
         self.query_id = start_query_response["queryId"]
+        self.started_at = time.monotonic()
+        self._queued_until = self.started_at
+        self.deadline_at = None
+        deadline_s = self.poll_timer.deadline_s()
+        if deadline_s is not None and not self._run_to_end:
+            self.deadline_at = self.started_at + deadline_s
+        self._schedule_poll(self.poll_timer.first_delay())
         return self
 
-    def get_results(self, prev_start=None):
-        """Get results from query and recurse if needed."""
-        self.logger.info(
-            "Retrieving results for batch from:"
-            f" `{datetime.utcfromtimestamp(self.start_ts).isoformat()} UTC` -"
-            f" `{datetime.utcfromtimestamp(self.end_ts).isoformat()} UTC`"
-        )
-        response = None
-        retry = True
-        first = True
-        while response is None or response["status"] != "Complete":
-            if not first:
-                time.sleep(0.5)
-            first = False
-            response = self.client.get_query_results(queryId=self.query_id)
-            status = response["status"]
-            if status in ("Failed", "Cancelled", "Timeout"):
-                # Retry the query
-                if retry:
-                    self.logger.info(f"Status: {status}. Retrying...")
-                    self.execute()
-                    retry = False
-                else:
-                    break
-            if status in ("Scheduled", "Unknown"):
-                self.logger.info(f"Status: {status}, continuing to poll.")
+    def _schedule_poll(self, delay):
+        self.poll_delay = delay
+        self.next_poll_at = time.monotonic() + delay
+
+    def poll(self):
+        """Check the query status once and return True when it has finished."""
+        response = self.client.get_query_results(queryId=self.query_id)
+        self.stats.polls += 1
+        status = response["status"]
+        if status == "Scheduled":
+            self._queued_until = time.monotonic()
+        if status in ("Failed", "Cancelled", "Timeout", "Complete"):
+            self._record_execution(response)
+        if status in ("Failed", "Cancelled", "Timeout"):
+            # Retry the query
+            if self._retry:
+                self.logger.info(f"Status: {status}. Retrying...")
+                self.stats.retries += 1
+                self.execute()
+                self._retry = False
+                return False
+            self._response = response
+            return True
+        if status == "Complete":
+            if self.started_at is not None:
+                self.poll_timer.observe(time.monotonic() - self.started_at)
+            # Set as soon as the query finishes, so the window planner can
+            # observe it before the pages are read.
+            self._record_matched(response)
+            self._response = response
+            return True
+        if self.deadline_at is not None and time.monotonic() >= self.deadline_at:
+            return self._stop_at_deadline(status)
+        if status in ("Scheduled", "Unknown"):
+            self.logger.info(f"Status: {status}, continuing to poll.")
+        self._schedule_poll(self.poll_timer.next_delay(self.poll_delay))
+        return False
+
+    def _stop_at_deadline(self, status):
+        # The query may have finished since it was polled, which is fine.
+        try:
+            self.client.stop_query(queryId=self.query_id)
+        except ClientError as e:
+            self.logger.info(f"Query {self.query_id} wasn't stopped: {e}")
+        self.stats.deadline_stops += 1
+        if self._resubmitted:
+            self.logger.info(
+                f"Status: {status} past the deadline again. Stopped the query."
+            )
+            self.timed_out = True
+            return True
+        self.logger.info(f"Status: {status} past the deadline. Resubmitting...")
+        self._resubmitted = True
+        self.execute()
+        return False
+
+    def _record_execution(self, response):
+        if self.started_at is None:
+            return
+        now = time.monotonic()
+        self.stats.queued_s += self._queued_until - self.started_at
+        self.stats.running_s += now - self._queued_until
+        statistics = response.get("statistics", {})
+        self.stats.records_scanned += statistics.get("recordsScanned", 0)
+        self.stats.bytes_scanned += statistics.get("bytesScanned", 0)
+
+    def _record_matched(self, response):
+        if self.records_matched is None:
+            # The first response covers the whole window.
+            self.records_matched = response.get("statistics", {}).get("recordsMatched")
+            self.stats.records_matched = self.records_matched or 0
+
+    def _wait_for_response(self):
+        while self._response is None:
+            if self.timed_out:
+                # Nothing split the window, e.g. it's a continuation, so it's
+                # run once more to the end.
+                self.timed_out = False
+                self._run_to_end = True
+                self.execute()
+            wait = self.next_poll_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.poll()
+        response, self._response = self._response, None
+        if isinstance(response.get("results"), HeldPage):
+            response["results"] = response["results"].rows()
 
         if (
             response.get("ResponseMetadata", {}).get("HTTPStatusCode") != 200
             or response["status"] != "Complete"
         ):
             raise Exception(f"Failed: {response}")
-        result_size = response.get("statistics", {}).get("recordsMatched")
+        self._record_matched(response)
+        return response
+
+    def can_split(self):
+        """Return True if the query was stopped and its window can be split."""
+        return self.timed_out and self.end_ts > self.start_ts
+
+    def is_oversized(self):
+        """Return True if the finished query matched more records than the limit."""
+        if self._response is None or self._response["status"] != "Complete":
+            return False
+        result_size = self._response.get("statistics", {}).get("recordsMatched", 0)
+        return result_size > self.limit and self.end_ts > self.start_ts
+
+    def split(self, target_fill):
+        """Split the remainder of an oversized window into sub-windows.
+
+        Returns the results received up to the last second they reach and the
+        sub-windows covering the rest of the window, each sized to hold about
+        `target_fill` of the limit. A window whose query was stopped at its
+        deadline is split in half instead.
+        """
+        if self.timed_out:
+            middle = (self.start_ts + self.end_ts) // 2
+            self.logger.info("Query timed out. Splitting into 2 sub-batches...")
+            return [], [(self.start_ts, middle), (middle + 1, self.end_ts)]
+        response = self._wait_for_response()
         results = response["results"]
+        last_ts = self._record_ts(results[-1])
+        # Records from the last second may be incomplete, so they are left
+        # for the first sub-window.
+        while results and self._record_ts(results[-1]) == last_ts:
+            results.pop()
+        remaining = response["statistics"]["recordsMatched"] - len(results)
+        span = self.end_ts - last_ts + 1
+        count = max(1, min(span, ceil(remaining / (self.limit * target_fill))))
+        self.logger.info(
+            f"Result set size '{int(response['statistics']['recordsMatched'])}' "
+            f"exceeded limit '{self.limit}'. Splitting into {count} sub-batches..."
+        )
+        windows = [
+            (last_ts + (i * span) // count, last_ts + ((i + 1) * span) // count - 1)
+            for i in range(count)
+        ]
+        return results, windows
+
+    def take_page(self):
+        """Return the finished query's response and whether it exceeded the limit.
+
+        The window has to be continued with `_handle_limit_exceeded` when it
+        did.
+        """
+        response = self._wait_for_response()
+        result_size = response.get("statistics", {}).get("recordsMatched")
         self.logger.info(f"Result set size '{int(result_size)}' received.")
-        if result_size > self.limit:
-            if prev_start == self.start_ts:
-                raise Exception(
-                    "Stuck in a loop, smaller batch still exceeds limit."
-                    "Reduce batch window."
-                )
-            self.logger.info(
-                f"Result set size '{int(result_size)}' exceeded limit "
-                f"'{self.limit}'. Re-running sub-batch..."
+        if result_size <= self.limit:
+            return response, False
+        if self._prev_start == self.start_ts:
+            raise Exception(
+                "Stuck in a loop, smaller batch still exceeds limit."
+                "Reduce batch window."
             )
-            results += self._handle_limit_exceeded(response)
-        return results
+        self.logger.info(
+            f"Result set size '{int(result_size)}' exceeded limit "
+            f"'{self.limit}'. Re-running sub-batch..."
+        )
+        self._prev_start = self.start_ts
+        return response, True
+
+    def iter_results(self):
+        """Yield each page of results as it arrives, continuing if needed.
+
+        A window over the limit is continued from the latest record received.
+        The continuation is submitted before the page is yielded so it runs
+        while the page is consumed, and only one page is held at a time.
+        """
+        self.logger.info(
+            "Retrieving results for batch from:"
+            f" `{datetime.utcfromtimestamp(self.start_ts).isoformat()} UTC` -"
+            f" `{datetime.utcfromtimestamp(self.end_ts).isoformat()} UTC`"
+        )
+        while True:
+            response, exceeded = self.take_page()
+            if not exceeded:
+                yield response["results"]
+                return
+            self._handle_limit_exceeded(response)
+            yield response["results"]
+
+    def get_results(self):
+        """Get all results from the query as a single list."""
+        return [record for page in self.iter_results() for record in page]
+
+    def hold_results(self, row_buffer, owner=None):
+        """Move a finished query's results into the buffer until they're read."""
+        if self._response is not None and "results" in self._response:
+            self._response["results"] = row_buffer.hold(
+                self._response["results"], owner
+            )
+
+    def buffered_rows(self):
+        """Return the number of rows held from a finished query's response."""
+        if self._response is None:
+            return 0
+        return len(self._response.get("results", []))
+
+    @staticmethod
+    def _parse_ts(ts_str):
+        return int(datetime.fromisoformat(ts_str).replace(tzinfo=pytz.UTC).timestamp())
+
+    @classmethod
+    def _record_ts(cls, record):
+        ts_str = [i["value"] for i in record if i["field"] == "@timestamp"][0]
+        return cls._parse_ts(ts_str)
 
     def _handle_limit_exceeded(self, response):
         results = response.get("results")
         last_record = results[-1]
 
-        latest_ts_str = [i["value"] for i in last_record if i["field"] == "@timestamp"][
-            0
-        ]
         # Include latest ts in query, this could cause duplicates but
         # without it we might miss ties
-        self.start_ts = int(
-            datetime.fromisoformat(latest_ts_str).replace(tzinfo=pytz.UTC).timestamp()
-        )
+        self.start_ts = self._record_ts(last_record)
+        self._retry = True
+        # The continuation is a new query, so it gets its own deadlines.
+        self._resubmitted = False
+        self._run_to_end = False
+        self.stats.continuations += 1
         self.execute()
-        return self.get_results()
 
     def _alter_query(self, query):
         query += " | sort @timestamp asc"
         return query
+
+
+class HistogramSubquery(Subquery):
+    """Subquery counting the records a query matches per time bin."""
+
+    def __init__(
+        self, client, start_ts, end_ts, log_group, query, bin_s, poll_timer=None
+    ):
+        """Initialize HistogramSubquery."""
+        self.bin_s = bin_s
+        super().__init__(
+            client, start_ts, end_ts, log_group, query, poll_timer=poll_timer
+        )
+
+    def _alter_query(self, query):
+        query += f" | stats count(*) as records by bin({self.bin_s}s)"
+        return query
+
+    def get_bins(self):
+        """Return the start and record count of each non-empty bin in time order."""
+        response = self._wait_for_response()
+        bins = []
+        for record in response["results"]:
+            fields = {i["field"]: i["value"] for i in record}
+            bin_start = next(v for k, v in fields.items() if k.startswith("bin("))
+            bins.append((self._parse_ts(bin_start), int(fields["records"])))
+        return sorted(bins)
+
+
+class LagSubquery(Subquery):
+    """Subquery measuring how long after their timestamp events are ingested."""
+
+    def __init__(
+        self, client, start_ts, end_ts, log_group, percentile, poll_timer=None
+    ):
+        """Initialize LagSubquery.
+
+        The lag at `percentile` is measured, with 100 taking the largest.
+        """
+        self.percentile = percentile
+        super().__init__(client, start_ts, end_ts, log_group, "", poll_timer=poll_timer)
+
+    def _alter_query(self, query):
+        if self.percentile >= 100:
+            lag = "max(lag)"
+        else:
+            lag = f"pct(lag, {self.percentile})"
+        return (
+            "fields @ingestionTime - @timestamp as lag"
+            f" | stats {lag} as lag_ms, count(*) as events"
+        )
+
+    def get_lag_s(self):
+        """Return the lag in seconds, or None when no events were ingested."""
+        response = self._wait_for_response()
+        if not response["results"]:
+            return None
+        fields = {i["field"]: i["value"] for i in response["results"][0]}
+        if not float(fields.get("events", 0)):
+            return None
+        return max(0.0, float(fields["lag_ms"]) / 1000)
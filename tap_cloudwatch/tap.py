@@ -5,6 +5,9 @@ from __future__ import annotations
 from singer_sdk import Stream, Tap
 from singer_sdk import typing as th
 
+from tap_cloudwatch.client_factory import ClientFactory
+from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.exception import InvalidConfigException
 from tap_cloudwatch.streams import LogStream
 
 STREAM_TYPES = [
@@ -16,6 +19,8 @@ class TapCloudWatch(Tap):
     """CloudWatch tap for extracting log data from AWS Cloudwatch Logs Insights API."""
 
     name = "tap-cloudwatch"
+    # Shared by every stream so their queries are scheduled together.
+    cloudwatch_api: CloudwatchAPI | None = None
 
     config_jsonschema = th.PropertiesList(
         th.Property(
@@ -47,6 +52,54 @@ class TapCloudWatch(Tap):
                 "configured and accessible."
             ),
         ),
+        th.Property(
+            "aws_role_arn",
+            th.StringType,
+            description=(
+                "The ARN of a role to assume with the configured credentials. The "
+                "role credentials are refreshed before they expire."
+            ),
+        ),
+        th.Property(
+            "aws_role_external_id",
+            th.StringType,
+            secret=True,
+            description="The external ID the role's trust policy requires, if any.",
+        ),
+        th.Property(
+            "aws_role_session_name",
+            th.StringType,
+            default="tap-cloudwatch",  # type: ignore
+            description="The session name the role is assumed with.",
+        ),
+        th.Property(
+            "aws_role_duration_s",
+            th.IntegerType,
+            default=3600,  # type: ignore
+            description="How long each set of role credentials is valid for.",
+        ),
+        th.Property(
+            "aws_max_attempts",
+            th.IntegerType,
+            default=5,  # type: ignore
+            description=(
+                "The maximum attempts botocore makes for each request, retrying "
+                "connection errors and 5xx responses. Throttled requests are "
+                "retried by the tap within the rate limits instead."
+            ),
+        ),
+        th.Property(
+            "aws_connect_timeout_s",
+            th.NumberType,
+            default=10,  # type: ignore
+            description="The timeout for opening a connection to AWS.",
+        ),
+        th.Property(
+            "aws_read_timeout_s",
+            th.NumberType,
+            default=60,  # type: ignore
+            description="The timeout for reading an AWS response.",
+        ),
         th.Property(
             "aws_endpoint_url",
             th.StringType,
@@ -73,20 +126,157 @@ class TapCloudWatch(Tap):
                 " 5 mins."
             ),
         ),
+        th.Property(
+            "adaptive_end_lag",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "Instead of a fixed buffer, end the windows of each log group "
+                "its measured ingestion lag plus `end_lag_margin_s` before now. "
+                "The lag is measured from `@ingestionTime` and `@timestamp` of the "
+                "events ingested in the last `end_lag_probe_s` seconds. A log group "
+                "without events in that range keeps its last measured lag, or "
+                "waits `end_lag_probe_s` plus the margin."
+            ),
+        ),
+        th.Property(
+            "end_lag_percentile",
+            th.NumberType,
+            default=100,  # type: ignore
+            description=(
+                "The percentile of the ingestion lags measured that is used. The "
+                "default of 100 uses the largest lag."
+            ),
+        ),
+        th.Property(
+            "end_lag_margin_s",
+            th.IntegerType,
+            default=30,  # type: ignore
+            description="Seconds added to the measured ingestion lag.",
+        ),
+        th.Property(
+            "end_lag_probe_s",
+            th.IntegerType,
+            default=3600,  # type: ignore
+            description=(
+                "How many seconds of recent events the ingestion lag is measured "
+                "from. It's measured again after as long."
+            ),
+        ),
+        th.Property(
+            "follow",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "Keep running after catching up, querying the log group every "
+                "`follow_poll_s` seconds for the records that arrived since. "
+                "Windows end `follow_lag_s` before now instead of 5 minutes. "
+                "Can't be used with `log_group_names`, `aws_region_names` or "
+                "more than one of `queries`."
+            ),
+        ),
+        th.Property(
+            "follow_poll_s",
+            th.NumberType,
+            default=5,  # type: ignore
+            description="How often new records are queried for while following.",
+        ),
+        th.Property(
+            "follow_lag_s",
+            th.IntegerType,
+            default=5,  # type: ignore
+            description="How many seconds before now the windows end while following.",
+        ),
+        th.Property(
+            "follow_overlap_s",
+            th.IntegerType,
+            default=60,  # type: ignore
+            description=(
+                "How many seconds before the end of the last window each poll "
+                "starts from, to pick up records ingested late. Records already "
+                "emitted are dropped by their `ptr`."
+            ),
+        ),
+        th.Property(
+            "follow_duration_s",
+            th.NumberType,
+            description=(
+                "Stop following after this many seconds. Runs until stopped by default."
+            ),
+        ),
         th.Property(
             "log_group_name",
             th.StringType,
-            required=True,
-            description="The log group on which to perform the query.",
+            description=(
+                "The log group on which to perform the query. Required unless "
+                "`log_group_names` is set."
+            ),
+        ),
+        th.Property(
+            "log_group_names",
+            th.ArrayType(th.StringType),
+            description=(
+                "A list of log groups on which to perform the query. Each one is "
+                "synced as a stream partition with its own bookmark, and all of "
+                "them share the same concurrent query budget."
+            ),
+        ),
+        th.Property(
+            "aws_region_names",
+            th.ArrayType(th.StringType),
+            description=(
+                "A list of AWS regions to query `log_group_name` or "
+                "`log_group_names` in. Each log group and region pair is synced as "
+                "its own partition."
+            ),
         ),
         th.Property(
             "query",
             th.StringType,
-            required=True,
             description=(
                 "The query string to use. For more information, see [CloudWatch"
                 " Logs Insights Query Syntax](https://docs.aws.amazon.com/Amazon"
-                "CloudWatch/latest/logs/CWL_QuerySyntax.html)."
+                "CloudWatch/latest/logs/CWL_QuerySyntax.html). Required unless "
+                "`queries` is set."
+            ),
+        ),
+        th.Property(
+            "queries",
+            th.ArrayType(
+                th.ObjectType(
+                    th.Property(
+                        "name",
+                        th.StringType,
+                        required=True,
+                        description="The name of the stream.",
+                    ),
+                    th.Property(
+                        "query",
+                        th.StringType,
+                        required=True,
+                        description="The query string to use.",
+                    ),
+                    th.Property(
+                        "log_group_name",
+                        th.StringType,
+                        description="The log group to query instead of the tap's.",
+                    ),
+                    th.Property(
+                        "log_group_names",
+                        th.ArrayType(th.StringType),
+                        description="The log groups to query instead of the tap's.",
+                    ),
+                    th.Property(
+                        "batch_increment_s",
+                        th.IntegerType,
+                        description="The batch increment to use instead of the tap's.",
+                    ),
+                )
+            ),
+            description=(
+                "Named queries, each synced as its own stream with its own schema "
+                "and bookmarks. The queries of every stream share the concurrent "
+                "query slots. Replaces `query`."
             ),
         ),
         th.Property(
@@ -107,11 +297,271 @@ class TapCloudWatch(Tap):
                 "avoid exceeding the 10k limit."
             ),
         ),
+        th.Property(
+            "max_buffered_rows",
+            th.IntegerType,
+            default=200000,  # type: ignore
+            description=(
+                "The maximum number of result rows held from finished queries "
+                "that are waiting for earlier windows to be emitted. Once reached"
+                " no new queries are submitted and only the query holding up the "
+                "output is polled, so memory stays flat on long backfills."
+            ),
+        ),
+        th.Property(
+            "query_deadline_factor",
+            th.NumberType,
+            default=3,  # type: ignore
+            description=(
+                "A query still running after this many times the "
+                "`query_deadline_percentile` of recent query durations is stopped "
+                "and resubmitted. If it misses its deadline again it's stopped and "
+                "its window split in half. Set to 0 to only use `query_timeout_s`."
+            ),
+        ),
+        th.Property(
+            "query_deadline_percentile",
+            th.NumberType,
+            default=95,  # type: ignore
+            description=(
+                "The percentile of recent query durations deadlines are based on."
+            ),
+        ),
+        th.Property(
+            "query_deadline_min_s",
+            th.NumberType,
+            default=120,  # type: ignore
+            description="The shortest deadline a query is given.",
+        ),
+        th.Property(
+            "query_timeout_s",
+            th.NumberType,
+            default=1800,  # type: ignore
+            description=(
+                "The longest deadline a query is given, also used until enough "
+                "queries have completed to base deadlines on."
+            ),
+        ),
+        th.Property(
+            "max_buffered_mb",
+            th.IntegerType,
+            default=256,  # type: ignore
+            description=(
+                "The memory budget, in MB, for result rows held from finished "
+                "queries. Rows are held as compact columns, and pages received "
+                "once the budget is used up are spilled to a temporary file "
+                "until they're emitted."
+            ),
+        ),
+        th.Property(
+            "buffer_spill_dir",
+            th.StringType,
+            description=(
+                "The directory result pages are spilled to once `max_buffered_mb`"
+                " is used up. Defaults to the system temporary directory."
+            ),
+        ),
+        th.Property(
+            "start_query_rate_limit",
+            th.NumberType,
+            default=5,  # type: ignore
+            description=(
+                "The maximum StartQuery requests per second, shared by every "
+                "query the tap runs. Default 5, the AWS default quota."
+            ),
+        ),
+        th.Property(
+            "get_query_results_rate_limit",
+            th.NumberType,
+            default=5,  # type: ignore
+            description=(
+                "The maximum GetQueryResults requests per second, shared by every"
+                " query the tap polls. Default 5, the AWS default quota."
+            ),
+        ),
+        th.Property(
+            "filter_log_events",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "Read queries that only select event fields, i.e. `@timestamp`, "
+                "`@message`, `@logStream`, `@ingestionTime` and `@ptr`, and "
+                "optionally filter `@message` or `@logStream` with `like` or `=`, "
+                "using FilterLogEvents instead of Logs Insights. The log streams "
+                "are read in parallel and merged in timestamp order, so there is "
+                "no query queueing, 10k result limit or rescanning. The `ptr` "
+                "primary key of these records is the event ID rather than the Logs "
+                "Insights `@ptr`, so changing this setting on a synced stream "
+                "duplicates its records in the target."
+            ),
+        ),
+        th.Property(
+            "filter_log_events_rate_limit",
+            th.NumberType,
+            default=5,  # type: ignore
+            description=(
+                "The maximum FilterLogEvents requests per second. Default 5, the "
+                "AWS default quota."
+            ),
+        ),
+        th.Property(
+            "export_bucket",
+            th.StringType,
+            description=(
+                "An S3 bucket to export historical ranges to with CreateExportTask. "
+                "Records older than `export_tail_s` are read from the exported "
+                "objects and the rest are queried. Only queries that select "
+                "`@timestamp`, `@message`, `@logStream` and `@ptr`, optionally "
+                "filtering `@message` or `@logStream` with `like` or `=`, are "
+                "exported. The bucket has to be in the log group's region and allow "
+                "CloudWatch Logs to write to it."
+            ),
+        ),
+        th.Property(
+            "export_prefix",
+            th.StringType,
+            default="tap-cloudwatch",  # type: ignore
+            description="The key prefix export tasks write their objects under.",
+        ),
+        th.Property(
+            "export_tail_s",
+            th.IntegerType,
+            default=86400,  # type: ignore
+            description=(
+                "Only export records older than this many seconds, default 86,400 "
+                "(i.e. 1 day). Newer records are queried."
+            ),
+        ),
+        th.Property(
+            "export_s3_endpoint_url",
+            th.StringType,
+            description=(
+                "The complete URL to use for the constructed S3 client reading "
+                "exported objects. Normally not needed."
+            ),
+        ),
+        th.Property(
+            "query_engine",
+            th.StringType,
+            default="sync",  # type: ignore
+            allowed_values=["sync", "async"],  # type: ignore
+            description=(
+                "The engine running the queries. `async` runs submitting, "
+                "polling and fetching results as asyncio tasks in a background "
+                "thread, so they overlap with the records being transformed."
+            ),
+        ),
+        th.Property(
+            "split_oversized_windows",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "When a batch window matches more than the 10k limit, keep the "
+                "results received and split the rest of the window into "
+                "sub-windows sized from `recordsMatched`. The sub-windows are "
+                "queried concurrently instead of re-running the window serially "
+                "from the latest record received."
+            ),
+        ),
+        th.Property(
+            "histogram_planning",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "Before extracting records, run one `stats count(*) by bin(...)` "
+                "query over the whole range and plan batch windows from it, so "
+                "each one stays under the 10k limit and ranges without records "
+                "are skipped. The planned windows are logged. Takes precedence "
+                "over `batch_increment_s` and `adaptive_batch_window`."
+            ),
+        ),
+        th.Property(
+            "adaptive_batch_window",
+            th.BooleanType,
+            default=False,  # type: ignore
+            description=(
+                "Size each batch window from the `recordsMatched` statistics of "
+                "the windows that just completed instead of using a fixed "
+                "`batch_increment_s`. The records per second estimate is saved "
+                "in the stream state per log group so the next run starts with "
+                "a well sized window."
+            ),
+        ),
+        th.Property(
+            "adaptive_target_fill",
+            th.NumberType,
+            default=0.7,  # type: ignore
+            description=(
+                "The fraction of the 10k result limit that adaptive, histogram "
+                "planned and split windows aim to fill, default 0.7."
+            ),
+        ),
+        th.Property(
+            "result_cache_dir",
+            th.StringType,
+            description=(
+                "A directory to cache the results of batch windows in. Windows "
+                "ending before the 5 minute buffer from realtime can't change, so "
+                "their results are stored compressed and read from the cache "
+                "instead of being queried again when a later run covers the same "
+                "window. Disabled when not set."
+            ),
+        ),
+        th.Property(
+            "result_cache_max_mb",
+            th.IntegerType,
+            default=1024,  # type: ignore
+            description=(
+                "The maximum size of the result cache. The least recently read "
+                "windows are evicted once it's exceeded."
+            ),
+        ),
+        th.Property(
+            "result_cache_ttl_s",
+            th.IntegerType,
+            default=604800,  # type: ignore
+            description=(
+                "How long cached results are kept, default 604,800 seconds "
+                "(i.e. 7 days)."
+            ),
+        ),
+        th.Property(
+            "shard_count",
+            th.IntegerType,
+            default=1,  # type: ignore
+            description=(
+                "The number of shards a backfill is split into. Each shard syncs "
+                "a separate, contiguous slice of the `batch_increment_s` windows "
+                "from `start_date` to `end_date` and writes its own state, so "
+                "several workers can run at once. `end_date` must be set."
+            ),
+        ),
+        th.Property(
+            "shard_index",
+            th.IntegerType,
+            default=0,  # type: ignore
+            description="The shard this worker syncs, from 0 to `shard_count` - 1.",
+        ),
     ).to_dict()
 
+    @property
+    def client_factory(self) -> ClientFactory:
+        """The factory of the AWS clients shared by every stream."""
+        if getattr(self, "_client_factory", None) is None:
+            self._client_factory = ClientFactory(self.config)
+        return self._client_factory
+
     def discover_streams(self) -> list[Stream]:
         """Return a list of discovered streams."""
-        return [stream_class(tap=self) for stream_class in STREAM_TYPES]
+        queries = self.config.get("queries")
+        if not queries:
+            if not self.config.get("query"):
+                raise InvalidConfigException("Either `query` or `queries` must be set")
+            return [stream_class(tap=self) for stream_class in STREAM_TYPES]
+        return [
+            LogStream(tap=self, name=query_config["name"], query_config=query_config)
+            for query_config in queries
+        ]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+"""Classes for rate limiting and pacing requests to the Cloudwatch API."""
+
+from __future__ import annotations
+
+import functools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from math import ceil
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERROR_CODES = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    # Raised by StartQuery when the account's concurrent query limit is reached.
+    "LimitExceededException",
+)
+
+FINISHED_QUERY_STATUSES = ("Complete", "Failed", "Cancelled", "Timeout")
+
+
+class TokenBucket:
+    """Thread safe token bucket shared by every caller of an API operation."""
+
+    def __init__(self, rate, capacity=None):
+        """Initialize TokenBucket with a rate in requests per second."""
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until the bucket has refilled enough for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Tokens are reserved up front so concurrent callers queue up
+            # behind each other instead of all waking at once.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PollTimer:
+    """Per-query poll delays and deadlines adapting to observed query durations.
+
+    A query's deadline is `deadline_factor` times the `deadline_percentile`
+    of the durations of recently completed queries, and at least
+    `min_deadline_s`. Until `min_samples` queries have completed, or without
+    a `deadline_factor`, it's `max_deadline_s`, which also caps it.
+    """
+
+    def __init__(
+        self,
+        min_delay_s=0.5,
+        max_delay_s=5.0,
+        backoff=1.5,
+        smoothing=0.3,
+        deadline_factor=None,
+        deadline_percentile=95,
+        min_deadline_s=120.0,
+        max_deadline_s=None,
+        min_samples=10,
+    ):
+        """Initialize PollTimer."""
+        self.min_delay_s = min_delay_s
+        self.max_delay_s = max_delay_s
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.expected_duration_s = None
+        self.deadline_factor = deadline_factor
+        self.deadline_percentile = deadline_percentile
+        self.min_deadline_s = min_deadline_s
+        self.max_deadline_s = max_deadline_s
+        self.min_samples = min_samples
+        self._durations: deque[float] = deque(maxlen=200)
+        self._lock = threading.Lock()
+
+    def _clamp(self, delay):
+        return max(self.min_delay_s, min(delay, self.max_delay_s))
+
+    def first_delay(self):
+        """Return the delay before a newly submitted query is first polled."""
+        if self.expected_duration_s is None:
+            return self.min_delay_s
+        # Aim slightly early so quick queries aren't overslept.
+        return self._clamp(self.expected_duration_s * 0.8)
+
+    def next_delay(self, previous_delay):
+        """Return the delay before polling a query that is still running."""
+        return self._clamp(previous_delay * self.backoff)
+
+    def deadline_s(self):
+        """Return how long a query may take before it's stopped, None if forever."""
+        with self._lock:
+            durations = sorted(self._durations)
+        if not self.deadline_factor or len(durations) < self.min_samples:
+            return self.max_deadline_s
+        index = ceil(len(durations) * self.deadline_percentile / 100) - 1
+        deadline = max(
+            self.min_deadline_s, self.deadline_factor * durations[max(index, 0)]
+        )
+        if self.max_deadline_s is None:
+            return deadline
+        return min(deadline, self.max_deadline_s)
+
+    def observe(self, duration_s):
+        """Update the expected duration from a completed query."""
+        with self._lock:
+            self._durations.append(duration_s)
+        if self.expected_duration_s is None:
+            self.expected_duration_s = duration_s
+        else:
+            self.expected_duration_s = (
+                self.smoothing * duration_s
+                + (1 - self.smoothing) * self.expected_duration_s
+            )
+
+
+class RateLimitedClient:
+    """Wrap a logs client so API calls share rate limits and retry throttling.
+
+    The queries started through it are tracked until they finish, so the ones
+    still running can be stopped when the sync is interrupted.
+    """
+
+    def __init__(self, client, limiters, max_retries=8, base_delay_s=0.5):
+        """Initialize RateLimitedClient.
+
+        The limiters map client method names, e.g. `start_query`, to the
+        TokenBucket every call to that method has to take a token from.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._client = client
+        self.limiters = limiters
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = 30
+        self.running_queries: set[str] = set()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """Pass through to the wrapped client, pacing its API operations."""
+        attr = getattr(self._client, name)
+        operations = getattr(
+            getattr(self._client, "meta", None), "method_to_api_mapping", {}
+        )
+        if name not in operations and name not in self.limiters:
+            return attr
+        return functools.partial(self._call, name)
+
+    def _call(self, operation, **kwargs):
+        limiter = self.limiters.get(operation)
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.acquire()
+            try:
+                response = getattr(self._client, operation)(**kwargs)
+                self._track_query(operation, kwargs, response)
+                return response
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in THROTTLING_ERROR_CODES or attempt >= self.max_retries:
+                    raise
+                # Full jitter so retries from concurrent queries spread out.
+                delay = random.uniform(
+                    0, min(self.max_delay_s, self.base_delay_s * 2**attempt)
+                )
+                self.logger.info(
+                    f"{operation} throttled with {code}, retrying in {delay:.2f}s..."
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def _track_query(self, operation, kwargs, response):
+        with self._lock:
+            if operation == "start_query":
+                self.running_queries.add(response["queryId"])
+            elif operation == "stop_query" or (
+                operation == "get_query_results"
+                and response.get("status") in FINISHED_QUERY_STATUSES
+            ):
+                self.running_queries.discard(kwargs["queryId"])
+
+    def stop_queries(self):
+        """Stop every query started through this client that is still running."""
+        with self._lock:
+            query_ids = list(self.running_queries)
+        for query_id in query_ids:
+            try:
+                self.stop_query(queryId=query_id)
+            except ClientError as e:
+                # It finished since its results were last polled.
+                self.logger.info(f"Query {query_id} wasn't stopped: {e}")
+                with self._lock:
+                    self.running_queries.discard(query_id)
+        if query_ids:
+            self.logger.info(f"Stopped {len(query_ids)} running queries.")
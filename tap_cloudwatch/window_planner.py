@@ -0,0 +1,111 @@
+"""Classes for adaptively planning query batch windows."""
+
+from __future__ import annotations
+
+from math import ceil
+
+
+class AdaptiveWindowPlanner:
+    """Plan batch windows sized from the observed density of log records."""
+
+    def __init__(
+        self,
+        batch_increment_s,
+        limit=10000,
+        target_fill=0.7,
+        density=None,
+        min_window_s=60,
+        max_window_s=86400,
+        smoothing=0.5,
+    ):
+        """Initialize AdaptiveWindowPlanner.
+
+        The density is an estimate of records per second. When no estimate is
+        available yet the first windows fall back to `batch_increment_s`.
+        """
+        self.batch_increment_s = batch_increment_s
+        self.target_records = limit * target_fill
+        self.density = density
+        self.min_window_s = min_window_s
+        self.max_window_s = max_window_s
+        self.smoothing = smoothing
+
+    def _next_window_size(self):
+        if self.density is None:
+            return self.batch_increment_s
+        if self.density <= 0:
+            return self.max_window_s
+        size = int(self.target_records / self.density)
+        return max(self.min_window_s, min(size, self.max_window_s))
+
+    def windows(self, start_time, end_time):
+        """Yield windows lazily so each one is sized from the latest estimate."""
+        query_start = int(start_time.timestamp())
+        end_ts = int(end_time.timestamp())
+        if end_ts <= query_start:
+            return
+        while True:
+            # Never exceed the end_time
+            query_end = min(query_start + self._next_window_size(), end_ts)
+            yield (query_start, query_end)
+            if query_end >= end_ts:
+                return
+            # Inclusive start and end date, so the next window skips one second.
+            query_start = query_end + 1
+
+    def observe(self, start_ts, end_ts, records_matched):
+        """Update the density estimate from a completed window."""
+        if records_matched is None:
+            return
+        observed = records_matched / max(end_ts - start_ts, 1)
+        if self.density is None:
+            self.density = observed
+        else:
+            self.density = (
+                self.smoothing * observed + (1 - self.smoothing) * self.density
+            )
+
+
+class HistogramWindowPlanner:
+    """Plan batch windows from a histogram of record counts per time bin."""
+
+    def __init__(self, limit=10000, target_fill=0.7):
+        """Initialize HistogramWindowPlanner."""
+        self.target_records = limit * target_fill
+
+    def plan(self, bins, start_ts, end_ts, bin_s):
+        """Return `(start, end, expected records)` windows covering the bins.
+
+        Neighbouring bins are merged while the window stays under the target
+        record count. Bins over the target are split evenly and ranges without
+        any records are skipped entirely.
+        """
+        windows = []
+        window = None
+        for bin_start, count in bins:
+            query_start = max(bin_start, start_ts)
+            query_end = min(bin_start + bin_s - 1, end_ts)
+            if count == 0 or query_start > query_end:
+                continue
+            if window and window[2] + count > self.target_records:
+                windows.append(tuple(window))
+                window = None
+            if count > self.target_records:
+                span = query_end - query_start + 1
+                pieces = min(span, ceil(count / self.target_records))
+                windows.extend(
+                    (
+                        query_start + (i * span) // pieces,
+                        query_start + ((i + 1) * span) // pieces - 1,
+                        count // pieces,
+                    )
+                    for i in range(pieces)
+                )
+                continue
+            if window is None:
+                window = [query_start, query_end, 0]
+            window[1] = query_end
+            window[2] += count
+        if window:
+            windows.append(tuple(window))
+        return windows
@@ -0,0 +1,117 @@
+"""Tests the asyncio query engine against the simulated backend in real time."""
+
+import logging
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from benchmarks.fake_logs import FakeLogsClient
+from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.throttling import PollTimer
+
+CONFIG = {"start_query_rate_limit": 1000, "get_query_results_rate_limit": 1000}
+
+
+def _api(engine, **config):
+    api = CloudwatchAPI(
+        logging.getLogger(__name__), {**CONFIG, "query_engine": engine, **config}
+    )
+    api.poll_timer = PollTimer(min_delay_s=0.01, max_delay_s=0.05)
+    return api
+
+
+def _fake():
+    return FakeLogsClient(
+        time, records_per_s=4, queue_s=0.01, base_latency_s=0.02, tps=1000
+    )
+
+
+def _read_job(api, fake, windows):
+    checkpoints = []
+
+    def on_checkpoint(window_end=None, continuation_ts=None):
+        checkpoints.append((window_end, continuation_ts))
+
+    api._add_job(
+        "a", fake, iter(windows), "group", "query", None, on_checkpoint=on_checkpoint
+    )
+    pages = [[row[2]["value"] for row in page] for page in api.run_query_job("a")]
+    return pages, checkpoints
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_async_engine_matches_sync(split):
+    """Pages and checkpoints arrive in the same order as with the sync engine."""
+    # 3600s windows hold 14,400 records, so every one exceeds the 10k limit.
+    windows = [(0, 3599), (3600, 7199), (7200, 10799)]
+
+    expected = _read_job(_api("sync", split_oversized_windows=split), _fake(), windows)
+    api = _api("async", split_oversized_windows=split)
+    output = _read_job(api, _fake(), windows)
+
+    assert output == expected
+    assert output[1][-1] == (10799, None)
+    assert not api._jobs
+
+
+class FailingLogsClient(FakeLogsClient):
+    """Fake client that rejects every query after the first."""
+
+    def start_query(self, **kwargs):
+        if self.calls["start_query"]:
+            raise self._error("AccessDeniedException", "start_query")
+        return super().start_query(**kwargs)
+
+
+def test_async_engine_raises_query_errors():
+    """An error in a query task is raised to the reader and stops the engine."""
+    api = _api("async")
+    fake = FailingLogsClient(time, queue_s=0.01, base_latency_s=0.02, tps=1000)
+    api._add_job("a", fake, iter([(0, 9), (10, 19)]), "group", "query", None)
+
+    with pytest.raises(ClientError, match="AccessDenied"):
+        list(api.run_query_job("a"))
+    assert api._async_engine._thread is not None
+    assert not api._async_engine._thread.is_alive()
+
+
+def test_async_engine_reads_cached_windows(tmp_path):
+    """Windows cached by the sync engine are replayed without querying."""
+    windows = [(0, 3599), (3600, 7199)]
+    config = {"result_cache_dir": str(tmp_path), "split_oversized_windows": True}
+    expected = _read_job(_api("sync", **config), _fake(), windows)
+    fake = _fake()
+
+    output = _read_job(_api("async", **config), fake, windows)
+
+    assert fake.calls["start_query"] == 0
+    assert output[0] == expected[0]
+    assert output[1] == [(3599, None), (7199, None)]
+
+
+def test_async_engine_raises_planning_errors():
+    """An error planning the next window isn't mistaken for the job's end."""
+
+    def windows():
+        yield (0, 9)
+        raise ValueError("planning failed")
+
+    api = _api("async")
+    api._add_job("a", _fake(), windows(), "group", "query", None)
+
+    with pytest.raises(ValueError, match="planning failed"):
+        list(api.run_query_job("a"))
+
+
+def test_async_engine_reads_sequential_jobs():
+    """A job added as the engine thread stops for lack of jobs starts it again."""
+    api = _api("async")
+    fake = _fake()
+
+    for job_key in range(5):
+        api._add_job(job_key, fake, iter([(0, 9)]), "group", "query", None)
+        pages = list(api.run_query_job(job_key))
+
+        assert sum(len(page) for page in pages) == 40
+    assert not api._jobs
@@ -0,0 +1,61 @@
+"""Tests the benchmarks against the simulated backend."""
+
+from benchmarks.bench_throughput import START, run_api, run_tap
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
+
+
+def _expected_records(fake, days):
+    start_ts = int(START.timestamp())
+    return fake._count(start_ts, start_ts + int(days * 86400))
+
+
+def test_run_api():
+    """Every record is read despite throttling, failures and continuations."""
+    fake = FakeLogsClient(
+        SimulatedClock(),
+        records_per_s=4,
+        throttle_rate=0.1,
+        failure_rate=0.1,
+        timeout_rate=0.1,
+    )
+
+    result = run_api(fake, 0.1, 3600, 5, trace_memory=False)
+
+    # Continuations overlap by a second, the stream drops those duplicates.
+    assert result["records"] >= _expected_records(fake, 0.1)
+    assert result["throttled"] > 0
+    assert result["elapsed_s"] > 0
+
+
+def test_run_tap():
+    """A full sync emits each record once."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4)
+
+    result = run_tap(fake, 0.05, 600, 5, trace_memory=False)
+
+    assert result["records"] == _expected_records(fake, 0.05)
+    assert result["start_query"] > 1
+
+
+def test_run_tap_batches():
+    """Each window with records is written to its own batch file."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4)
+
+    result = run_tap(fake, 0.05, 600, 5, trace_memory=False, batch=True)
+
+    assert result["records"] == _expected_records(fake, 0.05)
+    assert result["batches"] == 8
+
+
+def test_stuck_queries_stopped():
+    """Queries stuck running are stopped at their deadline and run again."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4, stuck_rate=0.2)
+
+    result = run_api(
+        fake, 0.1, 3600, 5, config={"query_timeout_s": 60}, trace_memory=False
+    )
+
+    assert result["records"] >= _expected_records(fake, 0.1)
+    assert fake.calls["stop_query"] > 0
+    now = fake.clock.monotonic()
+    assert all(q.status(now) != "Running" for q in fake._queries.values())
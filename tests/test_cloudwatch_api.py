@@ -1,12 +1,20 @@
 """Tests cloudwatch api module."""
 
+import logging
+import time
+from collections import Counter
 from contextlib import nullcontext as does_not_raise
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
 
 import pytest
 from freezegun import freeze_time
 
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
 from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
 from tap_cloudwatch.exception import InvalidQueryException
+from tap_cloudwatch.metrics import QueryStats
+from tap_cloudwatch.window_planner import AdaptiveWindowPlanner
 
 from .utils import datetime_from_str
 
@@ -106,3 +114,386 @@ def test_validate_query(query, expectation):
 def test_alter_end_ts(input_end_ts, expectation):
     api = CloudwatchAPI(None)
     assert api._alter_end_ts(input_end_ts) == expectation
+
+
+class FakeSubquery:
+    """Subquery stand-in that finishes after a scripted number of polls."""
+
+    polls_needed = {0: 3, 1: 1, 2: 1}
+    poll_log: list = []
+
+    def __init__(self, client, start_ts, end_ts, log_group, query, poll_timer=None):
+        self.start_ts = start_ts
+        self.window = (start_ts, end_ts)
+        self.records_matched = 1
+        self.polls = 0
+        self.next_poll_at = 0
+        self.stats = QueryStats(queries=1)
+
+    def execute(self):
+        return self
+
+    def poll(self):
+        self.polls += 1
+        FakeSubquery.poll_log.append(self.window[0])
+        return self.polls >= self.polls_needed[self.window[0]]
+
+    def can_split(self):
+        return False
+
+    def hold_results(self, row_buffer, owner=None):
+        pass
+
+    def buffered_rows(self):
+        return 1
+
+    def iter_results(self):
+        yield [self.window[0]]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_iterate_batches_completion_order():
+    """Slow head queries don't block harvesting, but output stays ordered."""
+    api = CloudwatchAPI(None)
+    api._client = "client"
+    FakeSubquery.poll_log = []
+
+    output = list(api._iterate_batches([(0, 0), (1, 1), (2, 2)], "group", "query"))
+
+    assert output == [[0], [1], [2]]
+    # The later windows were harvested on the first pass while 0 kept running.
+    assert FakeSubquery.poll_log == [0, 1, 2, 0, 0]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_iterate_batches_fills_freed_slots():
+    """A slot freed by a finished query is refilled before the head completes."""
+    api = CloudwatchAPI(None)
+    api._client = "client"
+    api.max_concurrent_queries = 2
+    FakeSubquery.poll_log = []
+
+    output = list(api._iterate_batches([(0, 0), (1, 1), (2, 2)], "group", "query"))
+
+    assert output == [[0], [1], [2]]
+    assert FakeSubquery.poll_log == [0, 1, 0, 2, 0]
+
+
+class FakeSplitSubquery(FakeSubquery):
+    """Subquery stand-in where the first window exceeds the limit."""
+
+    def poll(self):
+        return True
+
+    def is_oversized(self):
+        return self.window == (0, 9)
+
+    def split(self, target_fill):
+        return [[{"field": "@timestamp", "value": "0"}]], [(5, 6), (7, 9)]
+
+    def iter_results(self):
+        yield [self.window]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSplitSubquery)
+def test_iterate_batches_split_oversized():
+    """Sub-windows of a split window are emitted before the next window."""
+    api = CloudwatchAPI(None, {"split_oversized_windows": True})
+    api._client = "client"
+
+    output = list(api._iterate_batches([(0, 9), (10, 19)], "group", "query"))
+
+    assert output == [
+        [[{"field": "@timestamp", "value": "0"}]],
+        [(5, 6)],
+        [(7, 9)],
+        [(10, 19)],
+    ]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_iterate_batches_buffer_cap():
+    """Once the buffer is full only the head query is polled."""
+    api = CloudwatchAPI(None, {"max_buffered_rows": 1})
+    api._client = "client"
+    FakeSubquery.poll_log = []
+
+    output = list(api._iterate_batches([(0, 0), (1, 1), (2, 2)], "group", "query"))
+
+    assert output == [[0], [1], [2]]
+    # Window 1 fills the buffer, so window 2 waits until 0 is emitted.
+    assert FakeSubquery.poll_log == [0, 1, 0, 0, 2]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_query_jobs_share_slots():
+    """Slots the current job can't fill run the windows of later jobs."""
+    api = CloudwatchAPI(None)
+    api._client = "client"
+    api._add_job("a", "client", [(0, 0)], "group_a", "query", None)
+    api._add_job("b", "client", [(1, 1), (2, 2)], "group_b", "query", None)
+    FakeSubquery.poll_log = []
+
+    assert list(api.run_query_job("a")) == [[0]]
+    # Job b's windows were submitted and harvested while job a was running.
+    assert FakeSubquery.poll_log == [0, 1, 2, 0, 0]
+    assert list(api.run_query_job("b")) == [[1], [2]]
+    assert FakeSubquery.poll_log == [0, 1, 2, 0, 0]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_query_job_read_while_buffer_full():
+    """A job read while another job's results fill the buffer still gets windows."""
+    api = CloudwatchAPI(None, {"max_buffered_rows": 1})
+    api._client = "client"
+    api.max_concurrent_queries = 2
+    api._add_job("a", "client", [(0, 0), (1, 1)], "group_a", "query", None)
+    api._add_job("b", "client", [(2, 2)], "group_b", "query", None)
+    pages = api.run_query_job("a")
+
+    # Window 1 of job a fills the buffer before job b has any windows.
+    assert next(pages) == [0]
+    assert list(api.run_query_job("b")) == [[2]]
+    assert list(pages) == [[1]]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeSubquery)
+def test_query_stats_logged(caplog):
+    """Each query's statistics are logged and added to the run totals."""
+    api = CloudwatchAPI(None)
+    api._client = "client"
+    api._add_job("a", "client", [(0, 0), (1, 1)], "group_a", "query", None)
+
+    with caplog.at_level("INFO", logger="singer_sdk.metrics"):
+        list(api.run_query_job("a"))
+        api.log_summary({"stream": "log"})
+
+    assert api.stats.queries == 2
+    points = [r.args[0] for r in caplog.records if r.args]
+    counts = [p for p in points if p.metric == "query_count"]
+    assert [p.value for p in counts] == [1, 1, 2]
+    assert counts[0].tags == {
+        "log_group": "group_a",
+        "window_start": "1970-01-01T00:00:00",
+        "window_end": "1970-01-01T00:00:00",
+    }
+    assert counts[2].tags == {"stream": "log"}
+
+
+class FakeContinuedSubquery(FakeSubquery):
+    """Subquery stand-in where each window is continued once."""
+
+    def poll(self):
+        return True
+
+    def iter_results(self):
+        page = [self.start_ts]
+        # The continuation is submitted before the page is handed over.
+        self.start_ts += 5
+        yield page
+        yield [self.start_ts]
+
+
+@patch("tap_cloudwatch.cloudwatch_api.Subquery", FakeContinuedSubquery)
+def test_query_job_checkpoints():
+    """Checkpoints follow the windows and continuations as they are read."""
+    api = CloudwatchAPI(None)
+    api._client = "client"
+    checkpoints = []
+
+    def on_checkpoint(window_end=None, continuation_ts=None):
+        checkpoints.append((window_end, continuation_ts))
+
+    api._add_job(
+        "a",
+        "client",
+        [(0, 9), (10, 19)],
+        "group_a",
+        "query",
+        None,
+        on_checkpoint=on_checkpoint,
+    )
+    pages = api.run_query_job("a")
+
+    assert next(pages) == [0]
+    assert checkpoints == []
+    assert next(pages) == [5]
+    assert checkpoints == [(None, 5)]
+    assert list(pages) == [[10], [15]]
+    assert checkpoints == [(None, 5), (9, None), (None, 15), (19, None)]
+
+
+@pytest.mark.parametrize(
+    "index,count,expected",
+    [
+        [0, 1, (0, 36000)],
+        [0, 3, (0, 10800)],
+        [1, 3, (10801, 21600)],
+        [2, 3, (21601, 36000)],
+        [0, 12, None],
+    ],
+)
+def test_shard_range(index, count, expected):
+    """Shards take contiguous, non-overlapping slices of the windows."""
+    api = CloudwatchAPI(None)
+    start = datetime_from_str("1970-01-01 00:00:00")
+    end = datetime_from_str("1970-01-01 10:00:00")
+
+    assert api.shard_range(start, end, 3600, index, count) == expected
+
+
+@pytest.mark.parametrize("records_per_s,end_lag_s", [[1, 33], [0, 3630]])
+def test_adaptive_end_lag(records_per_s, end_lag_s):
+    """Windows end the measured lag plus a margin before now, once measured."""
+    fake = FakeLogsClient(
+        SimulatedClock(), records_per_s=records_per_s, ingestion_lag_s=2.5
+    )
+    config = {"adaptive_end_lag": True}
+    api = CloudwatchAPI(logging.getLogger(__name__), config)
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+    start = datetime.now(timezone.utc) - timedelta(hours=2)
+
+    with fake.clock.patched():
+        windows = list(
+            api._get_batch_windows(
+                api.client, "group", start, "fields @timestamp", 3600, None, None
+            )
+        )
+        api._measure_end_lag(api.client, "group")
+
+    now_ts = datetime.now(timezone.utc).timestamp()
+    assert now_ts - windows[-1][1] == pytest.approx(end_lag_s, abs=2)
+    assert fake.calls["start_query"] == 1
+
+
+def test_iterate_batches_observes_density():
+    """Completed windows update the planner's density before they're read."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=1)
+    api = CloudwatchAPI(logging.getLogger(__name__))
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate({})
+    planner = AdaptiveWindowPlanner(3600)
+    windows = planner.windows(
+        datetime(2023, 1, 1, tzinfo=timezone.utc),
+        datetime(2023, 1, 2, tzinfo=timezone.utc),
+    )
+
+    with fake.clock.patched():
+        for _ in api._iterate_batches(
+            windows, "group", "fields @timestamp, @message", planner
+        ):
+            pass
+
+    assert planner.density == pytest.approx(1, rel=0.05)
+
+
+def test_end_lag_kept_without_events():
+    """A probe finding no events keeps the lag measured before."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=1, ingestion_lag_s=2.5)
+    config = {"adaptive_end_lag": True}
+    api = CloudwatchAPI(logging.getLogger(__name__), config)
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+
+    with fake.clock.patched():
+        assert api._measure_end_lag(api.client, "group") == 33
+        time.sleep(api.end_lag_probe_s)
+        # Delayed by more than the probe range, or idle.
+        fake.records_per_s = 0
+        assert api._measure_end_lag(api.client, "group") == 33
+
+    assert fake.calls["start_query"] == 2
+
+
+def test_interrupted_job_stops_queries():
+    """Closing a job before it's done stops the queries still running."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=1)
+    api = CloudwatchAPI(logging.getLogger(__name__))
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate({})
+    records = api.get_records_iterator(
+        datetime(2023, 1, 1, tzinfo=timezone.utc),
+        "group",
+        "fields @timestamp, @message",
+        3600,
+        datetime(2023, 1, 2, tzinfo=timezone.utc),
+    )
+
+    with fake.clock.patched():
+        next(records)
+        records.close()
+
+    now = fake.clock.monotonic()
+    statuses = Counter(q.status(now) for q in fake._queries.values())
+    assert statuses["Cancelled"] > 0
+    assert statuses["Running"] == statuses["Scheduled"] == 0
+    assert api.client.running_queries == set()
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+def test_closed_job_releases_buffer(engine):
+    """Results held for a job closed before they're read are released."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=1)
+    config = {"query_engine": engine}
+    api = CloudwatchAPI(logging.getLogger(__name__), config)
+    api.row_buffer.max_bytes = 2**20
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+    records = api.get_records_iterator(
+        datetime(2023, 1, 1, tzinfo=timezone.utc),
+        "group",
+        "fields @timestamp, @message",
+        3600,
+        datetime(2023, 1, 2, tzinfo=timezone.utc),
+    )
+
+    with fake.clock.patched():
+        next(records)
+        while not api.row_buffer.spill_count:
+            next(records)
+        records.close()
+
+    assert api.row_buffer.bytes == 0
+    assert api.row_buffer._held_spilled == 0
+    assert api.row_buffer._file.tell() == 0
+    assert not api._jobs
+    assert not api._in_flight
+
+
+class StuckLogsClient(FakeLogsClient):
+    """Fake client leaving the queries started by the given calls stuck."""
+
+    def __init__(self, clock, stuck_calls, **kwargs):
+        super().__init__(clock, **kwargs)
+        self.stuck_calls = stuck_calls
+
+    def start_query(self, **kwargs):
+        response = super().start_query(**kwargs)
+        if self.calls["start_query"] in self.stuck_calls:
+            self._queries[response["queryId"]].done_at = float("inf")
+        return response
+
+
+def test_stuck_continuation_runs_to_the_end():
+    """A continuation past its deadline twice is run again without a deadline."""
+    # The window is resubmitted once, then its continuation is twice.
+    fake = StuckLogsClient(SimulatedClock(), stuck_calls={1, 3, 4}, records_per_s=4)
+    config = {"query_timeout_s": 60}
+    api = CloudwatchAPI(logging.getLogger(__name__), config)
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    start_ts = int(start.timestamp())
+    records = api.get_records_iterator(
+        start, "group", "fields @timestamp, @message", 3600, start + timedelta(hours=1)
+    )
+
+    with fake.clock.patched():
+        rows = [row for page in records for row in page]
+
+    # The continuation overlaps the first page by a second.
+    assert len(rows) >= fake._count(start_ts, start_ts + 3600)
+    assert fake.calls["start_query"] == 5
+    assert api.stats.deadline_stops == 3
+    assert api.client.running_queries == set()
@@ -1,13 +1,21 @@
 """Tests standard tap features using the built-in SDK tests library."""
 
+import io
+import json
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
 import boto3
+import pytest
 from botocore.stub import Stubber
 from freezegun import freeze_time
 from singer_sdk.testing import get_standard_tap_tests
 
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
 from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.exception import InvalidConfigException
 from tap_cloudwatch.tap import TapCloudWatch
 
 from .utils import datetime_from_str
@@ -60,3 +68,230 @@ def test_standard_tap_tests(patch_client):
     tests = get_standard_tap_tests(TapCloudWatch, config=SAMPLE_CONFIG)
     for test in tests:
         test()
+
+
+def test_log_group_partitions():
+    """Each log group and region pair is a partition."""
+    tap = TapCloudWatch(
+        config={
+            **SAMPLE_CONFIG,
+            "log_group_names": ["group_a", "group_b"],
+            "aws_region_names": ["us-east-1", "eu-west-1"],
+        },
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+
+    assert stream.partitions == [
+        {"log_group_name": "group_a", "aws_region_name": "us-east-1"},
+        {"log_group_name": "group_b", "aws_region_name": "us-east-1"},
+        {"log_group_name": "group_a", "aws_region_name": "eu-west-1"},
+        {"log_group_name": "group_b", "aws_region_name": "eu-west-1"},
+    ]
+    assert "log_group_name" in stream.schema["properties"]
+    assert "aws_region_name" in stream.schema["properties"]
+
+
+def test_region_partitions():
+    """A single log group is partitioned by region."""
+    tap = TapCloudWatch(
+        config={**SAMPLE_CONFIG, "aws_region_names": ["us-east-1", "eu-west-1"]},
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+
+    assert stream.partitions == [
+        {"aws_region_name": "us-east-1"},
+        {"aws_region_name": "eu-west-1"},
+    ]
+    assert "log_group_name" not in stream.schema["properties"]
+    assert "aws_region_name" in stream.schema["properties"]
+
+
+@patch.object(CloudwatchAPI, "add_query_job")
+@patch.object(CloudwatchAPI, "authenticate")
+def test_resume_from_window_checkpoint(authenticate, add_query_job):
+    """Windows already read are skipped even if they held no records."""
+    window_end = int(datetime_from_str("2022-12-29 06:00:00").timestamp())
+    tap = TapCloudWatch(
+        config=SAMPLE_CONFIG,
+        state={
+            "bookmarks": {
+                "log": {
+                    "replication_key": "timestamp",
+                    "replication_key_value": "2022-12-29T05:12:00.000Z",
+                    "window_checkpoint": {"window_end": window_end},
+                }
+            }
+        },
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+
+    stream._get_cloudwatch_api()
+
+    bookmark = add_query_job.call_args.args[1]
+    assert bookmark == datetime_from_str("2022-12-29 06:00:01")
+
+    on_checkpoint = add_query_job.call_args.args[-1]
+    on_checkpoint(continuation_ts=window_end + 100)
+    assert stream.get_context_state(None)["window_checkpoint"] == {
+        "window_end": window_end,
+        "continuation_ts": window_end + 100,
+    }
+    on_checkpoint(window_end=window_end + 3600)
+    assert stream.get_context_state(None)["window_checkpoint"] == {
+        "window_end": window_end + 3600,
+    }
+
+
+@patch.object(CloudwatchAPI, "add_query_job")
+@patch.object(CloudwatchAPI, "authenticate")
+def test_shard_bounds(authenticate, add_query_job):
+    """A shard only queues its slice of the windows and records it in state."""
+    tap = TapCloudWatch(
+        config={
+            **SAMPLE_CONFIG,
+            "end_date": "2022-12-31",
+            "batch_increment_s": 3600,
+            "shard_index": 1,
+            "shard_count": 4,
+        },
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+
+    stream._get_cloudwatch_api()
+
+    start_ts = int(datetime_from_str("2022-12-29 12:00:01").timestamp())
+    end_ts = int(datetime_from_str("2022-12-30 00:00:00").timestamp())
+    assert add_query_job.call_args.args[1] == datetime_from_str("2022-12-29 12:00:01")
+    assert add_query_job.call_args.args[5] == datetime_from_str("2022-12-30 00:00:00")
+    assert stream.get_context_state(None)["shard"] == {
+        "index": 1,
+        "count": 4,
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+    }
+
+
+def test_follow():
+    """Following re-reads the end of each window without emitting it twice."""
+    start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=10)
+    fake = FakeLogsClient(
+        SimulatedClock(), records_per_s=2, queue_s=0.5, base_latency_s=0.5
+    )
+    tap = TapCloudWatch(
+        config={
+            **SAMPLE_CONFIG,
+            "start_date": start.isoformat(),
+            "batch_increment_s": 3600,
+            "follow": True,
+            "follow_poll_s": 5,
+            "follow_duration_s": 30,
+        },
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+
+    with (
+        patch.object(CloudwatchAPI, "_create_client", return_value=fake),
+        fake.clock.patched(),
+        redirect_stdout(io.StringIO()),
+    ):
+        records = list(stream.get_records(None))
+
+    window_end = stream.get_context_state(None)["window_checkpoint"]["window_end"]
+    ptrs = [record["ptr"] for record in records]
+    assert len(set(ptrs)) == len(ptrs)
+    assert len(ptrs) == fake._count(int(start.timestamp()), window_end)
+    assert window_end >= time.time() - 10
+    assert fake.calls["start_query"] >= 6
+
+
+def test_named_queries():
+    """Each named query is a stream with its own schema, sharing one API."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=0.1, log_streams=2)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    config = {
+        **SAMPLE_CONFIG,
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(hours=6)).isoformat(),
+        "batch_increment_s": 3600,
+        "queries": [
+            {"name": "errors", "query": "fields @timestamp, @message"},
+            {
+                "name": "api",
+                "query": "fields @timestamp, @message, @logStream",
+                "log_group_name": "api_group",
+            },
+        ],
+    }
+    del config["query"]
+    tap = TapCloudWatch(config=config, parse_env_config=False)
+
+    assert sorted(tap.streams) == ["api", "errors"]
+    assert "logStream" not in tap.streams["errors"].schema["properties"]
+    assert "logStream" in tap.streams["api"].schema["properties"]
+
+    stdout = io.StringIO()
+    with (
+        patch.object(CloudwatchAPI, "_create_client", return_value=fake),
+        fake.clock.patched(),
+        redirect_stdout(stdout),
+    ):
+        tap.sync_all()
+
+    messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    records = [message for message in messages if message["type"] == "RECORD"]
+    end_ts = int(start.timestamp()) + 6 * 3600
+    expected = fake._count(int(start.timestamp()), end_ts)
+    for stream, log_group in [("errors", "my_log_group_name"), ("api", "api_group")]:
+        messages = [r["record"]["message"] for r in records if r["stream"] == stream]
+        assert len(messages) == expected
+        assert all(message.startswith(log_group) for message in messages)
+        assert tap.streams[stream]._cloudwatch_api is tap.cloudwatch_api
+    bookmarks = tap.state["bookmarks"]
+    assert bookmarks["errors"]["window_checkpoint"]["window_end"] == end_ts
+    assert bookmarks["api"]["window_checkpoint"]["window_end"] == end_ts
+
+
+def test_follow_named_queries():
+    """Following one of several named queries would never sync the others."""
+    config = {
+        **SAMPLE_CONFIG,
+        "follow": True,
+        "queries": [
+            {"name": "errors", "query": "fields @timestamp, @message"},
+            {"name": "api", "query": "fields @timestamp, @message, @logStream"},
+        ],
+    }
+    del config["query"]
+    tap = TapCloudWatch(config=config, parse_env_config=False)
+    fake = FakeLogsClient(SimulatedClock())
+
+    with (
+        patch.object(CloudwatchAPI, "_create_client", return_value=fake),
+        pytest.raises(InvalidConfigException, match="`queries`"),
+    ):
+        tap.sync_all()
+    assert fake.calls["start_query"] == 0
+
+
+@patch.object(CloudwatchAPI, "add_query_job")
+@patch.object(CloudwatchAPI, "authenticate")
+def test_deselected_fields_not_queried(authenticate, add_query_job):
+    """Properties deselected in the catalog are left out of the query."""
+    tap = TapCloudWatch(
+        config={
+            **SAMPLE_CONFIG,
+            "query": "fields @timestamp, @message, @logStream, @ptr",
+        },
+        parse_env_config=False,
+    )
+    stream = tap.streams["log"]
+    stream.metadata[("properties", "message")].selected = False
+
+    stream._get_cloudwatch_api()
+
+    assert add_query_job.call_args.args[3] == "fields @timestamp, @logStream, @ptr"
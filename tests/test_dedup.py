@@ -0,0 +1,33 @@
+"""Tests dedup module."""
+
+from tap_cloudwatch.dedup import PtrDedupCache
+
+
+def test_dedup_drops_repeats():
+    """Records repeated from a re-queried second are duplicates."""
+    cache = PtrDedupCache()
+    assert not cache.is_duplicate("2023-02-20 06:01:57.009", "a")
+    assert not cache.is_duplicate("2023-02-20 06:01:57.792", "b")
+    # Sub-batch restarts from 06:01:57
+    assert cache.is_duplicate("2023-02-20 06:01:57.009", "a")
+    assert cache.is_duplicate("2023-02-20 06:01:57.792", "b")
+    assert not cache.is_duplicate("2023-02-20 06:01:57.800", "c")
+    assert cache.hits == 2
+
+
+def test_dedup_evicts_past_watermark():
+    """Only the latest two seconds are kept."""
+    cache = PtrDedupCache()
+    cache.is_duplicate("2023-02-20 06:01:57.009", "a")
+    cache.is_duplicate("2023-02-20 06:01:58.009", "b")
+    assert len(cache) == 2
+    cache.is_duplicate("2023-02-20 06:01:59.009", "c")
+    assert len(cache) == 2
+    assert not cache.is_duplicate("2023-02-20 06:01:57.009", "a")
+
+
+def test_dedup_without_ptr():
+    """Records without a ptr are never duplicates."""
+    cache = PtrDedupCache()
+    assert not cache.is_duplicate("2023-02-20 06:01:57.009", None)
+    assert not cache.is_duplicate("2023-02-20 06:01:57.009", None)
@@ -0,0 +1,178 @@
+"""Tests reading historical ranges through export tasks."""
+
+import gzip
+import logging
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import boto3
+from botocore.stub import ANY, Stubber
+
+from benchmarks.bench_throughput import START, run_api
+from benchmarks.fake_logs import FakeLogsClient, FakeS3Client, SimulatedClock
+from tap_cloudwatch.cloudwatch_api import CloudwatchAPI
+from tap_cloudwatch.export import ExportReader
+from tap_cloudwatch.filter_events import parse_simple_query
+from tap_cloudwatch.subquery import Subquery
+
+
+def _put(s3, key, lines):
+    s3.put_object(
+        Bucket="bucket", Key=key, Body=gzip.compress("\n".join(lines).encode())
+    )
+
+
+def test_export_reader():
+    """Exported objects are merged in time order and filtered like a query."""
+    client = boto3.client("logs", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_response(
+        "create_export_task",
+        {"taskId": "task-1"},
+        {
+            "taskName": ANY,
+            "logGroupName": "group",
+            "fromTime": 1672531200000,
+            "to": 1672534799999,
+            "destination": "bucket",
+            "destinationPrefix": "exports",
+        },
+    )
+    for status in ["RUNNING", "COMPLETED"]:
+        stubber.add_response(
+            "describe_export_tasks",
+            {"exportTasks": [{"taskId": "task-1", "status": {"code": status}}]},
+            {"taskId": "task-1"},
+        )
+    s3 = FakeS3Client(page_size=2)
+    s3.put_object(Bucket="bucket", Key="exports/aws-logs-write-test", Body=b"")
+    _put(
+        s3,
+        "exports/task-1/web/1/000000.gz",
+        [
+            "2023-01-01T00:00:01.000Z error: one",
+            "2023-01-01T00:00:03.000Z ok",
+            "2023-01-01T00:00:05.000Z error: two",
+            "  at line 3",
+        ],
+    )
+    _put(s3, "exports/task-1/api/000000.gz", ["2023-01-01T00:00:02.000Z error: a"])
+    _put(s3, "exports/task-1/api/000001.gz", ["2023-01-01T00:00:04.000Z error: b"])
+    reader = ExportReader(
+        client,
+        s3,
+        "bucket",
+        "exports/",
+        "group",
+        parse_simple_query(
+            'fields @timestamp, @message, @logStream | filter @message like "error"'
+        ),
+        max_workers=2,
+        poll_s=0,
+    )
+
+    with stubber:
+        rows = [
+            row for page, _ in reader.iter_range(1672531200, 1672534799) for row in page
+        ]
+    reader.close()
+
+    assert [[field["value"] for field in row[:3]] for row in rows] == [
+        ["2023-01-01 00:00:01.000", "error: one", "web/1"],
+        ["2023-01-01 00:00:02.000", "error: a", "api"],
+        ["2023-01-01 00:00:04.000", "error: b", "api"],
+        ["2023-01-01 00:00:05.000", "error: two\n  at line 3", "web/1"],
+    ]
+    assert [row[3]["value"].split("/")[0] for row in rows] == [
+        "2023-01-01T00:00:01.000Z",
+        "2023-01-01T00:00:02.000Z",
+        "2023-01-01T00:00:04.000Z",
+        "2023-01-01T00:00:05.000Z",
+    ]
+    stubber.assert_no_pending_responses()
+
+
+def test_export_checkpoints_and_stable_ptrs():
+    """Pages end on whole seconds and re-exported events keep their `@ptr`."""
+    fake = FakeLogsClient(
+        SimulatedClock(), records_per_s=4, log_streams=2, s3=FakeS3Client()
+    )
+    reader = ExportReader(
+        fake,
+        fake.s3,
+        "bucket",
+        "exports",
+        "group",
+        parse_simple_query("fields @timestamp, @message, @ptr"),
+        max_workers=2,
+        poll_s=1,
+        page_size=3,
+    )
+
+    with fake.clock.patched():
+        first = list(reader.iter_range(0, 99))
+        second = list(reader.iter_range(50, 99))
+    reader.close()
+
+    ptrs = {row[2]["value"] for page, _ in first for row in page}
+    assert len(ptrs) == fake._count(0, 99)
+    assert [window_end for _, window_end in first] == [*range(0, 99), 99]
+    assert all(
+        Subquery._record_ts(row) > window_end
+        for (_, window_end), (page, _) in zip(first, first[1:])
+        for row in page
+    )
+    assert {row[2]["value"] for page, _ in second for row in page} <= ptrs
+
+
+def test_run_api_with_export():
+    """The whole historical range is read from one export task."""
+    fake = FakeLogsClient(
+        SimulatedClock(), records_per_s=4, log_streams=3, s3=FakeS3Client()
+    )
+
+    result = run_api(
+        fake, 0.1, 3600, 5, config={"export_bucket": "bucket"}, trace_memory=False
+    )
+
+    start_ts = int(START.timestamp())
+    assert result["records"] == fake._count(start_ts, start_ts + 8640)
+    assert result["start_query"] == 0
+    assert fake.calls["create_export_task"] == 1
+
+
+def test_recent_tail_is_queried():
+    """Only the range before the tail is exported, the tail is queried."""
+    fake = FakeLogsClient(
+        SimulatedClock(), records_per_s=0.01, log_streams=2, s3=FakeS3Client()
+    )
+    config = {"export_bucket": "bucket", "export_tail_s": 3600}
+    api = CloudwatchAPI(logging.getLogger(__name__), config)
+    with patch.object(CloudwatchAPI, "_create_client", return_value=fake):
+        api.authenticate(config)
+    api._s3_client = fake.s3
+    checkpoints = []
+    start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=3)
+    job_key = object()
+    api.add_query_job(
+        job_key,
+        start,
+        "group",
+        "fields @timestamp, @message",
+        3600,
+        None,
+        on_checkpoint=lambda **kwargs: checkpoints.append(kwargs),
+    )
+
+    with fake.clock.patched():
+        records = [row for page in api.run_query_job(job_key) for row in page]
+
+    (task,) = fake._export_tasks.values()
+    cutoff_ts = checkpoints[0]["window_end"]
+    assert cutoff_ts - int(start.timestamp()) in (7200, 7201)
+    assert task["request"][1:3] == (
+        int(start.timestamp()) * 1000,
+        cutoff_ts * 1000 + 999,
+    )
+    assert fake.calls["start_query"] > 0
+    assert len(records) >= fake._count(int(start.timestamp()), cutoff_ts)
@@ -0,0 +1,104 @@
+"""Tests reading simple queries with FilterLogEvents."""
+
+import pytest
+
+from benchmarks.bench_throughput import START, run_api
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
+from tap_cloudwatch.filter_events import FilterEventsReader, parse_simple_query
+
+
+@pytest.mark.parametrize(
+    "query,fields,filters",
+    [
+        ["fields @timestamp, @message", ["@timestamp", "@message"], 0],
+        [
+            "fields @timestamp, @logStream | filter @message like /a|b/",
+            ["@timestamp", "@logStream"],
+            1,
+        ],
+        [
+            'fields @timestamp | filter @message like "x | y" '
+            '| filter @logStream = "web"',
+            ["@timestamp"],
+            2,
+        ],
+        ["fields @timestamp, @message, level", None, None],
+        ["fields @timestamp | filter @timestamp like /2023/", None, None],
+        ["fields @timestamp | parse @message '* *' as a, b", None, None],
+        ["fields @timestamp | stats count(*) by bin(1h)", None, None],
+    ],
+)
+def test_parse_simple_query(query, fields, filters):
+    """Only queries selecting and filtering event fields are simple."""
+    simple_query = parse_simple_query(query)
+
+    if fields is None:
+        assert simple_query is None
+    else:
+        assert simple_query.fields == fields
+        assert len(simple_query.filters) == filters
+
+
+def _reader(fake, query, page_size=1000):
+    return FilterEventsReader(
+        fake, "group", parse_simple_query(query), max_workers=4, page_size=page_size
+    )
+
+
+def test_streams_merged_in_order():
+    """Every event of the window is read once, merged in timestamp order."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4, log_streams=3)
+    reader = _reader(fake, "fields @timestamp, @message")
+
+    pages = list(reader.iter_window(0, 3599))
+    reader.close()
+
+    rows = [row for page in pages for row in page]
+    assert max(len(page) for page in pages) == 1000
+    timestamps = [row[0]["value"] for row in rows]
+    assert timestamps == sorted(timestamps)
+    expected = fake._rows("group", 0, 3599, 20000)
+    assert sorted(row[2]["value"] for row in rows) == sorted(
+        row[2]["value"] for row in expected
+    )
+    assert rows[0] == expected[0]
+
+
+def test_filters():
+    """Log stream filters pick the streams, message filters the events."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4, log_streams=3)
+    reader = _reader(
+        fake,
+        'fields @timestamp, @logStream | filter @logStream = "stream-1" '
+        "| filter @message like / 1[0-9] /",
+    )
+
+    rows = [row for page in reader.iter_window(0, 59) for row in page]
+    reader.close()
+
+    assert {row[1]["value"] for row in rows} == {"stream-1"}
+    assert [row[2]["value"] for row in rows] == [
+        "group/10/1",
+        "group/11/1",
+        "group/12/1",
+        "group/13/1",
+        "group/14/1",
+        "group/15/1",
+        "group/16/1",
+        "group/17/1",
+        "group/18/1",
+        "group/19/1",
+    ]
+
+
+def test_run_api_with_filter_log_events():
+    """Simple queries don't run Logs Insights queries and aren't capped."""
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4, log_streams=4)
+
+    result = run_api(
+        fake, 0.1, 21600, 5, config={"filter_log_events": True}, trace_memory=False
+    )
+
+    start_ts = int(START.timestamp())
+    assert result["records"] == fake._count(start_ts, start_ts + 8640)
+    assert result["start_query"] == 0
@@ -8,7 +8,7 @@ import pytest
 from botocore.stub import Stubber
 from freezegun import freeze_time
 
-from tap_cloudwatch.subquery import Subquery
+from tap_cloudwatch.subquery import HistogramSubquery, LagSubquery, Subquery
 
 
 @freeze_time("2022-12-30")
@@ -129,7 +129,7 @@ def test_subquery_retry(first_status, second_status, expectation):
         assert response["results"] == output
 
 
-@patch.object(Subquery, "_handle_limit_exceeded", return_value=["foo"])
+@patch.object(Subquery, "_handle_limit_exceeded")
 def test_subquery_limit_exceeded(patch_limit):
     """Run subquery test."""
     client = boto3.client("logs", region_name="us-east-1")
@@ -150,26 +150,41 @@ def test_subquery_limit_exceeded(patch_limit):
         "ResponseMetadata": {"HTTPStatusCode": 200},
         "statistics": {"recordsMatched": 10001},
     }
+    continuation_response = {
+        "status": "Complete",
+        "results": [
+            [
+                {"field": "@timestamp", "value": "2022-01-02"},
+                {"field": "@message", "value": "def"},
+            ]
+        ],
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "statistics": {"recordsMatched": 1},
+    }
     stubber.add_response(
         "get_query_results",
         response,
         {"queryId": "123"},
     )
+    stubber.add_response(
+        "get_query_results",
+        continuation_response,
+        {"queryId": "123"},
+    )
     stubber.activate()
 
     query_obj = Subquery(client, query_start, query_end, log_group, in_query)
     query_obj.query_id = "123"
-    output = query_obj.get_results()
+    pages = query_obj.iter_results()
 
+    # The continuation is started before the first page is handed over.
+    assert next(pages) == response["results"]
     patch_limit.assert_called_with(response)
-    results = response["results"]
-    results += ["foo"]
-    assert results == output
+    assert list(pages) == [continuation_response["results"]]
 
 
 @patch.object(Subquery, "execute")
-@patch.object(Subquery, "get_results")
-def test_handle_limit_exceeded(patch_result, execute):
+def test_handle_limit_exceeded(execute):
     """Run subquery test."""
     response = {
         "status": "Complete",
@@ -191,7 +206,196 @@ def test_handle_limit_exceeded(patch_result, execute):
     query_obj.query_id = "123"
     query_obj._handle_limit_exceeded(response)
 
-    patch_result.assert_called()
     execute.assert_called()
 
     assert query_obj.start_ts == 1672531200
+
+
+def test_subquery_split():
+    """Split keeps results before the last second and plans sub-windows."""
+    query_obj = Subquery("", 1672531200, 1672531299, "", "")
+    query_obj._response = {
+        "status": "Complete",
+        "results": [
+            [{"field": "@timestamp", "value": "2023-01-01 00:00:00.100"}],
+            [{"field": "@timestamp", "value": "2023-01-01 00:00:10.100"}],
+            [{"field": "@timestamp", "value": "2023-01-01 00:00:10.200"}],
+        ],
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "statistics": {"recordsMatched": 20001},
+    }
+
+    assert query_obj.is_oversized()
+    results, windows = query_obj.split(0.5)
+
+    assert results == [
+        [{"field": "@timestamp", "value": "2023-01-01 00:00:00.100"}],
+    ]
+    assert query_obj.records_matched == 20001
+    # 20k remaining records at 5k per sub-window over the last 90 seconds.
+    assert windows == [
+        (1672531210, 1672531231),
+        (1672531232, 1672531254),
+        (1672531255, 1672531276),
+        (1672531277, 1672531299),
+    ]
+
+
+def test_histogram_subquery():
+    """Histogram queries count records per bin."""
+    client = boto3.client("logs", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_response(
+        "start_query",
+        {"queryId": "123"},
+        {
+            "endTime": 1672275600,
+            "limit": 10000,
+            "logGroupName": "my_log_group_name",
+            "queryString": "fields @timestamp, @message"
+            " | stats count(*) as records by bin(300s)",
+            "startTime": 1672272000,
+        },
+    )
+    stubber.add_response(
+        "get_query_results",
+        {
+            "status": "Complete",
+            "results": [
+                [
+                    {"field": "bin(300s)", "value": "2022-12-29 00:05:00.000"},
+                    {"field": "records", "value": "7"},
+                ],
+                [
+                    {"field": "bin(300s)", "value": "2022-12-29 00:00:00.000"},
+                    {"field": "records", "value": "3"},
+                ],
+            ],
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+            "statistics": {"recordsMatched": 10},
+        },
+        {"queryId": "123"},
+    )
+    stubber.activate()
+
+    query_obj = HistogramSubquery(
+        client,
+        1672272000,
+        1672275600,
+        "my_log_group_name",
+        "fields @timestamp, @message",
+        300,
+    )
+    query_obj.execute()
+    query_obj.next_poll_at = 0
+
+    assert query_obj.get_bins() == [(1672272000, 3), (1672272300, 7)]
+
+
+@pytest.mark.parametrize(
+    "percentile,stat,results,expected",
+    [
+        [99, "pct(lag, 99)", [[("lag_ms", "1500.5"), ("events", "20")]], 1.5005],
+        [100, "max(lag)", [[("lag_ms", "-200"), ("events", "20")]], 0.0],
+        [100, "max(lag)", [[("events", "0")]], None],
+        [100, "max(lag)", [], None],
+    ],
+)
+def test_lag_subquery(percentile, stat, results, expected):
+    """Lag queries measure the ingestion lag, None without any events."""
+    client = boto3.client("logs", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_response(
+        "start_query",
+        {"queryId": "123"},
+        {
+            "endTime": 1672275600,
+            "limit": 10000,
+            "logGroupName": "my_log_group_name",
+            "queryString": "fields @ingestionTime - @timestamp as lag"
+            f" | stats {stat} as lag_ms, count(*) as events",
+            "startTime": 1672272000,
+        },
+    )
+    stubber.add_response(
+        "get_query_results",
+        {
+            "status": "Complete",
+            "results": [
+                [{"field": field, "value": value} for field, value in row]
+                for row in results
+            ],
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+            "statistics": {"recordsMatched": 20},
+        },
+        {"queryId": "123"},
+    )
+    stubber.activate()
+
+    query_obj = LagSubquery(
+        client, 1672272000, 1672275600, "my_log_group_name", percentile
+    )
+    query_obj.execute()
+    query_obj.next_poll_at = 0
+
+    assert query_obj.get_lag_s() == expected
+
+
+def test_subquery_stats():
+    """Polls, retries, queueing and scan statistics are tracked."""
+    client = boto3.client("logs", region_name="us-east-1")
+    stubber = Stubber(client)
+    params = {
+        "endTime": 1672275600,
+        "limit": 10000,
+        "logGroupName": "my_log_group_name",
+        "queryString": "fields @timestamp, @message | sort @timestamp asc",
+        "startTime": 1672272000,
+    }
+    stubber.add_response("start_query", {"queryId": "123"}, params)
+    stubber.add_response("get_query_results", {"status": "Failed"}, {"queryId": "123"})
+    stubber.add_response("start_query", {"queryId": "456"}, params)
+    stubber.add_response(
+        "get_query_results", {"status": "Scheduled"}, {"queryId": "456"}
+    )
+    stubber.add_response(
+        "get_query_results",
+        {
+            "status": "Complete",
+            "results": [],
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+            "statistics": {
+                "recordsMatched": 3,
+                "recordsScanned": 5,
+                "bytesScanned": 100,
+            },
+        },
+        {"queryId": "456"},
+    )
+    stubber.activate()
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with (
+        patch("tap_cloudwatch.subquery.time.monotonic", lambda: clock[0]),
+        patch("tap_cloudwatch.subquery.time.sleep", sleep),
+    ):
+        query_obj = Subquery(
+            client,
+            1672272000,
+            1672275600,
+            "my_log_group_name",
+            "fields @timestamp, @message",
+        ).execute()
+        query_obj.get_results()
+
+    stats = query_obj.stats
+    assert (stats.polls, stats.retries, stats.continuations) == (3, 1, 0)
+    # Failed after 0.5s running, then queued 0.5s and ran 0.75s.
+    assert stats.queued_s == 0.5
+    assert stats.running_s == 1.25
+    assert stats.records_matched == 3
+    assert stats.records_scanned == 5
+    assert stats.bytes_scanned == 100
@@ -0,0 +1,79 @@
+"""Tests tokenizing Logs Insights queries."""
+
+import pytest
+
+from tap_cloudwatch.query_parser import (
+    Field,
+    parse_fields,
+    project_query,
+    split_commands,
+)
+
+
+@pytest.mark.parametrize(
+    "query,commands",
+    [
+        ["fields @timestamp", ["fields @timestamp"]],
+        [
+            'fields @timestamp | filter @message like "a | b"',
+            ["fields @timestamp", 'filter @message like "a | b"'],
+        ],
+        [
+            "fields @timestamp | filter @message like /a|b/ | filter x =~ /c|d/",
+            ["fields @timestamp", "filter @message like /a|b/", "filter x =~ /c|d/"],
+        ],
+        [
+            r'fields @timestamp | filter @message = "quoted \" | pipe"',
+            ["fields @timestamp", r'filter @message = "quoted \" | pipe"'],
+        ],
+    ],
+)
+def test_split_commands(query, commands):
+    """Pipes inside literals don't split commands."""
+    assert split_commands(query) == commands
+
+
+def test_parse_fields():
+    """Fields are split outside of function calls and literals, with aliases."""
+    query = (
+        "fields @timestamp, concat(@logStream, ',', level) as `stream level`,"
+        " strlen(@message), @message AS msg | filter msg like /x/"
+    )
+
+    assert parse_fields(query) == [
+        Field("@timestamp", "@timestamp"),
+        Field("concat(@logStream, ',', level)", "stream level"),
+        Field("strlen(@message)", "strlen(@message)"),
+        Field("@message", "msg"),
+    ]
+    assert parse_fields("filter @message like /x/ | fields @timestamp") is None
+
+
+@pytest.mark.parametrize(
+    "query,selected,expected",
+    [
+        [
+            "fields @timestamp, @message, @logStream, @ptr",
+            {"message"},
+            "fields @timestamp, @message, @ptr",
+        ],
+        [
+            "fields @timestamp, @message, @logStream",
+            {"message", "logStream"},
+            "fields @timestamp, @message, @logStream",
+        ],
+        [
+            "fields @timestamp, @message, level | filter @message like 'level'",
+            set(),
+            "fields @timestamp | filter @message like 'level'",
+        ],
+        [
+            "fields @timestamp, strlen(@message) as len, @logStream | filter len > 5",
+            set(),
+            "fields @timestamp, strlen(@message) as len | filter len > 5",
+        ],
+    ],
+)
+def test_project_query(query, selected, expected):
+    """Only selected fields, the key fields and referenced aliases are kept."""
+    assert project_query(query, selected.__contains__) == expected
@@ -0,0 +1,27 @@
+"""Tests records module."""
+
+from tap_cloudwatch.records import iter_records
+
+
+def test_iter_records():
+    """Rows are converted and timestamps normalized to RFC 3339."""
+    rows = [
+        [
+            {"field": "@timestamp", "value": "2023-02-20 06:01:57.792"},
+            {"field": "@message", "value": "abc"},
+            {"field": "@ptr", "value": "p1"},
+        ],
+        [
+            {"field": "@timestamp", "value": "2023-02-20 06:01:58.001"},
+            {"field": "loggingType", "value": "INFO"},
+        ],
+        [{"field": "@timestamp", "value": "2022-01-01"}],
+    ]
+
+    records = list(iter_records(rows))
+
+    assert records == [
+        {"timestamp": "2023-02-20T06:01:57.792Z", "message": "abc", "ptr": "p1"},
+        {"timestamp": "2023-02-20T06:01:58.001Z", "loggingType": "INFO"},
+        {"timestamp": "2022-01-01"},
+    ]
@@ -0,0 +1,114 @@
+"""Tests the on-disk result cache."""
+
+import os
+import time
+
+import pytest
+
+from benchmarks.bench_throughput import run_api
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
+from tap_cloudwatch.result_cache import ResultCache, normalize_query
+
+PAGE = [
+    [
+        {"field": "@timestamp", "value": "2023-01-01 00:00:00.000"},
+        {"field": "@message", "value": "a"},
+    ],
+    [{"field": "@timestamp", "value": "2023-01-01 00:00:01.000"}],
+]
+
+
+def _store(cache, window, pages):
+    writer = cache.writer("us-east-1", "group", "query", *window)
+    for page in pages:
+        writer.add_page(page)
+    writer.commit()
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        [
+            "fields @timestamp,\n  @message |  limit 5",
+            "fields @timestamp, @message | limit 5",
+        ],
+        ["fields @timestamp|filter x", "fields @timestamp | filter x"],
+        ['filter @message like "a  |  b"', 'filter @message like "a  |  b"'],
+    ],
+)
+def test_normalize_query(query, expected):
+    """Whitespace is normalized outside of quoted strings."""
+    assert normalize_query(query) == expected
+
+
+def test_round_trip(tmp_path):
+    """Pages are read back as they were stored, keyed by the whole window."""
+    cache = ResultCache(str(tmp_path), 2**20, 60)
+    _store(cache, (0, 9), [PAGE, []])
+
+    assert list(cache.get("us-east-1", "group", "query", 0, 9)) == [PAGE, []]
+    assert cache.get("us-east-1", "group", "query", 0, 10) is None
+    assert cache.get("eu-west-1", "group", "query", 0, 9) is None
+    assert cache.get("us-east-1", "group", "query  ", 0, 9) is not None
+
+
+def test_aborted_entries_are_discarded(tmp_path):
+    """A window that wasn't read in full isn't cached."""
+    cache = ResultCache(str(tmp_path), 2**20, 60)
+    writer = cache.writer("us-east-1", "group", "query", 0, 9)
+    writer.add_page(PAGE)
+    writer.abort()
+
+    assert cache.get("us-east-1", "group", "query", 0, 9) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_ttl(tmp_path):
+    """Entries older than the TTL are dropped."""
+    cache = ResultCache(str(tmp_path), 2**20, 60)
+    _store(cache, (0, 9), [PAGE])
+    (path,) = tmp_path.iterdir()
+    os.utime(path, (time.time(), time.time() - 61))
+
+    assert cache.get("us-east-1", "group", "query", 0, 9) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_lru_eviction(tmp_path):
+    """The least recently read entries are evicted over the size cap."""
+    cache = ResultCache(str(tmp_path), 2**20, 60)
+    windows = [(0, 9), (10, 19), (20, 29)]
+    for age, window in zip([30, 20, 10], windows):
+        _store(cache, window, [PAGE])
+        path = cache._path("us-east-1", "group", "query", *window)
+        os.utime(path, (time.time() - age, os.stat(path).st_mtime))
+    list(cache.get("us-east-1", "group", "query", 0, 9))
+    cache.max_bytes = 2 * os.stat(path).st_size
+
+    cache.evict()
+
+    cached = [cache.get("us-east-1", "group", "query", *w) for w in windows]
+    assert [pages is not None for pages in cached] == [True, False, True]
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_rerun_reads_from_cache(tmp_path, split):
+    """A re-run reads every historical window from the cache."""
+    config = {
+        "result_cache_dir": str(tmp_path),
+        "split_oversized_windows": split,
+    }
+    first = run_api(
+        FakeLogsClient(SimulatedClock(), records_per_s=4),
+        0.1,
+        3600,
+        5,
+        config=config,
+        trace_memory=False,
+    )
+    fake = FakeLogsClient(SimulatedClock(), records_per_s=4)
+    second = run_api(fake, 0.1, 3600, 5, config=config, trace_memory=False)
+
+    assert first["start_query"] > 0
+    assert second["start_query"] == 0
+    assert second["records"] == first["records"]
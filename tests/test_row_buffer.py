@@ -0,0 +1,74 @@
+"""Tests holding result pages compactly until they're emitted."""
+
+import tracemalloc
+
+from tap_cloudwatch.row_buffer import RowBuffer
+
+
+def _rows(count, start=0):
+    return [
+        [
+            {"field": "@timestamp", "value": f"2023-01-01 00:00:{i % 60:02d}.000"},
+            {"field": "@message", "value": f"message {i}"},
+            {"field": "@ptr", "value": f"ptr{i}"},
+        ]
+        for i in range(start, start + count)
+    ]
+
+
+def test_rows_round_trip():
+    """Rows come back as they were held, including missing fields."""
+    buffer = RowBuffer()
+    rows = _rows(3)
+    del rows[1][1]
+    rows.append([{"field": "level", "value": "error"}])
+
+    page = buffer.hold(rows)
+
+    assert len(page) == 4
+    assert buffer.bytes > 0
+    assert page.rows() == rows
+    assert buffer.bytes == 0
+
+
+def test_spill_over_budget():
+    """Pages over the memory budget are spilled and read back in any order."""
+    buffer = RowBuffer(max_bytes=50000)
+    pages = [buffer.hold(_rows(100, start)) for start in range(0, 500, 100)]
+
+    assert buffer.spill_count == 3
+    assert buffer.bytes <= 50000
+    assert [page.rows() for page in reversed(pages)] == [
+        _rows(100, start) for start in reversed(range(0, 500, 100))
+    ]
+    assert buffer.bytes == 0
+    assert buffer._file.tell() == 0
+
+
+def test_held_pages_are_smaller():
+    """Held pages take a fraction of the memory of the rows."""
+    tracemalloc.start()
+    rows = _rows(10000)
+    rows_size = tracemalloc.get_traced_memory()[0]
+    page = RowBuffer().hold(rows)
+    del rows
+    page_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert page_size < rows_size / 2
+    assert len(page.rows()) == 10000
+
+
+def test_discard_owner():
+    """Pages of an owner that are never read are released by discarding it."""
+    buffer = RowBuffer(max_bytes=50000)
+    pages = [buffer.hold(_rows(100, start), "a") for start in range(0, 300, 100)]
+    kept = buffer.hold(_rows(100), "b")
+
+    pages[0].rows()
+    buffer.discard("a")
+
+    assert buffer._held_spilled == 1
+    assert kept.rows() == _rows(100)
+    assert buffer.bytes == 0
+    assert buffer._file.tell() == 0
@@ -0,0 +1,89 @@
+"""Tests merging the states of a sharded backfill."""
+
+from tap_cloudwatch.sharding import merge_shard_states
+
+
+def _state(index, end_ts, window_end=None, value=None, count=3):
+    state = {
+        "shard": {
+            "index": index,
+            "count": count,
+            "start_ts": end_ts - 99,
+            "end_ts": end_ts,
+        },
+        "starting_replication_value": f"start-{index}",
+    }
+    if window_end is not None:
+        state["window_checkpoint"] = {"window_end": window_end}
+    if value is not None:
+        state["replication_key"] = "timestamp"
+        state["replication_key_value"] = value
+    return {"bookmarks": {"log": state}}
+
+
+def test_merge_complete_shards():
+    """The merged bookmark is the last shard's once every shard is done."""
+    states = [
+        _state(2, 300, window_end=300, value="c"),
+        _state(0, 100, window_end=100, value="a"),
+        _state(1, 200, window_end=200, value="b"),
+    ]
+
+    assert merge_shard_states(states) == {
+        "bookmarks": {
+            "log": {
+                "replication_key": "timestamp",
+                "replication_key_value": "c",
+                "window_checkpoint": {"window_end": 300},
+                "starting_replication_value": "start-0",
+            }
+        }
+    }
+
+
+def test_merge_stops_at_unfinished_shard():
+    """Shards after one that didn't finish are left for the next run."""
+    states = [
+        _state(0, 100, window_end=100, value="a"),
+        _state(1, 200, window_end=150, value="b"),
+        _state(2, 300, window_end=300, value="c"),
+    ]
+
+    merged = merge_shard_states(states)["bookmarks"]["log"]
+
+    assert merged["replication_key_value"] == "b"
+    assert merged["window_checkpoint"] == {"window_end": 150}
+
+
+def test_merge_shard_without_progress():
+    """A shard that hasn't started keeps the bookmark of the one before."""
+    states = [
+        _state(0, 100, window_end=100, value="a"),
+        _state(1, 200),
+        _state(2, 300, window_end=300, value="c"),
+    ]
+
+    merged = merge_shard_states(states)["bookmarks"]["log"]
+
+    assert merged["replication_key_value"] == "a"
+
+
+def test_merge_partitions():
+    """Partitions are merged separately, matched by their context."""
+    states = []
+    for index, window_end in enumerate([100, 150]):
+        partitions = []
+        for group in ["a", "b"]:
+            partition = _state(index, (index + 1) * 100, window_end, group, 2)
+            partitions.append(
+                {"context": {"log_group_name": group}, **partition["bookmarks"]["log"]}
+            )
+        states.append({"bookmarks": {"log": {"partitions": partitions}}})
+
+    merged = merge_shard_states(states)["bookmarks"]["log"]["partitions"]
+
+    assert [p["context"] for p in merged] == [
+        {"log_group_name": "a"},
+        {"log_group_name": "b"},
+    ]
+    assert [p["window_checkpoint"] for p in merged] == [{"window_end": 150}] * 2
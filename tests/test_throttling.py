@@ -0,0 +1,102 @@
+"""Tests throttling module."""
+
+from unittest.mock import patch
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from benchmarks.fake_logs import FakeLogsClient, SimulatedClock
+from tap_cloudwatch.throttling import PollTimer, RateLimitedClient, TokenBucket
+
+
+@patch("tap_cloudwatch.throttling.time.sleep")
+@patch("tap_cloudwatch.throttling.time.monotonic", return_value=100.0)
+def test_token_bucket(monotonic, sleep):
+    """Calls over the burst capacity wait for their reserved token."""
+    bucket = TokenBucket(2)
+    bucket.acquire()
+    bucket.acquire()
+    sleep.assert_not_called()
+    bucket.acquire()
+    sleep.assert_called_with(0.5)
+    bucket.acquire()
+    sleep.assert_called_with(1.0)
+
+
+def test_poll_timer():
+    """Poll delays back off and adapt to observed durations."""
+    timer = PollTimer(min_delay_s=0.5, max_delay_s=4, backoff=2, smoothing=0.5)
+    assert timer.first_delay() == 0.5
+    assert timer.next_delay(0.5) == 1
+    assert timer.next_delay(3) == 4
+    timer.observe(10)
+    assert timer.first_delay() == 4
+    timer.observe(2)
+    assert timer.expected_duration_s == 6
+    timer.observe(0)
+    assert timer.first_delay() == pytest.approx(2.4)
+
+
+@patch("tap_cloudwatch.throttling.time.sleep")
+def test_rate_limited_client_retries_throttling(sleep):
+    """Throttling errors are retried and other errors are raised."""
+    client = boto3.client("logs", region_name="us-east-1")
+    stubber = Stubber(client)
+    stubber.add_client_error("get_query_results", "ThrottlingException")
+    stubber.add_response("get_query_results", {"status": "Running"}, {"queryId": "123"})
+    stubber.add_client_error("get_query_results", "InvalidParameterException")
+    stubber.activate()
+
+    limiter = TokenBucket(100)
+    wrapped = RateLimitedClient(client, {"get_query_results": limiter})
+
+    assert wrapped.get_query_results(queryId="123") == {"status": "Running"}
+    assert sleep.call_count == 1
+    with pytest.raises(ClientError):
+        wrapped.get_query_results(queryId="123")
+    # Non-operations pass straight through.
+    assert wrapped.meta is client.meta
+
+
+def test_poll_timer_deadline():
+    """Deadlines follow the observed durations once there are enough."""
+    timer = PollTimer(
+        deadline_factor=2,
+        deadline_percentile=90,
+        min_deadline_s=10,
+        max_deadline_s=100,
+        min_samples=10,
+    )
+    assert timer.deadline_s() == 100
+    for duration in range(1, 11):
+        timer.observe(duration)
+    assert timer.deadline_s() == 18
+    for _ in range(10):
+        timer.observe(80)
+    assert timer.deadline_s() == 100
+    assert PollTimer().deadline_s() is None
+
+
+def test_rate_limited_client_stops_running_queries():
+    """Queries that haven't finished are stopped, finished ones aren't."""
+    fake = FakeLogsClient(SimulatedClock(), base_latency_s=10)
+    client = RateLimitedClient(fake, {"start_query": TokenBucket(5)})
+    client.limiters["stop_query"] = TokenBucket(5)
+    client.limiters["get_query_results"] = TokenBucket(5)
+    running = client.start_query(
+        logGroupName="group", startTime=0, endTime=10, queryString="fields @message"
+    )["queryId"]
+    finished = client.start_query(
+        logGroupName="group", startTime=0, endTime=10, queryString="fields @message"
+    )["queryId"]
+    fake._queries[finished].running_at = fake._queries[finished].done_at = 0
+    client.get_query_results(queryId=finished)
+
+    assert client.running_queries == {running}
+    client.stop_queries()
+
+    assert client.running_queries == set()
+    assert fake.calls["stop_query"] == 1
+    assert fake.get_query_results(queryId=running)["status"] == "Cancelled"
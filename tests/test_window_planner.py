@@ -0,0 +1,70 @@
+"""Tests window planner module."""
+
+from tap_cloudwatch.window_planner import AdaptiveWindowPlanner, HistogramWindowPlanner
+
+from .utils import datetime_from_str
+
+
+def test_windows_without_density():
+    """Fall back to the batch increment until a density is observed."""
+    planner = AdaptiveWindowPlanner(3600)
+    windows = list(
+        planner.windows(
+            datetime_from_str("2022-12-29 00:00:00"),
+            datetime_from_str("2022-12-29 02:00:00"),
+        )
+    )
+    start = int(datetime_from_str("2022-12-29 00:00:00").timestamp())
+    assert windows == [
+        (start, start + 3600),
+        (start + 3601, start + 7200),
+    ]
+
+
+def test_windows_resize_after_observe():
+    """Each window is sized from the latest estimate."""
+    planner = AdaptiveWindowPlanner(3600, limit=10000, target_fill=0.5)
+    windows = planner.windows(
+        datetime_from_str("2022-12-29 00:00:00"),
+        datetime_from_str("2022-12-30 00:00:00"),
+    )
+    start_ts, end_ts = next(windows)
+    assert end_ts - start_ts == 3600
+    # 36k records in an hour is 10/s, so 5k records fit in 500s.
+    planner.observe(start_ts, end_ts, 36000)
+    start_ts, end_ts = next(windows)
+    assert end_ts - start_ts == 500
+
+
+def test_window_size_bounds():
+    """Window sizes are clamped to the configured bounds."""
+    planner = AdaptiveWindowPlanner(3600, density=0, max_window_s=7200)
+    assert planner._next_window_size() == 7200
+    planner = AdaptiveWindowPlanner(3600, density=10000, min_window_s=60)
+    assert planner._next_window_size() == 60
+
+
+def test_observe_smoothing():
+    """Observations are blended into the existing estimate."""
+    planner = AdaptiveWindowPlanner(3600, density=10, smoothing=0.5)
+    planner.observe(0, 100, 3000)
+    assert planner.density == 20
+    planner.observe(0, 100, None)
+    assert planner.density == 20
+
+
+def test_histogram_plan():
+    """Bins are merged under the target, split over it and gaps skipped."""
+    planner = HistogramWindowPlanner(limit=100, target_fill=0.5)
+    bins = [(0, 20), (60, 20), (120, 0), (180, 20), (240, 120), (300, 0), (360, 5)]
+
+    windows = planner.plan(bins, 30, 400, 60)
+
+    assert windows == [
+        (30, 119, 40),
+        (180, 239, 20),
+        (240, 259, 40),
+        (260, 279, 40),
+        (280, 299, 40),
+        (360, 400, 5),
+    ]